@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+# Sprite atlas builder. Packs every image in a directory into one
+# texture, so any number of sprite types can be drawn from a single
+# texture in a single draw call, and writes a JSON manifest saying where
+# each sprite went:
+#
+#     python atlas.py sprites/ bullet_atlas.png --padding 2 --bleed 2
+#
+# writes bullet_atlas.png and bullet_atlas.json. The atlas may also be a
+# .btex, baked with its mip chain by texture_assets.
+#
+# Sprites are packed with a skyline bottom-left packer, tallest first.
+# Each is surrounded by padding pixels; the innermost bleed of those
+# repeat the sprite's edge texels, so filtering and the first few mip
+# levels don't pull in the neighbouring sprites. That makes it safe for
+# texture coordinates to run right to the sprite's edges.
+#
+# The manifest gives each sprite's rectangle in pixels, top-left origin,
+# and the size of one world unit in pixels. sprite_tables turns it into
+# the integer-indexed arrays that bullets.py draws from.
+
+import argparse
+import json
+import os
+
+import numpy
+import pygame, pygame.image
+
+import texture_assets
+
+image_extensions = ('.png', '.tga', '.bmp', '.gif', '.jpg', '.jpeg')
+
+def load_sprites(directory):
+    # (name, pixels) for every image in directory, by file name. pixels
+    # is (height, width, 4) RGBA8 with the top row first.
+    sprites = []
+    for filename in sorted(os.listdir(directory)):
+        name, extension = os.path.splitext(filename)
+        if extension.lower() not in image_extensions:
+            continue
+        image = pygame.image.load(os.path.join(directory, filename))
+        pixels = numpy.frombuffer(
+            pygame.image.tostring(image, "RGBA"), dtype=numpy.uint8)
+        sprites.append((name, pixels.reshape(
+            image.get_height(), image.get_width(), 4)))
+    return sprites
+
+def skyline_pack(sizes, width):
+    # Positions (x, y), top-left origin, for rectangles of the given
+    # (width, height) sizes in a strip width wide, and the height used.
+    # The skyline is the list of (x, y, length) segments making up the
+    # top of what has been placed so far; each rectangle goes wherever
+    # its top edge ends up lowest, leftmost on ties.
+    skyline = [(0, 0, width)]
+    positions = [None] * len(sizes)
+    order = sorted(range(len(sizes)),
+        key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+    for i in order:
+        w, h = sizes[i]
+        if w > width:
+            return None, None
+        best = None
+        for start, (x, y, length) in enumerate(skyline):
+            if x + w > width:
+                break
+            top = y
+            covered = 0
+            segment = start
+            while covered < w:
+                top = max(top, skyline[segment][1])
+                covered += skyline[segment][2]
+                segment += 1
+            if best is None or (top + h, x) < (best[0], best[1]):
+                best = (top + h, x, top)
+        bottom, x, top = best
+        positions[i] = (x, top)
+        # Replace the part of the skyline under the new rectangle.
+        updated = [(x, bottom, w)]
+        for sx, sy, length in skyline:
+            end = sx + length
+            if sx < x:
+                updated.append((sx, sy, min(end, x) - sx))
+            if end > x + w:
+                start = max(sx, x + w)
+                updated.append((start, sy, end - start))
+        updated.sort()
+        # Merge neighbours at the same height.
+        skyline = [updated[0]]
+        for sx, sy, length in updated[1:]:
+            px, py, plength = skyline[-1]
+            if py == sy:
+                skyline[-1] = (px, py, plength + length)
+            else:
+                skyline.append((sx, sy, length))
+    height = max([y + sizes[i][1] for i, (x, y) in enumerate(positions)]
+        or [0])
+    return positions, height
+
+def next_power_of_two(value):
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+def pack(sprites, padding=2, max_size=4096):
+    # Chooses a power-of-two atlas size and packs sprites into it.
+    # Returns (width, height, rectangles), rectangles being the (x, y)
+    # of each sprite's top-left texel.
+    sizes = [(pixels.shape[1] + 2*padding, pixels.shape[0] + 2*padding)
+        for name, pixels in sprites]
+    area = sum(w * h for w, h in sizes)
+    width = next_power_of_two(max(
+        [int(area ** 0.5)] + [w for w, h in sizes]))
+    while width <= max_size:
+        positions, height = skyline_pack(sizes, width)
+        if positions is not None:
+            height = next_power_of_two(height)
+            if height <= min(2 * width, max_size):
+                return width, height, [
+                    (x + padding, y + padding) for x, y in positions]
+        width *= 2
+    raise ValueError(
+        "Sprites don't fit in a %dx%d atlas." % (max_size, max_size))
+
+def build(sprites, padding=2, bleed=2, max_size=4096):
+    # The atlas pixels, top row first, and each sprite's (x, y, width,
+    # height) in them.
+    if bleed > padding:
+        raise ValueError("bleed can be at most padding.")
+    width, height, positions = pack(sprites, padding, max_size)
+    pixels = numpy.zeros((height, width, 4), dtype=numpy.uint8)
+    rectangles = []
+    for (name, sprite), (x, y) in zip(sprites, positions):
+        h, w = sprite.shape[:2]
+        pixels[y-bleed:y+h+bleed, x-bleed:x+w+bleed] = numpy.pad(
+            sprite, ((bleed, bleed), (bleed, bleed), (0, 0)), mode='edge')
+        rectangles.append((x, y, w, h))
+    return pixels, rectangles
+
+def save_image(filename, pixels):
+    if filename.endswith(".btex"):
+        # Baked textures are stored bottom row first.
+        levels = texture_assets.mip_chain(
+            numpy.ascontiguousarray(pixels[::-1]))
+        texture_assets.write_texture(filename, levels)
+        return
+    height, width = pixels.shape[:2]
+    surface = pygame.image.fromstring(
+        numpy.ascontiguousarray(pixels).tobytes(), (width, height), "RGBA")
+    pygame.image.save(surface, filename)
+
+def write_atlas(directory, image_filename, manifest_filename=None,
+        padding=2, bleed=2, unit=128, max_size=4096):
+    if manifest_filename is None:
+        manifest_filename = os.path.splitext(image_filename)[0] + ".json"
+    sprites = load_sprites(directory)
+    pixels, rectangles = build(sprites, padding, bleed, max_size)
+    save_image(image_filename, pixels)
+    manifest = {
+        "image": os.path.relpath(
+            image_filename, os.path.dirname(manifest_filename) or "."),
+        "width": pixels.shape[1],
+        "height": pixels.shape[0],
+        "unit": unit,
+        "sprites": [
+            {"name": name, "x": x, "y": y, "width": w, "height": h}
+            for (name, sprite), (x, y, w, h) in zip(sprites, rectangles)],
+        }
+    with open(manifest_filename, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def read_manifest(filename):
+    # The manifest, with "image" made relative to the current directory.
+    with open(filename) as f:
+        manifest = json.load(f)
+    manifest["image"] = os.path.join(
+        os.path.dirname(filename), manifest["image"])
+    return manifest
+
+def sprite_tables(manifest):
+    # (names, texture_coords, atlas_rects, sizes) for a manifest, indexed
+    # by sprite id in manifest order. texture_coords are (n, 4, 2) quad
+    # corners running bottom-left, bottom-right, top-right, top-left;
+    # atlas_rects are (left, bottom, width, height) in texture space; and
+    # sizes are each sprite's width and height in world units.
+    sprites = manifest["sprites"]
+    width = float(manifest["width"])
+    height = float(manifest["height"])
+    rectangles = numpy.array(
+        [(s["x"], s["y"], s["width"], s["height"]) for s in sprites],
+        dtype=numpy.float64).reshape(-1, 4)
+    x, y, w, h = rectangles.T
+    # Textures are uploaded bottom row first, so v runs upwards.
+    left = x / width
+    right = (x + w) / width
+    bottom = (height - y - h) / height
+    top = (height - y) / height
+    texture_coords = numpy.stack([
+        left, bottom, right, bottom, right, top, left, top],
+        axis=1).reshape(-1, 4, 2).astype(numpy.float32)
+    atlas_rects = numpy.stack([left, bottom, right - left, top - bottom],
+        axis=1).astype(numpy.float32)
+    sizes = (rectangles[:, 2:4] / manifest["unit"]).astype(numpy.float32)
+    return [s["name"] for s in sprites], texture_coords, atlas_rects, sizes
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+        "Pack a directory of sprite images into one atlas texture.")
+    parser.add_argument("directory", help="directory of sprite images")
+    parser.add_argument("image",
+        help="atlas image to write (.png, .tga or .btex)")
+    parser.add_argument("--manifest",
+        help="manifest to write (default: the image name ending .json)")
+    parser.add_argument("--padding", type=int, default=2,
+        help="pixels around each sprite (default: %(default)s)")
+    parser.add_argument("--bleed", type=int, default=2,
+        help="padding pixels filled by repeating the sprite's edge "
+             "(default: %(default)s)")
+    parser.add_argument("--unit", type=float, default=128,
+        help="pixels per world unit in the size table "
+             "(default: %(default)s)")
+    parser.add_argument("--max-size", type=int, default=4096,
+        help="largest atlas width or height (default: %(default)s)")
+    args = parser.parse_args(argv)
+    write_atlas(args.directory, args.image, args.manifest,
+        args.padding, args.bleed, args.unit, args.max_size)
+
+if __name__ == '__main__':
+    main()
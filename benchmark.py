@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+
+# Headless benchmark for the bullet simulation.
+#
+# Builds a BulletCollection at several sizes and times each stage of a
+# frame separately, without opening a window or touching the GPU. The
+# results are written as JSON so they can be compared between runs.
+#
+#     python benchmark.py --sizes 1000,10000 --frames 50 --output out.json
+#
+# Each size is run once per vertex layout (separate arrays, interleaved
+# and instanced) and vertex format (float or compact) so they can be
+# compared side by side. The largest size is also stepped with the
+# simulation sharded over each of --threads, and the smallest checks how
+# closely the compact vertex format follows the float one. Bullet
+# emitters are timed separately, firing --spawn-rate bullets a second, as
+# is each bullet behavior channel.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import timeit
+
+import numpy
+
+# bullets imports pygame, whose banner would otherwise end up in the
+# JSON on stdout.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import emitters
+import spatial
+from bullets import (
+    advance_simulation,
+    behavior_channels,
+    escape_radius,
+    make_simulation_state,
+    respawn_dead_bullets,
+    zap_bullets)
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2 has no tracemalloc; allocation figures are reported as null.
+    tracemalloc = None
+
+default_sizes = (1000, 10000, 100000, 1000000)
+
+default_layouts = ('separate', 'interleaved', 'instanced')
+
+default_vertex_formats = ('float', 'compact')
+
+# Largest acceptable difference between the compact vertex format and the
+# float one: world units for positions and sizes, texture space for
+# texture coordinates. Half float positions near the origin are good to
+# about 1/256.
+position_tolerance = 1.0 / 64.0
+texcoord_tolerance = 1.0 / 32768.0
+
+timestep = 1.0 / 60.0
+
+coalesce_gap = 16
+
+def stage_move(state, staging):
+    state.bullet_collection.move_bullets(timestep)
+    state.bullet_collection.rotate_bullets(timestep * 15.0)
+
+def stage_respawn(state, staging):
+    respawn_dead_bullets(state)
+
+def stage_update_positions(state, staging):
+    state.bullet_collection.update_positions()
+
+def stage_buffer_prep(state, staging):
+    # Without a GL context the closest we can get to the upload is the
+    # copy the driver makes out of client memory, done as raw bytes. Like
+    # BatchRenderer, only changed spans of tracked arrays are copied.
+    # Returns the number of bytes sent.
+    uploaded = 0
+    for dest, (data, spans) in zip(
+            staging,
+            state.bullet_collection.upload_spans(coalesce_gap)):
+        if spans is None:
+            spans = [(0, len(data))]
+        for start, stop in spans:
+            span = data[start:stop]
+            offset = start * data.strides[0]
+            dest[offset:offset + span.nbytes] = \
+                span.reshape(-1).view(numpy.uint8)
+            uploaded += span.nbytes
+    return uploaded
+
+# The pre-vectorization kernels, kept so the rewritten ones can be
+# measured against them.
+def legacy_move_bullets(collection, multiplier):
+    count = collection.active_count
+    collection.positions[:count] += collection.velocities[:count] * multiplier
+
+def legacy_update_positions(collection):
+    count = collection.active_count
+    positions = collection.positions[:count]
+    dimensions = collection.dimensions[:count]
+    vertex_positions = collection.vertex_positions[:count]
+    ups = collection.ups[:count]
+    rights = collection.rights[:count]
+    vertex_positions[:,:,:] = positions[:,numpy.newaxis,:]
+    numpy.sin(collection.angles[:count], ups[:,0])
+    numpy.cos(collection.angles[:count], ups[:,1])
+    rights[:,:] = ups[:,::-1]
+    ups[:,0:1] = -1 * dimensions[:,1:2] * ups[:,0:1]
+    ups[:,1:2] = dimensions[:,1:2] * ups[:,1:2]
+    rights[:,:] = rights[:,:] * dimensions[:,0:1]
+    vertex_positions[:,0] -= ups
+    vertex_positions[:,0] -= rights
+    vertex_positions[:,1] -= ups
+    vertex_positions[:,1] += rights
+    vertex_positions[:,3] += ups
+    vertex_positions[:,3] -= rights
+    vertex_positions[:,2] += ups
+    vertex_positions[:,2] += rights
+
+kernels = (
+    ("move", lambda state, staging:
+        legacy_move_bullets(state.bullet_collection, timestep),
+        lambda state, staging:
+        state.bullet_collection.move_bullets(timestep)),
+    ("update_positions", lambda state, staging:
+        legacy_update_positions(state.bullet_collection),
+        stage_update_positions),
+    )
+
+# Stages that must not allocate arrays in a steady-state frame. A couple
+# of kilobytes of Python objects (slice views and the like) are allowed,
+# the same at any size; an array temporary is at least one float per
+# bullet.
+allocation_free_stages = ("move", "update_positions")
+allocation_tolerance = 4096
+
+stages = (
+    ("move", stage_move),
+    ("respawn", stage_respawn),
+    ("update_positions", stage_update_positions),
+    ("buffer_prep", stage_buffer_prep),
+    )
+
+def make_staging(state):
+    return [numpy.empty(array.nbytes, dtype=numpy.uint8)
+        for array in state.bullet_collection.vertex_arrays()]
+
+def measure_allocations(state, staging, function, frames):
+    # Peak bytes allocated above the baseline during one call, the
+    # worst over several frames. Zero means the stage ran entirely in
+    # preallocated memory.
+    if tracemalloc is None or not hasattr(tracemalloc, "reset_peak"):
+        return None
+    tracemalloc.start()
+    try:
+        worst = 0
+        for frame in range(frames):
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            function(state, staging)
+            worst = max(worst, tracemalloc.get_traced_memory()[1] - current)
+        return worst
+    finally:
+        tracemalloc.stop()
+
+def benchmark_size(count, frames, warmup, seed, occupancy, layout,
+        vertex_format='float'):
+    # occupancy < 1 leaves free slots past the live bullets, as in a
+    # sparse wave; the per-bullet figures are per live bullet.
+    capacity = int(count / occupancy)
+    state = make_simulation_state(
+        count, seed=seed, capacity=capacity, layout=layout,
+        vertex_format=vertex_format)
+    staging = make_staging(state)
+    for frame in range(warmup):
+        for name, function in stages:
+            function(state, staging)
+    timings = dict((name, []) for name, function in stages)
+    uploaded = []
+    timer = timeit.default_timer
+    for frame in range(frames):
+        for name, function in stages:
+            start = timer()
+            result = function(state, staging)
+            timings[name].append(timer() - start)
+            if name == "buffer_prep":
+                uploaded.append(result)
+    results = {}
+    for name, function in stages:
+        seconds = numpy.array(timings[name])
+        median = float(numpy.median(seconds))
+        results[name] = {
+            "ms_per_frame": median * 1e3,
+            "ms_per_frame_max": float(seconds.max()) * 1e3,
+            "ns_per_bullet": median * 1e9 / count,
+            "alloc_bytes_per_frame": measure_allocations(
+                state, staging, function, min(frames, 5)),
+            }
+    total = sum(results[name]["ms_per_frame"] for name, function in stages)
+    return {
+        "bullets": count,
+        "capacity": capacity,
+        "layout": layout,
+        "vertex_format": vertex_format,
+        "resident_bytes_per_bullet": sum(
+            array.nbytes for array in state.bullet_collection.vertex_arrays()
+            ) / float(capacity),
+        "uploads_per_frame": len(staging),
+        "upload_bytes_per_frame": float(numpy.mean(uploaded)),
+        "frames": frames,
+        "stages": results,
+        "total_ms_per_frame": total,
+        "total_ns_per_bullet": total * 1e6 / count,
+        }
+
+def benchmark_kernels(count, frames, seed):
+    # Before/after timings for the hot kernels.
+    state = make_simulation_state(count, seed=seed)
+    timer = timeit.default_timer
+    results = {}
+    for name, before, after in kernels:
+        result = {}
+        for label, function in (("before", before), ("after", after)):
+            seconds = []
+            for frame in range(frames):
+                start = timer()
+                function(state, None)
+                seconds.append(timer() - start)
+            median = float(numpy.median(seconds))
+            result[label + "_ms"] = median * 1e3
+            result[label + "_alloc_bytes"] = measure_allocations(
+                state, None, function, min(frames, 5))
+        result["speedup"] = result["before_ms"] / result["after_ms"]
+        results[name] = result
+    return {"bullets": count, "kernels": results}
+
+def benchmark_vertex_formats(count, frames, seed, layouts=default_layouts):
+    # Steps a float and a compact collection side by side from the same
+    # seed and reports how far apart what they'd upload ends up, and how
+    # much less the compact one uploads.
+    results = []
+    for layout in layouts:
+        states = [
+            make_simulation_state(
+                count, seed=seed, layout=layout, vertex_format=vertex_format)
+            for vertex_format in ("float", "compact")]
+        for frame in range(frames):
+            for state in states:
+                advance_simulation(state, timestep)
+        exact, compact = [state.bullet_collection for state in states]
+        live = slice(0, exact.active_count)
+        if layout == 'instanced':
+            position_error = float(numpy.abs(
+                compact.dimensions[live].astype(numpy.float64) -
+                exact.dimensions[live]).max())
+            texcoord_error = float(numpy.abs(
+                compact.atlas_rects[live] / 65535.0 -
+                exact.atlas_rects[live]).max())
+        else:
+            position_error = float(numpy.abs(
+                compact.vertex_positions[live].astype(numpy.float64) +
+                compact.vertex_origin - exact.vertex_positions[live]).max())
+            texcoord_error = float(numpy.abs(
+                compact.texture_coordinates[live] / 65535.0 -
+                exact.texture_coordinates[live]).max())
+        exact_bytes, compact_bytes = [
+            sum(array.nbytes for array in collection.upload_arrays())
+            for collection in (exact, compact)]
+        results.append({
+            "layout": layout,
+            "bullets": exact.active_count,
+            "same_bullets": exact.active_count == compact.active_count,
+            # Sizes for the instanced layout, whose positions stay float.
+            "position_error": position_error,
+            "texcoord_error": texcoord_error,
+            "float_upload_bytes": exact_bytes,
+            "compact_upload_bytes": compact_bytes,
+            "compact_ratio": compact_bytes / float(exact_bytes),
+            })
+    return results
+
+def accuracy_failures(report):
+    return [result for result in report["vertex_formats"]
+        if not result["same_bullets"]
+        or result["position_error"] > position_tolerance
+        or result["texcoord_error"] > texcoord_tolerance]
+
+def allocation_failures(report):
+    # Stages in allocation_free_stages, and behavior channels, that
+    # allocated more than the tolerance in any measured frame.
+    failures = []
+    for result in report["results"]:
+        for name in allocation_free_stages:
+            allocated = result["stages"][name]["alloc_bytes_per_frame"]
+            if allocated is None or allocated > allocation_tolerance:
+                failures.append((result["layout"], result["vertex_format"],
+                    result["bullets"], name, allocated))
+    for result in report["behaviors"]:
+        for name, channel in sorted(result["channels"].items()):
+            allocated = channel["alloc_bytes_per_frame"]
+            if allocated is None or allocated > allocation_tolerance:
+                failures.append(("separate", "float", result["bullets"],
+                    "behavior " + name, allocated))
+    return failures
+
+def benchmark_behaviors(count, frames, seed):
+    # apply_behaviors with no channels, each channel alone and all of
+    # them. Values are picked so that every channel does real work but no
+    # bullet's lifetime runs out.
+    values = {
+        'angular_velocity': 2.0,
+        'acceleration': (0.0, -1.0),
+        'drag': 0.5,
+        'max_speed': 3.0,
+        'lifetime': 1e9,
+        'homing': 1.0,
+        }
+    names = sorted(behavior_channels)
+    configurations = [("none", [])] + [(name, [name]) for name in names] + \
+        [("all", names)]
+    timer = timeit.default_timer
+    results = {}
+    for label, channels in configurations:
+        state = make_simulation_state(count, seed=seed)
+        collection = state.bullet_collection
+        collection.set_behaviors(slice(0, count),
+            **dict((name, values[name]) for name in channels))
+        function = lambda state, staging: \
+            state.bullet_collection.apply_behaviors(timestep)
+        seconds = []
+        for frame in range(frames):
+            start = timer()
+            function(state, None)
+            seconds.append(timer() - start)
+        median = float(numpy.median(seconds))
+        results[label] = {
+            "ms_per_frame": median * 1e3,
+            "ns_per_bullet": median * 1e9 / count,
+            "alloc_bytes_per_frame": measure_allocations(
+                state, None, function, min(frames, 5)),
+            }
+    return {"bullets": count, "channels": results}
+
+def benchmark_respawn(count, frames, seed, layouts=default_layouts):
+    # Cost of respawning count bullets in one go, as after a big wave
+    # leaves the play area, and of respawning a scattered fifth of them,
+    # as bullets escaping one by one do. A whole wave is one contiguous
+    # run, which set_bullets writes with slices. Neither gets near
+    # microseconds for 10k bullets: each respawn still draws three random
+    # numbers and writes around a hundred bytes of arrays, so expect
+    # tenths of a millisecond, interleaved being the slowest.
+    timer = timeit.default_timer
+    rng = numpy.random.RandomState(seed)
+    cases = [
+        ("wave", numpy.arange(count)),
+        ("scattered", numpy.sort(
+            rng.choice(count, count // 5, replace=False)))]
+    results = {}
+    for layout in layouts:
+        state = make_simulation_state(count, seed=seed, layout=layout)
+        result = results[layout] = {}
+        for name, indices in cases:
+            seconds = []
+            for frame in range(frames):
+                start = timer()
+                zap_bullets(state, indices)
+                seconds.append(timer() - start)
+            median = float(numpy.median(seconds))
+            result[name] = {
+                "bullets": len(indices),
+                "ms_per_call": median * 1e3,
+                "ns_per_bullet": median * 1e9 / len(indices),
+                }
+    return {"bullets": count, "layouts": results}
+
+def benchmark_spatial(count, frames, seed, queries=64):
+    # Grid rebuild plus one batch of circle queries (a hitbox and a few
+    # dozen shields) against testing every bullet for every circle. The
+    # hits, and those of a batch of box queries, must be exactly the ones
+    # the brute force tests find.
+    state = make_simulation_state(count, seed=seed)
+    collection = state.bullet_collection
+    rng = numpy.random.RandomState(seed)
+    centers = rng.uniform(-10.0, 10.0, (queries,2))
+    radii = rng.uniform(0.1, 1.0, queries)
+    corners = rng.uniform(-10.0, 10.0, (queries,2))
+    boxes = numpy.hstack(
+        (corners, corners + rng.uniform(0.1, 2.0, (queries,2))))
+    grid = spatial.UniformGrid(1.0)
+    timer = timeit.default_timer
+    build, query, brute = [], [], []
+    for frame in range(frames):
+        start = timer()
+        grid.build_from_collection(collection)
+        build.append(timer() - start)
+        start = timer()
+        hits = grid.query_circles(centers, radii)
+        query.append(timer() - start)
+    for frame in range(max(1, frames // 10)):
+        start = timer()
+        expected = spatial.brute_force_circles(
+            collection.positions[:count],
+            spatial.bullet_radii(collection),
+            centers, radii)
+        brute.append(timer() - start)
+    box_hits = grid.query_boxes(boxes)
+    expected_box_hits = spatial.brute_force_boxes(
+        collection.positions[:count], spatial.bullet_radii(collection), boxes)
+    grid_ms = (numpy.median(build) + numpy.median(query)) * 1e3
+    return {
+        "bullets": count,
+        "queries": queries,
+        "hits": len(hits[0]),
+        "hits_match_brute_force": bool(numpy.array_equal(
+            spatial.sorted_hits(hits), spatial.sorted_hits(expected))),
+        "box_hits": len(box_hits[0]),
+        "box_hits_match_brute_force": bool(numpy.array_equal(
+            spatial.sorted_hits(box_hits),
+            spatial.sorted_hits(expected_box_hits))),
+        "build_ms": float(numpy.median(build)) * 1e3,
+        "build_ns_per_bullet": float(numpy.median(build)) * 1e9 / count,
+        "query_ms": float(numpy.median(query)) * 1e3,
+        "grid_total_ms": float(grid_ms),
+        "brute_force_ms": float(numpy.median(brute)) * 1e3,
+        }
+
+def benchmark_emitters(spawn_rate, frames, warmup, seed, per_pattern=8):
+    # A field fed by per_pattern emitters of each pattern, firing
+    # spawn_rate bullets a second between them, with bullets removed once
+    # they escape. Times the emitters' step on its own.
+    rng = numpy.random.RandomState(seed)
+    patterns = sorted(emitters.pattern_defaults)
+    bullet_emitters = []
+    for pattern in patterns:
+        for i in range(per_pattern):
+            emitter = emitters.Emitter(pattern,
+                position=tuple(rng.uniform(-5.0, 5.0, 2)),
+                angle=rng.uniform(0.0, 2.0 * numpy.pi),
+                phase=rng.uniform(0.0, 0.5),
+                speed=[(0.0, 2.0), (1.0, 6.0)],
+                speed_spread=0.25)
+            emitter.rate = spawn_rate / float(
+                emitter.count * per_pattern * len(patterns))
+            bullet_emitters.append(emitter)
+    state = make_simulation_state(
+        0, seed=seed, capacity=int(spawn_rate * 4) + 1,
+        layout='instanced')
+    state.emitters = emitters.EmitterSet(bullet_emitters, state.rng)
+    collection = state.bullet_collection
+    timer = timeit.default_timer
+    seconds = []
+    spawned = []
+    for frame in range(warmup + frames):
+        collection.move_bullets(timestep)
+        collection.eliminate_bullets(collection.bullets_beyond(escape_radius))
+        start = timer()
+        indices = state.emitters.emit(collection, timestep)
+        if frame >= warmup:
+            seconds.append(timer() - start)
+            spawned.append(len(indices))
+    seconds = numpy.array(seconds)
+    total = float(numpy.sum(spawned))
+    return {
+        "emitters": len(bullet_emitters),
+        "spawn_rate": spawn_rate,
+        "spawns_per_frame": total / frames,
+        "live_bullets": int(collection.active_count),
+        "dropped": int(state.emitters.dropped),
+        "ms_per_frame": float(numpy.median(seconds)) * 1e3,
+        "ms_per_frame_p99": float(numpy.percentile(seconds, 99)) * 1e3,
+        "ns_per_spawn": float(seconds.sum()) * 1e9 / max(total, 1.0),
+        # Bullets the emitters could fire per second of CPU time.
+        "spawns_per_cpu_second": total / float(seconds.sum()),
+        }
+
+def benchmark_threads(count, frames, warmup, seed, thread_counts):
+    # Whole simulation steps at one size with the kernels sharded over
+    # each number of threads. Every run starts from the same seed, so the
+    # final positions should agree exactly with the single-threaded run.
+    # Speedups only mean something with as many cores as threads, and
+    # below ShardedSimulation's crossover a run uses fewer shards than
+    # threads; "cpus" and "shards" say how it went.
+    timer = timeit.default_timer
+    results = []
+    reference = None
+    for threads in thread_counts:
+        state = make_simulation_state(count, seed=seed, threads=threads)
+        for frame in range(warmup):
+            advance_simulation(state, timestep)
+        seconds = []
+        for frame in range(frames):
+            start = timer()
+            advance_simulation(state, timestep)
+            seconds.append(timer() - start)
+        shards = 1
+        if state.simulation is not None:
+            shards = len(state.simulation.shards(count))
+            state.simulation.close()
+        positions = state.bullet_collection.positions[:count].copy()
+        if reference is None:
+            reference = positions
+        median = float(numpy.median(seconds))
+        results.append({
+            "threads": threads,
+            "shards": shards,
+            "ms_per_frame": median * 1e3,
+            "ns_per_bullet": median * 1e9 / count,
+            "matches_first": bool(numpy.array_equal(positions, reference)),
+            })
+    first = results[0]["ms_per_frame"]
+    for result in results:
+        result["speedup"] = first / result["ms_per_frame"]
+    return {"bullets": count, "cpus": multiprocessing.cpu_count(),
+        "runs": results}
+
+def run(sizes, frames, warmup, seed, occupancy=1.0,
+        layouts=default_layouts, thread_counts=(1,),
+        vertex_formats=default_vertex_formats, spawn_rate=60000):
+    return {
+        "respawn": benchmark_respawn(10000, frames, seed, layouts),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "timestep": timestep,
+        "results": [
+            benchmark_size(
+                count, frames, warmup, seed, occupancy, layout, vertex_format)
+            for count in sizes
+            for layout in layouts
+            for vertex_format in vertex_formats],
+        "vertex_formats": benchmark_vertex_formats(
+            min(sizes), frames, seed, layouts),
+        "spatial": [benchmark_spatial(count, frames, seed)
+            for count in sizes],
+        "kernels": [benchmark_kernels(count, frames, seed)
+            for count in sizes],
+        "behaviors": [benchmark_behaviors(count, frames, seed)
+            for count in sizes],
+        "threads": benchmark_threads(
+            max(sizes), frames, warmup, seed, thread_counts),
+        "emitters": benchmark_emitters(spawn_rate, frames, warmup, seed),
+        }
+
+def parse_sizes(text):
+    return [int(size) for size in text.split(",") if size]
+
+def parse_threads(text):
+    return [int(threads) for threads in text.split(",") if threads]
+
+def parse_layouts(text):
+    return [layout for layout in text.split(",") if layout]
+
+def parse_vertex_formats(text):
+    return [vertex_format for vertex_format in text.split(",")
+        if vertex_format]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+        "Time the stages of a bullet simulation frame without a display.")
+    parser.add_argument("--sizes", type=parse_sizes,
+        default=list(default_sizes),
+        help="comma separated bullet counts (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=50,
+        help="timed frames per size (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=5,
+        help="untimed frames before measuring (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1,
+        help="seed for the bullet layout (default: %(default)s)")
+    parser.add_argument("--occupancy", type=float, default=1.0,
+        help="fraction of the collection's capacity that is live "
+             "(default: %(default)s)")
+    parser.add_argument("--layouts", type=parse_layouts,
+        default=list(default_layouts),
+        help="comma separated vertex layouts (default: %(default)s)")
+    parser.add_argument("--vertex-formats", type=parse_vertex_formats,
+        default=list(default_vertex_formats),
+        help="comma separated vertex formats (default: %(default)s)")
+    parser.add_argument("--threads", type=parse_threads,
+        default=[1, 2, 4, 8, 16],
+        help="comma separated thread counts to step the largest size "
+             "with (default: %(default)s)")
+    parser.add_argument("--spawn-rate", type=float, default=60000,
+        help="bullets a second fired by the emitter benchmark "
+             "(default: %(default)s)")
+    parser.add_argument("--check-allocations", action="store_true",
+        help="fail unless the move and update_positions stages run "
+             "without allocating (needs tracemalloc, Python 3.9+)")
+    parser.add_argument("--check-accuracy", action="store_true",
+        help="fail unless the compact vertex format stays within "
+             "tolerance of the float one")
+    parser.add_argument("--output",
+        help="write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.check_allocations and (
+            tracemalloc is None or not hasattr(tracemalloc, "reset_peak")):
+        parser.error("--check-allocations needs tracemalloc (Python 3.9+)")
+    report = run(
+        args.sizes, args.frames, args.warmup, args.seed, args.occupancy,
+        args.layouts, args.threads, args.vertex_formats, args.spawn_rate)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    if args.check_allocations:
+        failures = allocation_failures(report)
+        for layout, vertex_format, count, name, allocated in failures:
+            sys.stderr.write(
+                "%s stage allocated %s bytes per frame "
+                "(%s layout, %s vertices, %d bullets)\n" % (
+                    name, allocated, layout, vertex_format, count))
+        if failures:
+            sys.exit(1)
+    if args.check_accuracy:
+        failures = accuracy_failures(report)
+        for result in failures:
+            sys.stderr.write(
+                "compact vertices are off by %g in position and %g in "
+                "texture coordinates (%s layout)\n" % (
+                    result["position_error"], result["texcoord_error"],
+                    result["layout"]))
+        if failures:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -9,88 +9,109 @@ import pygame, pygame.image, pygame.key
 from pygame.locals import *
 import numpy
 import math
-from random import Random
+import os
+import multiprocessing
+import threading
+import timeit
+import collections
+import argparse
+from multiprocessing.pool import ThreadPool
+import atlas
+import emitters
+from profiler import FrameProfiler
+from recording import Recorder
 from ogl_helpers import (
     make_buffer,
-    short_element_buffer,
     float_array,
     short_array,
     translation_matrix,
     make_texture,
     make_shader,
     show_info_log,
-    make_program)
-
-def render_bullets(resources, state):
-    bullet_collection = state.bullet_collection
-    bullet_buffers = state.bullet_buffers
-    prog = resources.bullet_program.program
-    unis = resources.bullet_program.uniforms
-    atts = resources.bullet_program.attributes
-    glUseProgram(prog)
-    glUniform2f(unis.focal_point, 0,0)
-    glUniform2f(unis.zoom, 0.1 / resources.aspect_ratio, 0.1)
-    glActiveTexture(GL_TEXTURE0)
-    glBindTexture(GL_TEXTURE_2D, resources.textures[2])
-    glUniform1i(unis.tex, 0)
-
-    glBindBuffer(GL_ARRAY_BUFFER, bullet_buffers.position_buffer)
-    glVertexAttribPointer(
-        atts.position,
-        2,
-        GL_FLOAT,
-        GL_FALSE,
-        ctypes.sizeof(GLfloat)*2,
-        None)
-    glEnableVertexAttribArray(atts.position)
-
-    glBindBuffer(GL_ARRAY_BUFFER, bullet_buffers.texcoord_buffer)
-    glVertexAttribPointer(
-        atts.texcoord,
-        2,
-        GL_FLOAT,
-        GL_FALSE,
-        ctypes.sizeof(GLfloat)*2,
-        None)
-    glEnableVertexAttribArray(atts.texcoord)
-
-    if not hasattr(state, "first"):
-        state.first = True
-        print bullet_collection.vertex_colors
-
-    glBindBuffer(GL_ARRAY_BUFFER, bullet_buffers.color_buffer)
-    glVertexAttribPointer(
-        atts.color,
-        4,
-        GL_UNSIGNED_BYTE,
-        GL_TRUE,
-        ctypes.sizeof(GLubyte)*4,
-        None)
-    glEnableVertexAttribArray(atts.color)
-
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, bullet_buffers.element_buffer)
-    
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
-    
-    glDrawElements(
-        GL_TRIANGLES,
-        bullet_collection.count*6,
-        GL_UNSIGNED_SHORT,
-        None)
+    make_program,
+    vertex_attribute_pointers,
+    StreamingBuffer,
+    DynamicBuffer,
+    DirtyRanges,
+    instancing_supported,
+    transform_feedback_supported,
+    make_feedback_program,
+    shared_quad_corners,
+    shared_quad_indices,
+    shared_program_cache,
+    TextureLoader,
+    gl_state,
+    VertexArray)
 
-    glDisable(GL_BLEND)
-    
-    glDisableVertexAttribArray(bullet_buffers.position_buffer)
-    glDisableVertexAttribArray(bullet_buffers.texcoord_buffer)
-    glDisableVertexAttribArray(bullet_buffers.color_buffer)
+def view_transform(resources):
+    # The focal_point and zoom uniforms: what the middle of the window
+    # looks at, and the scale from world units to clip space.
+    zoom = resources.zoom
+    return resources.focal_point, (zoom / resources.aspect_ratio, zoom)
+
+def visible_extent(resources):
+    # The world space box the window shows, as its center and half its
+    # width and height.
+    focal_point, zoom = view_transform(resources)
+    return focal_point, (1.0 / zoom[0], 1.0 / zoom[1])
+
+def bullet_program(resources, layout):
+    if layout == 'instanced':
+        return resources.instanced_bullet_program
+    return resources.bullet_program
+
+def bind_sprite_attributes(vertex_array, program, layout, attribute_pointers,
+        corner_buffer=None, quad_indices=None):
+    # Points the program's attributes at the sprite data in
+    # attribute_pointers, (buffer, attribute name, size, type, normalized,
+    # stride, offset) tuples, recording the setup in vertex_array.
+    atts = program.attributes
+    instanced = layout == 'instanced'
+    vertex_array.bind()
+    for (buffer, name, size, type, normalized, stride, offset
+            ) in attribute_pointers:
+        vertex_array.attribute(
+            getattr(atts, name),
+            buffer,
+            size,
+            type,
+            normalized,
+            stride,
+            offset,
+            1 if instanced else 0)
+    if instanced:
+        vertex_array.attribute(
+            atts.corner,
+            corner_buffer,
+            2,
+            GL_FLOAT,
+            GL_FALSE,
+            ctypes.sizeof(GLfloat)*2,
+            0)
+    else:
+        vertex_array.element_buffer(quad_indices.buffer)
+
+def draw_sprites(layout, count, quad_indices=None):
+    if layout == 'instanced':
+        glDrawArraysInstanced(
+            GL_TRIANGLE_FAN,
+            0,
+            4,
+            count)
+    else:
+        glDrawElements(
+            GL_TRIANGLES,
+            count*6,
+            quad_indices.type,
+            None)
 
 def render(resources, state):
     #glClearColor(0.1, 0.1, 0.1, 1.0)
     glClearColor(0,0,0,1.0)
     glClear(GL_COLOR_BUFFER_BIT)
-    render_bullets(resources, state)
-    pygame.display.flip()
+    state.renderer.draw(resources)
+    if isinstance(state.simulation, GPUSimulation):
+        state.simulation.draw(resources)
 
 vertex_buffer_data = float_array(
     -1.0, -1.0, 0.0, 1.0,
@@ -131,6 +152,39 @@ void main()
 }
 '''
 
+# Expands each bullet's quad from one per-bullet record. corner runs
+# (-1,-1), (1,-1), (1,1), (-1,1) and is the only per-vertex attribute;
+# everything else advances once per instance. Matches the corner maths
+# in BulletCollection.update_positions.
+instanced_bullet_vertex_shader = '''\
+#version 110
+
+uniform vec2 focal_point;
+uniform vec2 zoom;
+
+attribute vec2 corner;
+attribute vec2 center;
+attribute float angle;
+attribute vec2 size;
+attribute vec4 atlas_rect;
+attribute vec4 color;
+
+varying vec2 var_texcoord;
+varying vec4 var_color;
+
+void main()
+{
+    vec2 up = vec2(-sin(angle), cos(angle)) * size.y;
+    vec2 right = vec2(cos(angle), sin(angle)) * size.x;
+    vec2 position = center + corner.x * right + corner.y * up;
+    gl_Position.xy = (position - focal_point) * zoom;
+    gl_Position.z = 0.0;
+    gl_Position.w = 1.0;
+    var_texcoord = atlas_rect.xy + (corner * 0.5 + 0.5) * atlas_rect.zw;
+    var_color = color;
+}
+'''
+
 bullet_fragment_shader = '''\
 #version 130
 
@@ -165,6 +219,16 @@ bullet_texture_coords = {
     'test':      tex_coords(0.50, 0.25, 0.25, 0.25),
     }
 
+def atlas_rect(coords):
+    # (left, bottom, width, height) of a quad given as tex_coords corners.
+    left, bottom = coords[0:2]
+    right, top = coords[4:6]
+    return (left, bottom, right-left, top-bottom)
+
+bullet_atlas_rects = dict(
+    (name, atlas_rect(coords))
+    for name, coords in bullet_texture_coords.items())
+
 bullet_sizes = {
     'triangle':  (1,1),
     'dart':      (1,1),
@@ -177,86 +241,912 @@ bullet_sizes = {
     'test':      (1,1),
     }
 
+# One vertex of the interleaved layout: everything a corner needs in a
+# single record, so the whole collection uploads from one array.
+interleaved_vertex_dtype = numpy.dtype([
+    ('position', GLfloat, 2),
+    ('texcoord', GLfloat, 2),
+    ('color', GLubyte, 4)])
+
+# One bullet of the instanced layout. The vertex shader builds the quad,
+# so there are no per-vertex arrays at all.
+instanced_bullet_dtype = numpy.dtype([
+    ('center', GLfloat, 2),
+    ('angle', GLfloat),
+    ('size', GLfloat, 2),
+    ('atlas_rect', GLfloat, 4),
+    ('color', GLubyte, 4)])
+
+# The "compact" vertex format: corner positions as half floats, relative
+# to the collection's vertex_origin, and texture coordinates as 16-bit
+# normalized integers, 12 bytes a vertex rather than 20. Instanced
+# bullets keep float centers and angles, which the simulation steps in
+# place, but get half float sizes and 16-bit atlas rectangles.
+compact_interleaved_vertex_dtype = numpy.dtype([
+    ('position', numpy.float16, 2),
+    ('texcoord', GLushort, 2),
+    ('color', GLubyte, 4)])
+
+compact_instanced_bullet_dtype = numpy.dtype([
+    ('center', GLfloat, 2),
+    ('angle', GLfloat),
+    ('size', numpy.float16, 2),
+    ('atlas_rect', GLushort, 4),
+    ('color', GLubyte, 4)])
+
+vertex_formats = ('float', 'compact')
+
+def unorm16(values):
+    # [0, 1] as normalized GLushorts.
+    return numpy.round(
+        numpy.clip(values, 0.0, 1.0) * 65535.0).astype(GLushort)
+
+class SpriteTables(object):
+    # The sprites a BulletCollection draws its bullets with: the same data
+    # as the dictionaries above as arrays indexed by sprite id, so batches
+    # of bullets can look up their sprites with one fancy index. Sprite
+    # ids index names.
+    def __init__(self, names, texture_coords, atlas_rects, sizes):
+        self.names = list(names)
+        self.ids = dict((name, i) for i, name in enumerate(self.names))
+        self.texture_coords = numpy.asarray(
+            texture_coords, dtype=GLfloat).reshape(-1,4,2)
+        self.atlas_rects = numpy.asarray(
+            atlas_rects, dtype=GLfloat).reshape(-1,4)
+        self.sizes = numpy.asarray(sizes, dtype=GLfloat).reshape(-1,2)
+        # For the compact vertex format.
+        self.texture_coords_unorm = unorm16(self.texture_coords)
+        self.atlas_rects_unorm = unorm16(self.atlas_rects)
+    def check_names(self, names, source):
+        # Raises ValueError unless there are sprites with all of names;
+        # source says where the tables came from.
+        missing = sorted(set(names) - set(self.ids))
+        if missing:
+            raise ValueError("%s has no sprites named %s." % (
+                source, ", ".join(missing)))
+
+# The hand-made sheet, with ids assigned in name order.
+default_sprite_tables = SpriteTables(
+    sorted(bullet_sizes),
+    [bullet_texture_coords[name] for name in sorted(bullet_sizes)],
+    [bullet_atlas_rects[name] for name in sorted(bullet_sizes)],
+    [bullet_sizes[name] for name in sorted(bullet_sizes)])
+
+# Sprites the demo asks for by name, in zap_bullets and demo_emitters.
+# Any other tables it's given have to have these too.
+demo_sprite_names = ('circle', 'dart', 'dot', 'lozenge', 'oval', 'triangle')
+
+# Optional per-bullet behaviors, see BulletCollection.set_behaviors: each
+# channel's shape per bullet and the value that leaves a bullet alone.
+#
+#     angular_velocity  radians per second the sprite spins, in place of
+#                       spin_rate
+#     acceleration      (x, y) added to the velocity per second
+#     drag              fraction of speed lost per second, exponentially
+#     max_speed         speed cap
+#     lifetime          seconds left before the bullet dies
+#     homing            radians per second the velocity may turn toward
+#                       homing_target; the sprite turns with it
+behavior_channels = {
+    'angular_velocity': ((), 0.0),
+    'acceleration': ((2,), 0.0),
+    'drag': ((), 0.0),
+    # Not inf, which would make the scaling in apply_behaviors inf/inf.
+    'max_speed': ((), float(numpy.finfo(GLfloat).max)),
+    'lifetime': ((), numpy.inf),
+    'homing': ((), 0.0),
+    }
+
+# Written by atlas.py. When it's there, the bullets are drawn from it
+# instead of the hand-made sheet.
+bullet_atlas_manifest = "bullet_atlas.json"
+
+def packed_field(records, name):
+    # The 4-byte field name of a record array as one GLuint per record,
+    # so RGBA colors can be written a word at a time.
+    dtype = records.dtype
+    return records.view(numpy.dtype({
+        'names': [name],
+        'formats': [GLuint],
+        'offsets': [dtype.fields[name][1]],
+        'itemsize': dtype.itemsize}))[name]
+
+def packed_colors(color):
+    # One RGBA color, or an array of them, as packed_field GLuints.
+    return numpy.ascontiguousarray(color, dtype=GLubyte).view(GLuint)[...,0]
+
+def contiguous_slice(indices):
+    # The slice equivalent to indices, a 1-d array, if they run up one at
+    # a time with no gaps, as when a whole wave respawns; otherwise None.
+    # Slices write several times faster than the same indices scattered.
+    if indices.ndim != 1 or not len(indices):
+        return None
+    start = int(indices[0])
+    stop = start + len(indices)
+    if int(indices[-1]) != stop - 1 or \
+            not (numpy.diff(indices) == 1).all():
+        return None
+    return slice(start, stop)
+
 class BulletCollection(object):
-    def __init__(self, num):
-        self.count = num
-        self.positions = numpy.empty(shape=(num,2), dtype=GLfloat)
-        self.positions[:,:] = 0
-        self.angles = numpy.zeros(shape=(num), dtype=GLfloat)
-        self.dimensions = numpy.zeros(shape=(num,2), dtype=GLfloat)
-        self.vertex_positions = numpy.zeros(shape=(num,8), dtype=GLfloat)
-        self.texture_coordinates = numpy.zeros(shape=(num,8), dtype=GLfloat)
-        self.vertex_colors = numpy.zeros(shape=(num,16), dtype=GLubyte)
+    # Live bullets are kept packed at the front of the arrays: indices
+    # below active_count are live, everything from there up to capacity
+    # is free. Every stage only looks at the live range.
+    #
+    # Per-vertex data is indexed [bullet, corner, component], corners
+    # running bottom-left, bottom-right, top-right, top-left. With the
+    # "separate" layout each attribute has its own array; with
+    # "interleaved" they are views onto the fields of one record array,
+    # self.vertices.
+    #
+    # The "instanced" layout has no per-vertex data. positions, angles
+    # and dimensions are views onto self.instances, one record per bullet
+    # alongside its atlas rectangle and color, and the quad is expanded
+    # on the GPU.
+    #
+    # vertex_format is one of vertex_formats, choosing the types of the
+    # arrays that are uploaded. Corner positions are stored relative to
+    # vertex_origin; see set_vertex_origin.
+    #
+    # sprite_tables, default_sprite_tables unless given, has the sizes
+    # and texture coordinates of the sprite ids bullets are spawned with.
+    # Bullets keep what they were spawned with, so set it before spawning
+    # any.
+    #
+    # Behavior channels are extra per-bullet arrays in self.behaviors,
+    # keyed by the names in behavior_channels. They only exist once
+    # enabled, and apply_behaviors skips the ones that don't, so a
+    # collection that uses none pays nothing for them.
+    attribute_names = ('position', 'texcoord', 'color')
+    def __init__(self, num, layout='separate', vertex_format='float',
+            sprite_tables=None, track_changes=True):
+        self.layout = layout
+        self.vertex_format = vertex_format
+        self.sprite_tables = default_sprite_tables if sprite_tables is None \
+            else sprite_tables
+        self.capacity = num
+        self.active_count = 0
+        self.vertex_origin = (0.0, 0.0)
+        self.behaviors = {}
+        # Where bullets with the homing behavior steer toward.
+        self.homing_target = (0.0, 0.0)
+        if layout not in ('separate', 'interleaved', 'instanced'):
+            raise ValueError("Unknown bullet layout %r." % (layout,))
+        if vertex_format not in vertex_formats:
+            raise ValueError("Unknown vertex format %r." % (vertex_format,))
+        compact = vertex_format == 'compact'
+        if layout == 'instanced':
+            self.instances = numpy.zeros(
+                shape=(num,),
+                dtype=compact_instanced_bullet_dtype if compact else
+                    instanced_bullet_dtype)
+            self.positions = self.instances['center']
+            self.angles = self.instances['angle']
+            self.dimensions = self.instances['size']
+            self.atlas_rects = self.instances['atlas_rect']
+            self.colors = self.instances['color']
+            self.packed_colors = packed_field(self.instances, 'color')
+        else:
+            self.positions = numpy.empty(shape=(num,2), dtype=GLfloat)
+            self.positions[:,:] = 0
+            self.angles = numpy.zeros(shape=(num), dtype=GLfloat)
+            self.dimensions = numpy.zeros(shape=(num,2), dtype=GLfloat)
+        if layout == 'interleaved':
+            self.vertices = numpy.zeros(
+                shape=(num,4),
+                dtype=compact_interleaved_vertex_dtype if compact else
+                    interleaved_vertex_dtype)
+            self.vertex_positions = self.vertices['position']
+            self.texture_coordinates = self.vertices['texcoord']
+            self.vertex_colors = self.vertices['color']
+            self.packed_colors = packed_field(self.vertices, 'color')
+        elif layout == 'separate':
+            self.vertex_positions = numpy.zeros(
+                shape=(num,4,2), dtype=numpy.float16 if compact else GLfloat)
+            self.texture_coordinates = numpy.zeros(
+                shape=(num,4,2), dtype=GLushort if compact else GLfloat)
+            self.vertex_colors = numpy.zeros(shape=(num,4,4), dtype=GLubyte)
+            self.packed_colors = self.vertex_colors.view(GLuint)[...,0]
+        # Texture coordinates and colors only change in set_bullet (and
+        # when bullets are moved by eliminate_bullets), so with separate
+        # arrays we note which bullets changed and upload just those.
+        # Positions change every frame and always go up in full. Without
+        # track_changes, for collections that are never drawn, nothing is
+        # noted.
+        self.dirty_ranges = {}
+        if layout == 'separate' and track_changes:
+            self.dirty_ranges['texcoord'] = DirtyRanges()
+            self.dirty_ranges['color'] = DirtyRanges()
+        # Scratch space for the per-frame kernels, so that a steady-state
+        # frame allocates no arrays.
         self.ups = numpy.zeros(shape=(num,2), dtype=GLfloat)
         self.rights = numpy.zeros(shape=(num,2), dtype=GLfloat)
+        self.sincos = numpy.zeros(shape=(num,2), dtype=GLfloat)
+        self.steps = numpy.zeros(shape=(num,2), dtype=GLfloat)
+        self.distances = numpy.zeros(shape=(num,), dtype=GLfloat)
+        self.flags = numpy.zeros(shape=(num,), dtype=bool)
         self.velocities = numpy.zeros(shape=(num,2), dtype=GLfloat)
+    def bullet_arrays(self, behaviors=True):
+        # Every array holding per-bullet state, i.e. everything that has
+        # to move when a bullet changes slot. ups and rights are scratch.
+        if behaviors:
+            extra = tuple(
+                self.behaviors[name] for name in sorted(self.behaviors))
+        else:
+            extra = ()
+        if self.layout == 'instanced':
+            return (self.velocities, self.instances) + extra
+        return (
+            self.positions,
+            self.angles,
+            self.dimensions,
+            self.velocities) + self.vertex_arrays() + extra
+    def vertex_arrays(self):
+        if self.layout == 'instanced':
+            return (self.instances,)
+        if self.layout == 'interleaved':
+            return (self.vertices,)
+        return (
+            self.vertex_positions,
+            self.texture_coordinates,
+            self.vertex_colors)
     def set_bullet(self, index, x, y, w, h, angle, vx, vy, texture_id, color):
-        self.positions[index,:] = x, y
-        self.angles[index] = angle
-        bw, bh = bullet_sizes[texture_id]
-        self.dimensions[index,:] = w*bw, h*bh
-        self.velocities[index,:] = vx, vy
-        self.texture_coordinates[index,:] = bullet_texture_coords[texture_id]
-        self.vertex_colors[index,0:4] = color
-        self.vertex_colors[index,4:8] = color
-        self.vertex_colors[index,8:12] = color
-        self.vertex_colors[index,12:16] = color
+        self.set_bullets(
+            index, x, y, w, h, angle, vx, vy,
+            self.sprite_tables.ids[texture_id], color)
+    def set_bullets(self, indices, x, y, w, h, angle, vx, vy, sprite_id, color):
+        # Writes the bullets at indices. Every argument is a scalar or an
+        # array with one entry per index; color is one RGBA value or one
+        # per index. sprite_id indexes self.sprite_tables.
+        self.positions[indices,0] = x
+        self.positions[indices,1] = y
+        self.angles[indices] = angle
+        sprites = self.sprite_tables
+        sizes = sprites.sizes[sprite_id]
+        self.dimensions[indices,0] = w * sizes[...,0]
+        self.dimensions[indices,1] = h * sizes[...,1]
+        self.velocities[indices,0] = vx
+        self.velocities[indices,1] = vy
+        # New bullets start out with no behaviors.
+        for name, array in self.behaviors.items():
+            array[indices] = behavior_channels[name][1]
+        compact = self.vertex_format == 'compact'
+        if self.layout == 'instanced':
+            self.atlas_rects[indices] = (
+                sprites.atlas_rects_unorm if compact else
+                sprites.atlas_rects)[sprite_id]
+            self.packed_colors[indices] = packed_colors(color)
+            return
+        self.texture_coordinates[indices] = (
+            sprites.texture_coords_unorm if compact else
+            sprites.texture_coords)[sprite_id]
+        self.packed_colors[indices] = \
+            packed_colors(color)[...,numpy.newaxis]
+        self.mark_dirty(indices)
+    def mark_dirty(self, indices):
+        for dirty in self.dirty_ranges.values():
+            dirty.mark_indices(indices)
+    def forget_changes(self):
+        # For collections whose changes reach the GPU some other way, or
+        # not at all.
+        for dirty in self.dirty_ranges.values():
+            dirty.clear()
+    def copy_bullets(self, source, indices=None):
+        # Makes the bullets at indices the same as in source, a collection
+        # with the same layout and capacity. With indices None, every live
+        # bullet is copied and active_count comes across too. Only the
+        # behaviors enabled in both are copied.
+        if indices is None:
+            self.active_count = source.active_count
+            indices = slice(0, source.active_count)
+        pairs = list(zip(
+            self.bullet_arrays(False), source.bullet_arrays(False)))
+        pairs.extend(
+            (array, source.behaviors[name])
+            for name, array in self.behaviors.items()
+            if name in source.behaviors)
+        for mine, theirs in pairs:
+            mine[indices] = theirs[indices]
+        self.mark_dirty(indices)
+    def enable_behaviors(self, *names):
+        # Allocates the named channels, every bullet starting with the
+        # value that leaves it alone.
+        for name in names:
+            if name not in behavior_channels:
+                raise ValueError("Unknown bullet behavior %r." % (name,))
+            if name not in self.behaviors:
+                shape, neutral = behavior_channels[name]
+                self.behaviors[name] = numpy.full(
+                    (self.capacity,) + shape, neutral, dtype=GLfloat)
+    def disable_behaviors(self, *names):
+        for name in names:
+            self.behaviors.pop(name, None)
+    def set_behaviors(self, indices, **channels):
+        # Sets behavior channels of the bullets at indices, enabling them
+        # as needed, e.g. set_behaviors(indices, drag=0.5, lifetime=3.0).
+        # Values are scalars or one per index, acceleration being (x, y)
+        # pairs. set_bullets resets every channel, so set these after.
+        self.enable_behaviors(*channels)
+        for name, values in channels.items():
+            self.behaviors[name][indices] = values
+    def spawn_bullet(self, x, y, w, h, angle, vx, vy, texture_id, color):
+        # Takes the first free slot and returns its index.
+        return self.spawn_many(
+            None, x, y, w, h, angle, vx, vy,
+            self.sprite_tables.ids[texture_id], color)[0]
+    def spawn_many(self, indices, x, y, w, h, angle, vx, vy, sprite_id, color):
+        # Batch form of spawn_bullet, taking arrays or scalars as for
+        # set_bullets. With indices None the bullets go into the first
+        # free slots; otherwise they replace the live bullets at indices.
+        # Returns the indices written.
+        if indices is None:
+            count = numpy.broadcast(
+                x, y, w, h, angle, vx, vy, sprite_id,
+                numpy.asarray(color)[...,0]).size
+            if self.active_count + count > self.capacity:
+                raise IndexError("Bullet collection is full.")
+            start = self.active_count
+            self.active_count += count
+            # A slice rather than an index array: basic indexing writes
+            # several times faster than fancy indexing.
+            self.set_bullets(
+                slice(start, start + count),
+                x, y, w, h, angle, vx, vy, sprite_id, color)
+            return numpy.arange(start, start + count)
+        indices = numpy.asarray(indices)
+        if indices.size and indices.max() >= self.active_count:
+            raise IndexError("Can only respawn live bullets.")
+        self.set_bullets(
+            contiguous_slice(indices) or indices,
+            x, y, w, h, angle, vx, vy, sprite_id, color)
+        return indices
     def eliminate_bullets(self, indices):
-        self.positions[indices,:] = 0
-        self.velocities[indices,:] = 0
-        self.dimensions[indices,:] = 0
-    def update_positions(self):
-        # Reset positions to centers:
-        self.vertex_positions[:,::2] = self.positions[:,0:1]
-        self.vertex_positions[:,1::2] = self.positions[:,1:2]
-        # Calculate sine and cosine of angles:
-        numpy.sin(self.angles.T, self.ups[:,0])
-        numpy.cos(self.angles.T, self.ups[:,1])
-        self.rights[:,:] = self.ups[:,::-1]
-        # At this point, ups are (sine, cosine)
-        #                downs are (cosine, sine)
+        # Swap-remove: the live bullets at the end of the active range are
+        # moved down into the holes left by the dead ones, so the live set
+        # stays contiguous. Indices of surviving bullets may change; returns
+        # the indices now holding a different bullet.
+        count = self.active_count
+        dead = numpy.zeros(count, dtype=bool)
+        dead[indices] = True
+        remaining = count - numpy.count_nonzero(dead)
+        holes = numpy.nonzero(dead[:remaining])[0]
+        movers = numpy.nonzero(~dead[remaining:])[0] + remaining
+        for array in self.bullet_arrays():
+            array[holes] = array[movers]
+        self.active_count = remaining
+        self.mark_dirty(holes)
+        return holes
+    # The per-frame kernels below work on the live bullets, or on the
+    # slice [start, stop) of them when given, so that separate slices can
+    # be run on separate threads.
+    def update_positions(self, start=0, stop=None):
+        if self.layout == 'instanced':
+            # Corners are worked out in the vertex shader.
+            return
+        live = slice(start, self.active_count if stop is None else stop)
+        positions = self.positions[live]
+        dimensions = self.dimensions[live]
+        vertex_positions = self.vertex_positions[live]
+        ups = self.ups[live]
+        rights = self.rights[live]
+        sincos = self.sincos[live]
+        # Everything below writes into preallocated arrays with out=, so
+        # no temporaries are created however many bullets there are. The
+        # x and y components are done separately: numpy iterates 1-d
+        # strided views directly, where 2-d ones over strided or
+        # interleaved memory go through allocated buffers.
+        sines = sincos[:,0]
+        cosines = sincos[:,1]
+        widths = dimensions[:,0]
+        heights = dimensions[:,1]
+        numpy.sin(self.angles[live], sines)
+        numpy.cos(self.angles[live], cosines)
         # We want:
         #    ups:    (-sine, cosine) * height
         #    rights: (cosine, sine) * width
-        self.ups[:,0:1] = -1 * self.dimensions[:,1:2] * self.ups[:,0:1]
-        self.ups[:,1:2] = self.dimensions[:,1:2] * self.ups[:,1:2]
-        self.rights[:,:] = self.rights[:,:] * self.dimensions[:,0:1]
-        # Finally displace the positions to the corners:
-        # Bottom-left:
-        self.vertex_positions[:,0:2] -= self.ups
-        self.vertex_positions[:,0:2] -= self.rights
-        # Bottom-right:
-        self.vertex_positions[:,2:4] -= self.ups
-        self.vertex_positions[:,2:4] += self.rights
-        # Top-left:
-        self.vertex_positions[:,6:8] += self.ups
-        self.vertex_positions[:,6:8] -= self.rights
-        # Top-right:
-        self.vertex_positions[:,4:6] += self.ups
-        self.vertex_positions[:,4:6] += self.rights
-    def move_bullets(self, multiplier):
-        self.positions[:,:] += self.velocities * multiplier
+        numpy.multiply(sines, heights, ups[:,0])
+        numpy.negative(ups[:,0], ups[:,0])
+        numpy.multiply(cosines, heights, ups[:,1])
+        numpy.multiply(cosines, widths, rights[:,0])
+        numpy.multiply(sines, widths, rights[:,1])
+        origin = self.vertex_origin
+        for axis in (0, 1):
+            centers = positions[:,axis]
+            if origin[axis]:
+                centers = numpy.subtract(
+                    centers, origin[axis], self.steps[live,axis])
+            # The corners lie along the two diagonals, up+right and
+            # up-right. sincos is free again, so it holds the first; ups
+            # is overwritten with the second.
+            diagonals = numpy.add(ups[:,axis], rights[:,axis], sincos[:,axis])
+            antidiagonals = numpy.subtract(
+                ups[:,axis], rights[:,axis], ups[:,axis])
+            corners = (
+                (numpy.subtract, diagonals),      # Bottom-left
+                (numpy.subtract, antidiagonals),  # Bottom-right
+                (numpy.add, diagonals),           # Top-right
+                (numpy.add, antidiagonals))       # Top-left
+            if vertex_positions.dtype == GLfloat:
+                for corner, (operation, offsets) in enumerate(corners):
+                    operation(centers, offsets, vertex_positions[:,corner,axis])
+            else:
+                # A ufunc writing straight into half floats would cast
+                # through buffers it allocates; work each corner out in
+                # rights, now free, and convert it with copyto instead.
+                corner_scratch = rights[:,axis]
+                for corner, (operation, offsets) in enumerate(corners):
+                    operation(centers, offsets, corner_scratch)
+                    numpy.copyto(
+                        vertex_positions[:,corner,axis], corner_scratch,
+                        casting='same_kind')
+    def set_vertex_origin(self, origin):
+        # Corner positions are written relative to origin, which is added
+        # back by subtracting it from the focal_point uniform. Keeping it
+        # near the camera keeps half float positions precise there. The
+        # instanced layout builds quads from the float centers, so has no
+        # use for it.
+        if self.layout == 'instanced':
+            return
+        self.vertex_origin = (float(origin[0]), float(origin[1]))
+        self.update_positions()
+    def move_bullets(self, multiplier, start=0, stop=None):
+        live = slice(start, self.active_count if stop is None else stop)
+        positions = self.positions[live]
+        velocities = self.velocities[live]
+        steps = self.steps[live]
+        if self.layout == 'instanced':
+            # positions is a field of self.instances; go an axis at a time
+            # for the reason given in update_positions.
+            parts = [
+                (positions[:,axis], velocities[:,axis], steps[:,axis])
+                for axis in (0, 1)]
+        else:
+            parts = [(positions, velocities, steps)]
+        for positions, velocities, steps in parts:
+            numpy.multiply(velocities, multiplier, steps)
+            numpy.add(positions, steps, positions)
+    def apply_behaviors(self, elapsed, start=0, stop=None):
+        # Integrates the enabled behavior channels over elapsed seconds,
+        # each in one pass over the live bullets, changing velocities
+        # (and angles) ahead of move_bullets. Returns the indices of the
+        # bullets whose lifetimes ran out.
+        behaviors = self.behaviors
+        if not behaviors:
+            return numpy.zeros(0, dtype=numpy.intp)
+        live = slice(start, self.active_count if stop is None else stop)
+        velocities = self.velocities[live]
+        vx = velocities[:,0]
+        vy = velocities[:,1]
+        angles = self.angles[live]
+        scratch = self.distances[live]
+        steps = self.steps[live]
+        sincos = self.sincos[live]
+        if 'acceleration' in behaviors:
+            accelerations = behaviors['acceleration'][live]
+            for axis in (0, 1):
+                numpy.multiply(accelerations[:,axis], elapsed, steps[:,axis])
+                numpy.add(velocities[:,axis], steps[:,axis],
+                    velocities[:,axis])
+        if 'homing' in behaviors:
+            # The turn toward the target, wrapped into [-pi, pi) and
+            # limited to homing * elapsed either way.
+            turns = scratch
+            for axis in (0, 1):
+                numpy.subtract(self.homing_target[axis],
+                    self.positions[live,axis], steps[:,axis])
+            numpy.arctan2(steps[:,1], steps[:,0], turns)
+            numpy.arctan2(vy, vx, steps[:,0])
+            numpy.subtract(turns, steps[:,0], turns)
+            numpy.add(turns, math.pi, turns)
+            numpy.remainder(turns, 2.0 * math.pi, turns)
+            numpy.subtract(turns, math.pi, turns)
+            limits = numpy.multiply(behaviors['homing'][live], elapsed,
+                steps[:,1])
+            numpy.minimum(turns, limits, turns)
+            numpy.negative(limits, limits)
+            numpy.maximum(turns, limits, turns)
+            sines = sincos[:,0]
+            cosines = sincos[:,1]
+            numpy.sin(turns, sines)
+            numpy.cos(turns, cosines)
+            # (vx, vy) rotated by the turn.
+            numpy.multiply(vx, sines, steps[:,0])
+            numpy.multiply(vy, sines, steps[:,1])
+            numpy.multiply(vx, cosines, vx)
+            numpy.subtract(vx, steps[:,1], vx)
+            numpy.multiply(vy, cosines, vy)
+            numpy.add(vy, steps[:,0], vy)
+            numpy.add(angles, turns, angles)
+        if 'drag' in behaviors:
+            factors = numpy.multiply(behaviors['drag'][live], -elapsed,
+                scratch)
+            numpy.exp(factors, factors)
+            numpy.multiply(vx, factors, vx)
+            numpy.multiply(vy, factors, vy)
+        if 'max_speed' in behaviors:
+            # Scale by max_speed / max(speed, max_speed), which is one for
+            # bullets under the cap; the floor keeps 0 / 0 out.
+            max_speeds = behaviors['max_speed'][live]
+            factors = numpy.hypot(vx, vy, scratch)
+            numpy.maximum(factors, max_speeds, factors)
+            numpy.maximum(factors, 1e-30, factors)
+            numpy.divide(max_speeds, factors, factors)
+            numpy.multiply(vx, factors, vx)
+            numpy.multiply(vy, factors, vy)
+        if 'angular_velocity' in behaviors:
+            spins = numpy.multiply(behaviors['angular_velocity'][live],
+                elapsed, scratch)
+            numpy.add(angles, spins, angles)
+        if 'lifetime' in behaviors:
+            lifetimes = behaviors['lifetime'][live]
+            flags = self.flags[live]
+            numpy.subtract(lifetimes, elapsed, lifetimes)
+            numpy.less_equal(lifetimes, 0.0, flags)
+            return numpy.nonzero(flags)[0] + start
+        return numpy.zeros(0, dtype=numpy.intp)
+    def rotate_bullets(self, amount, start=0, stop=None):
+        angles = self.angles[start:self.active_count if stop is None else stop]
+        numpy.add(angles, amount, angles)
+    def bullets_beyond(self, radius, start=0, stop=None):
+        # Indices of the live bullets further than radius from the origin.
+        live = slice(start, self.active_count if stop is None else stop)
+        distances = self.distances[live]
+        flags = self.flags[live]
+        xs = self.positions[live,0]
+        ys = self.positions[live,1]
+        squares = self.steps[live,0]
+        numpy.multiply(xs, xs, distances)
+        numpy.multiply(ys, ys, squares)
+        numpy.add(distances, squares, distances)
+        numpy.greater(distances, radius * radius, flags)
+        return numpy.nonzero(flags)[0] + start
+    def visible_bullets(self, center, half_extent, start=0, stop=None):
+        # Flags the live bullets whose bounding circles overlap the box
+        # center +/- half_extent (x, y), and returns the flags. Bullets are
+        # circles of radius hypot(dimensions), which encloses the quad at
+        # any angle. The flags are self.flags, so use them before the
+        # next kernel does.
+        live = slice(start, self.active_count if stop is None else stop)
+        radii = self.distances[live]
+        flags = self.flags[live]
+        excess = self.steps[live]
+        numpy.hypot(self.dimensions[live,0], self.dimensions[live,1], radii)
+        # How far each bullet's circle lies beyond the box on each axis,
+        # negative when it reaches inside.
+        for axis in (0, 1):
+            gap = excess[:,axis]
+            numpy.subtract(self.positions[live,axis], center[axis], gap)
+            numpy.absolute(gap, gap)
+            numpy.subtract(gap, radii, gap)
+            numpy.subtract(gap, half_extent[axis], gap)
+        numpy.maximum(excess[:,0], excess[:,1], excess[:,0])
+        numpy.less_equal(excess[:,0], 0.0, flags)
+        return flags
+    def upload_arrays(self):
+        # The arrays BatchRenderer sends to the GPU, one per buffer, cut
+        # down to the live range.
+        count = self.active_count
+        return tuple(array[:count] for array in self.vertex_arrays())
+    def upload_spans(self, coalesce_gap=0):
+        # Pairs each live vertex array with the [start, stop) bullet spans
+        # that need uploading, or None when all of it does, and forgets
+        # the changes. Spans closer than coalesce_gap bullets are merged.
+        count = self.active_count
+        spans = []
+        for array, name in zip(self.upload_arrays(), self.attribute_names):
+            dirty = self.dirty_ranges.get(name)
+            if dirty is None:
+                spans.append((array, None))
+            else:
+                spans.append((array, dirty.ranges(coalesce_gap, count)))
+                dirty.clear()
+        return spans
     
-class BulletBuffers(object):
-    def __init__(self, bullet_collection):
-        self.bullets = bullet_collection
-        self.position_buffer, self.texcoord_buffer, self.color_buffer = \
-            glGenBuffers(3)
-        self.element_buffer = short_element_buffer(
-            *sum([[i+0,i+1,i+2,i+2,i+3,i+0]
-                for i in xrange(0, 4*self.bullets.count, 4)], []))
-        self.update_buffers()
-    def update_buffers(self):
-        target = GL_ARRAY_BUFFER
-        for buf, data in (
-            (self.position_buffer, self.bullets.vertex_positions),
-            (self.texcoord_buffer, self.bullets.texture_coordinates),
-            (self.color_buffer, self.bullets.vertex_colors)):
-            glBindBuffer(target, buf)
-            glBufferData(target, data.nbytes, data, GL_STREAM_DRAW)
+def sprite_vertex_attributes(bullet_collection):
+    # (stream index, attribute name, size, type, normalized, stride,
+    # offset within the uploaded array) for every attribute of the
+    # collection's vertex arrays.
+    return [
+        (i,) + pointer
+        for i, (array, name) in enumerate(zip(
+            bullet_collection.vertex_arrays(),
+            bullet_collection.attribute_names))
+        for pointer in vertex_attribute_pointers(array, name)]
+
+alpha_blend = (GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+additive_blend = (GL_SRC_ALPHA, GL_ONE)
+
+class SpriteLayer(object):
+    # A collection of bullets to draw with BatchRenderer, and how to draw
+    # it. texture is a TextureHandle, None meaning the sprite sheet;
+    # program a ShaderProgram, None meaning the bullet program for the
+    # collection's layout; blend a (source, destination) pair for
+    # glBlendFunc, or None to draw opaque.
+    #
+    # Layers are drawn in order of order. Layers with the same order may
+    # be drawn in any order relative to each other, which is what lets
+    # the renderer merge them, so give layers that must overlap one way
+    # different orders.
+    def __init__(self, bullet_collection, texture=None, blend=alpha_blend,
+            order=0, program=None, name=None):
+        self.bullet_collection = bullet_collection
+        self.texture = texture
+        self.blend = blend
+        self.order = order
+        self.program = program
+        self.name = name
+
+class SpriteBatch(object):
+    # Layers drawn with one draw call: their bullets lie together in the
+    # renderer's buffers for their layout and vertex format, from start
+    # for count bullets.
+    def __init__(self, key, program, texture, blend, bullet_collection):
+        self.key = key
+        self.program = program
+        self.texture = texture
+        self.blend = blend
+        self.layout = bullet_collection.layout
+        self.vertex_layout = (
+            bullet_collection.layout, bullet_collection.vertex_format)
+        self.vertex_origin = bullet_collection.vertex_origin
+        self.layers = []
+        self.start = 0
+        self.count = 0
+
+class BatchRenderer(object):
+    # Draws any number of SpriteLayers with as few draw calls as state
+    # changes allow. prepare() sorts the layers by order, program,
+    # texture and blend, merges neighbours that agree on all four (and
+    # on vertex layout) into batches, and packs every layer of a layout
+    # into one staging array per vertex array, sent with a single upload
+    # per StreamingBuffer. draw() then issues one draw call per batch,
+    # pointing the attributes at the batch's part of the buffers.
+    #
+    # With cull, only bullets that overlap the window are packed, so
+    # uploading and drawing cost what's on screen rather than what's in
+    # the collections.
+    #
+    # Arrays a collection tracks changes to (its dirty_ranges) go in
+    # DynamicBuffers rather than StreamingBuffers. While a layout has a
+    # single collection to draw and nothing of it is culled, its rows sit
+    # in the buffers as they do in the collection, so only the changed
+    # spans of those arrays are rewritten, merging spans up to
+    # coalesce_gap bullets apart. A frame that packs the layout's rows
+    # instead sends them in full, as does the frame after.
+    #
+    # Per-frame statistics are in the frame_* attributes: layers and
+    # batches drawn (a draw call each), layers that shared a draw call
+    # with another, sprites drawn and culled, and bytes uploaded.
+    # total_layers and total_draw_calls add up the frames.
+    origin_snap = 8.0
+    def __init__(self, strategy='orphan', cull=True, coalesce_gap=16):
+        self.strategy = strategy
+        self.cull = cull
+        self.coalesce_gap = coalesce_gap
+        # By (layout, vertex format): StreamingBuffers and DynamicBuffers,
+        # staging arrays, VertexArray, attribute layout, bytes per bullet,
+        # and the collection last sent unpacked, if it was last frame.
+        self.streams = {}
+        self.staging = {}
+        self.vertex_arrays = {}
+        self.vertex_attributes = {}
+        self.row_bytes = {}
+        self.resident = {}
+        self.corner_buffer = None
+        self.quad_indices = None
+        self.batches = []
+        self.attribute_offsets = {}
+        self.frame_layers = 0
+        self.frame_draw_calls = 0
+        self.frame_merged_layers = 0
+        self.frame_sprites = 0
+        self.frame_culled = 0
+        self.frame_upload_bytes = 0
+        self.total_layers = 0
+        self.total_draw_calls = 0
+    def batch_key(self, resources, layer):
+        collection = layer.bullet_collection
+        program = layer.program or bullet_program(
+            resources, collection.layout)
+        texture = layer.texture or resources.textures[2]
+        return (
+            (layer.order, program.program, texture.texture,
+                layer.blend or (), collection.layout,
+                collection.vertex_format, collection.vertex_origin),
+            program, texture)
+    def track_camera(self, resources, layers):
+        # Moves the vertex origin of compact collections to within
+        # origin_snap of the camera, so half float positions are precise
+        # where they're seen. Snapping keeps it still, and the layers
+        # mergeable, while the camera drifts.
+        focal_point = view_transform(resources)[0]
+        snap = self.origin_snap
+        origin = tuple(
+            math.floor(value / snap + 0.5) * snap for value in focal_point)
+        for layer in layers:
+            collection = layer.bullet_collection
+            if collection.vertex_format == 'compact' and \
+                    collection.layout != 'instanced' and \
+                    collection.vertex_origin != origin:
+                collection.set_vertex_origin(origin)
+    def make_batches(self, resources, layers):
+        batches = []
+        keyed = [
+            self.batch_key(resources, layer) + (layer,)
+            for layer in layers
+            if layer.bullet_collection.active_count]
+        keyed.sort(key=lambda entry: entry[0])
+        for key, program, texture, layer in keyed:
+            if not batches or batches[-1].key != key:
+                batches.append(SpriteBatch(
+                    key, program, texture, layer.blend,
+                    layer.bullet_collection))
+            batches[-1].layers.append(layer)
+        return batches
+    def layout_buffers(self, collection):
+        # Streams, VertexArray and attribute layout for the collection's
+        # layout and vertex format, made the first time they're seen.
+        layout = (collection.layout, collection.vertex_format)
+        if layout not in self.streams:
+            self.streams[layout] = [
+                DynamicBuffer(GL_ARRAY_BUFFER, array.nbytes)
+                if name in collection.dirty_ranges else
+                StreamingBuffer(GL_ARRAY_BUFFER, array.nbytes, self.strategy)
+                for array, name in zip(
+                    collection.vertex_arrays(),
+                    collection.attribute_names)]
+            self.vertex_arrays[layout] = VertexArray()
+            self.vertex_attributes[layout] = \
+                sprite_vertex_attributes(collection)
+            self.staging[layout] = [
+                array[:0].copy() for array in collection.vertex_arrays()]
+            self.row_bytes[layout] = [
+                array.dtype.itemsize * int(numpy.prod(array.shape[1:]))
+                for array in collection.vertex_arrays()]
+            if collection.layout == 'instanced' and \
+                    self.corner_buffer is None:
+                self.corner_buffer = shared_quad_corners.get()
+        return self.streams[layout]
+    def prepare(self, resources, layers):
+        # Sorts, merges, culls and uploads; call draw() to draw the
+        # result.
+        self.track_camera(resources, layers)
+        batches = self.make_batches(resources, layers)
+        self.attribute_offsets = {}
+        self.frame_sprites = 0
+        self.frame_culled = 0
+        self.frame_upload_bytes = 0
+        if self.cull:
+            center, half_extent = visible_extent(resources)
+        by_layout = collections.OrderedDict()
+        for batch in batches:
+            by_layout.setdefault(batch.vertex_layout, []).append(batch)
+        for layout, layout_batches in by_layout.items():
+            streams = self.layout_buffers(
+                layout_batches[0].layers[0].bullet_collection)
+            # (arrays, visible flags or None for all, count) per layer,
+            # and the changed spans of its arrays. upload_spans forgets
+            # the collections' changes whether or not the spans get used.
+            parts = []
+            part_spans = []
+            count = 0
+            for batch in layout_batches:
+                batch.start = count
+                for layer in batch.layers:
+                    collection = layer.bullet_collection
+                    arrays, spans = zip(
+                        *collection.upload_spans(self.coalesce_gap))
+                    flags = None
+                    visible = collection.active_count
+                    if self.cull:
+                        flags = collection.visible_bullets(
+                            center, half_extent)
+                        visible = int(numpy.count_nonzero(flags))
+                        self.frame_culled += collection.active_count - visible
+                        if visible == collection.active_count:
+                            flags = None
+                    parts.append((arrays, flags, visible))
+                    part_spans.append(spans)
+                    count += visible
+                batch.count = count - batch.start
+            if len(parts) == 1 and parts[0][1] is None:
+                # Nothing to merge or cull; upload straight from the
+                # collection, just the changed spans if the buffers
+                # already hold the rest of it.
+                arrays = parts[0][0]
+                spans = part_spans[0]
+                collection = layout_batches[0].layers[0].bullet_collection
+                if self.resident.get(layout) is not collection:
+                    spans = [None] * len(arrays)
+                self.resident[layout] = collection
+            else:
+                arrays = self.pack(layout, parts, count)
+                spans = [None] * len(arrays)
+                self.resident.pop(layout, None)
+            offsets = []
+            for stream, array, array_spans in zip(streams, arrays, spans):
+                if array_spans is None or array.nbytes > stream.size:
+                    offsets.append(stream.upload(array))
+                    self.frame_upload_bytes += array.nbytes
+                else:
+                    offsets.append(stream.update(array, array_spans))
+                    self.frame_upload_bytes += sum(
+                        array[start:stop].nbytes
+                        for start, stop in array_spans)
+            self.attribute_offsets[layout] = offsets
+            self.frame_sprites += count
+            if layout_batches[0].layout != 'instanced':
+                self.quad_indices = shared_quad_indices.reserve(
+                    max(batch.count for batch in layout_batches))
+        # Layers culled away entirely needn't be drawn.
+        self.batches = [batch for batch in batches if batch.count]
+        self.frame_layers = sum(len(b.layers) for b in self.batches)
+        self.frame_draw_calls = len(self.batches)
+        self.frame_merged_layers = sum(
+            len(b.layers) for b in self.batches if len(b.layers) > 1)
+        self.total_layers += self.frame_layers
+        self.total_draw_calls += self.frame_draw_calls
+    def pack(self, layout, parts, count):
+        # Gathers the visible rows of each layer's arrays one after
+        # another into the staging arrays, growing them as needed, and
+        # returns the filled part.
+        staging = self.staging[layout]
+        if len(staging[0]) < count:
+            staging = self.staging[layout] = [
+                numpy.empty((max(count, 2 * len(array)),) + array.shape[1:],
+                    dtype=array.dtype)
+                for array in staging]
+        for i, array in enumerate(staging):
+            start = 0
+            for arrays, flags, visible in parts:
+                if flags is None:
+                    array[start:start + visible] = arrays[i]
+                else:
+                    numpy.compress(flags, arrays[i], axis=0,
+                        out=array[start:start + visible])
+                start += visible
+        return [array[:count] for array in staging]
+    def draw(self, resources):
+        focal_point, zoom = view_transform(resources)
+        for batch in self.batches:
+            program = batch.program
+            unis = program.uniforms
+            origin = batch.vertex_origin
+            gl_state.use_program(program.program)
+            gl_state.uniform(glUniform2f, unis.focal_point,
+                focal_point[0] - origin[0], focal_point[1] - origin[1])
+            gl_state.uniform(glUniform2f, unis.zoom, *zoom)
+            gl_state.bind_texture(GL_TEXTURE_2D, batch.texture.texture, 0)
+            gl_state.uniform(glUniform1i, unis.tex, 0)
+            if batch.blend is None:
+                gl_state.disable(GL_BLEND)
+            else:
+                gl_state.enable(GL_BLEND)
+                gl_state.blend_func(*batch.blend)
+            # The batch's bullets start batch.start rows into each buffer.
+            vertex_layout = batch.vertex_layout
+            streams = self.streams[vertex_layout]
+            offsets = self.attribute_offsets[vertex_layout]
+            row_bytes = self.row_bytes[vertex_layout]
+            pointers = [
+                (streams[i].buffer, name, size, type, normalized, stride,
+                    offsets[i] + batch.start * row_bytes[i] + offset)
+                for i, name, size, type, normalized, stride, offset
+                in self.vertex_attributes[vertex_layout]]
+            layout = batch.layout
+            bind_sprite_attributes(
+                self.vertex_arrays[vertex_layout], program, layout, pointers,
+                self.corner_buffer, self.quad_indices)
+            draw_sprites(layout, batch.count, self.quad_indices)
+        for streams in self.streams.values():
+            for stream in streams:
+                stream.end_frame()
 
 class Resources(object):
-    pass
+    # The camera: the world point in the middle of the window, and clip
+    # space units per world unit vertically.
+    focal_point = (0.0, 0.0)
+    zoom = 0.1
 
 class Uniforms(object):
     pass
@@ -275,15 +1165,19 @@ def make_shader_program(
     fragment_shader_source,
     uniforms,
     attributes):
-    vertex_shader = make_shader(
-        GL_VERTEX_SHADER,
-        vertex_shader_source)
-    fragment_shader = make_shader(
-        GL_FRAGMENT_SHADER,
+    program = shared_program_cache.program(
+        vertex_shader_source,
         fragment_shader_source)
-    program = make_program(
-        vertex_shader,
-        fragment_shader)
+    return describe_program(program, uniforms, attributes)
+
+def make_feedback_shader_program(shaders, varyings, uniforms, attributes):
+    # As make_shader_program, for a transform feedback program built from
+    # (shader type, source) pairs; see make_feedback_program.
+    program = make_feedback_program(
+        [make_shader(type, source) for type, source in shaders], varyings)
+    return describe_program(program, uniforms, attributes)
+
+def describe_program(program, uniforms, attributes):
     shader_program = ShaderProgram(program)
     for u in uniforms:
         setattr(
@@ -298,16 +1192,38 @@ def make_shader_program(
 
 def make_resources(viewport_size): 
     resources = Resources()
+    # Textures stream in over the first few frames; until then they draw
+    # as a transparent placeholder.
+    resources.texture_loader = TextureLoader()
+    load = resources.texture_loader.load
+    # The sprite tables go with the sheet: make_state needs these ones
+    # for the bullets to find their sprites on it.
+    if os.path.exists(bullet_atlas_manifest):
+        manifest = atlas.read_manifest(bullet_atlas_manifest)
+        resources.sprite_tables = SpriteTables(
+            *atlas.sprite_tables(manifest))
+        resources.sprite_tables.check_names(
+            demo_sprite_names, bullet_atlas_manifest)
+        sprite_sheet = load(manifest["image"], True)
+    else:
+        resources.sprite_tables = default_sprite_tables
+        sprite_sheet = load("spaceship_simple_parts_flat.tga", True)
     resources.textures=[
-        make_texture("hello1.tga"),
-        make_texture("hello2.tga"),
-        make_texture("spaceship_simple_parts_flat.tga", True),
+        load("hello1.tga"),
+        load("hello2.tga"),
+        sprite_sheet,
         ]
     resources.bullet_program = make_shader_program(
         bullet_vertex_shader,
         bullet_fragment_shader,
         uniforms = ["focal_point", "zoom", "tex"],
         attributes = ["position", "texcoord", "color"])
+    if instancing_supported():
+        resources.instanced_bullet_program = make_shader_program(
+            instanced_bullet_vertex_shader,
+            bullet_fragment_shader,
+            uniforms = ["focal_point", "zoom", "tex"],
+            attributes = list(instanced_bullet_dtype.names) + ["corner"])
     w,h = viewport_size
     resources.aspect_ratio = (1.0 * w) / h
     return resources
@@ -316,103 +1232,829 @@ def make_resources(viewport_size):
 class State(object):
     timer = 0
     camera_pos = float_array(0,0,-3)
+    # A ShardedSimulation or GPUSimulation to step the bullets with, or
+    # None to step them on the calling thread.
+    simulation = None
+    # A SimulationScheduler stepping the bullets on its own thread, in
+    # which case bullet_collection is only the interpolated copy drawn.
+    scheduler = None
+    # An emitters.EmitterSet firing the bullets. Bullets that escape are
+    # then removed rather than respawned.
+    emitters = None
+    # A recording.Recorder that update_timer logs each frame to.
+    recorder = None
 
-def make_state():
+def make_numpy_rng(seed=None):
+    # numpy.random.Generator where numpy has it (1.17 on), otherwise the
+    # legacy RandomState. Callers stick to methods the two share.
+    if hasattr(numpy.random, 'default_rng'):
+        return numpy.random.default_rng(seed)
+    return numpy.random.RandomState(seed)
+
+# The six orders of a color's red, green and blue channels.
+channel_orders = numpy.array(
+    [(0,1,2), (0,2,1), (1,0,2), (1,2,0), (2,0,1), (2,1,0)])
+
+def make_simulation_state(
+        bullet_count=1000, seed=None, capacity=None, layout='separate',
+        threads=1, vertex_format='float', sprite_tables=None):
+    # threads other than 1 steps the bullets on a thread pool (a
+    # ShardedSimulation, which see for when that pays); None means one
+    # thread per core. The bullets are drawn from sprite_tables
+    # (default_sprite_tables unless given), which zap_bullets also uses.
     state = State()
-    state.rng = Random()
-    state.bullet_collection = BulletCollection(1000)
+    state.rng = make_numpy_rng(seed)
+    if threads != 1:
+        state.simulation = ShardedSimulation(threads)
+    state.bullet_collection = BulletCollection(
+        bullet_count if capacity is None else capacity, layout,
+        vertex_format, sprite_tables)
     state.paused = False
-    random = state.rng.random
-    bullet_textures = bullet_sizes.keys()
-    for i in xrange(1000):
-        angle = random()*math.pi*2.0
-        size = random()*0.5+0.25
-        speed = 3*random()+1
-        color = [255, state.rng.randint(0,255), 0]
-        state.rng.shuffle(color)
-        color.append(state.rng.randint(63,255))
-        state.bullet_collection.set_bullet(
-            i,
-            random()*16.0-8.0, random()*16.0-8.0,
-            size, size,
-            angle,
-            math.cos(angle)*speed, math.sin(angle)*speed,
-            state.rng.choice(bullet_textures),
-            color)
+    rng = state.rng
+    count = bullet_count
+    angle = rng.uniform(0.0, math.pi*2.0, count)
+    size = rng.uniform(0.25, 0.75, count)
+    speed = rng.uniform(1.0, 4.0, count)
+    # One channel full, one random and one off, in a random order.
+    channels = numpy.zeros((count,3), dtype=GLubyte)
+    channels[:,0] = 255
+    channels[:,1] = rng.choice(256, count)
+    color = numpy.empty((count,4), dtype=GLubyte)
+    color[:,:3] = channels[
+        numpy.arange(count)[:,numpy.newaxis],
+        channel_orders[rng.choice(len(channel_orders), count)]]
+    color[:,3] = 63 + rng.choice(193, count)
+    state.bullet_collection.spawn_many(
+        None,
+        rng.uniform(-8.0, 8.0, count), rng.uniform(-8.0, 8.0, count),
+        size, size,
+        angle,
+        numpy.cos(angle)*speed, numpy.sin(angle)*speed,
+        rng.choice(len(state.bullet_collection.sprite_tables.names), count),
+        color)
     state.bullet_collection.update_positions()
-    state.bullet_buffers = BulletBuffers(state.bullet_collection)
     return state
 
-def zap_bullet(state, index):
+def make_state(layout='instanced', upload_strategy='orphan',
+        tick_rate=None, vertex_format='float', bullet_emitters=None,
+        capacity=20000, gpu_simulation=False, seed=None,
+        sprite_tables=None):
+    # Instanced drawing needs GL 3.3 or ARB_instanced_arrays; without it
+    # we expand the quads on the CPU instead. With a tick_rate the
+    # simulation runs on its own thread at that many steps a second.
+    # With bullet_emitters, a list of emitters.Emitters, the field starts
+    # empty with room for capacity bullets and the emitters fill it.
+    # gpu_simulation steps the bullets with a GPUSimulation instead, on
+    # the calling thread, where it's supported: that takes transform
+    # feedback, the instanced float layout and no emitters. seed seeds
+    # the RNG, for sessions that can be recorded and replayed. Pass
+    # resources.sprite_tables as sprite_tables to draw with the sheet
+    # make_resources loaded.
+    if layout == 'instanced' and not instancing_supported():
+        layout = 'separate'
+    gpu_simulation = gpu_simulation and layout == 'instanced' and \
+        vertex_format == 'float' and bullet_emitters is None and \
+        transform_feedback_supported()
+    if gpu_simulation:
+        tick_rate = None
+    if bullet_emitters is None:
+        state = make_simulation_state(
+            seed=seed, layout=layout, vertex_format=vertex_format,
+            sprite_tables=sprite_tables)
+    else:
+        state = make_simulation_state(
+            0, seed=seed, capacity=capacity, layout=layout,
+            vertex_format=vertex_format, sprite_tables=sprite_tables)
+        state.emitters = emitters.EmitterSet(bullet_emitters, state.rng)
+    if tick_rate is not None:
+        simulation_state = state
+        state = State()
+        state.paused = False
+        state.scheduler = SimulationScheduler(simulation_state, tick_rate)
+        state.bullet_collection = BulletCollection(
+            simulation_state.bullet_collection.capacity, layout,
+            vertex_format, sprite_tables)
+        state.scheduler.interpolate(state.bullet_collection)
+        state.scheduler.start()
+    state.renderer = BatchRenderer(upload_strategy)
+    if gpu_simulation:
+        # The bullets never leave the GPU, so they draw themselves.
+        state.simulation = GPUSimulation(state.bullet_collection)
+        state.layers = []
+    else:
+        state.layers = [SpriteLayer(state.bullet_collection, name='bullets')]
+    return state
+
+def demo_emitters(sprite_tables=default_sprite_tables):
+    # One of each pattern, for main's --emitters, some with behaviors.
+    # Their sprite ids are for sprite_tables.
+    ids = sprite_tables.ids
+    return [
+        emitters.Emitter('spiral', rate=40, count=3, speed=3.0,
+            sprite_id=ids['dart'], size=0.4, color=(255, 96, 64, 255)),
+        emitters.Emitter('ring', rate=1.5, count=32, size=0.3,
+            speed=[(0.0, 1.0), (10.0, 4.0)],
+            sprite_id=ids['circle'], color=(64, 160, 255, 255)),
+        emitters.Emitter('fan', position=(-6.0, 6.0), rate=4, count=7,
+            angle=-math.pi / 4, speed=5.0, size=0.4,
+            sprite_id=ids['lozenge'], color=(255, 255, 96, 255),
+            behaviors={'acceleration': (0.0, -4.0), 'max_speed': 6.0}),
+        emitters.Emitter('aimed', position=(6.0, 6.0), rate=3, count=3,
+            target=(0.0, -6.0), speed=6.0, size=0.4, phase=0.15,
+            sprite_id=ids['triangle'], color=(128, 255, 128, 255),
+            behaviors={'homing': 1.5, 'lifetime': 4.0}),
+        emitters.Emitter('burst', position=(0.0, -4.0), rate=0.5,
+            count=64, speed=4.0, speed_spread=0.5, size=0.3,
+            sprite_id=ids['dot'], color=(255, 255, 255, 200),
+            behaviors={'drag': 0.8, 'angular_velocity': 6.0}),
+        ]
+
+def zap_bullets(state, indices):
     rng = state.rng
-    random = rng.random
-    x = random()*0.3
-    y = random()*0.3 - 1.0
+    count = len(indices)
+    x = rng.uniform(0.0, 0.3, count)
+    y = rng.uniform(0.0, 0.3, count) - 1.0
     angle = math.pi * 0.5 #(random()-0.5)*math.pi/16 + math.pi * 0.5
-    state.bullet_collection.set_bullet(
-        index,
+    state.bullet_collection.spawn_many(
+        indices,
         x, y,
         1, 1,
-        angle+math.pi*0.5+random()*2.0*math.pi,
+        angle+math.pi*0.5+rng.uniform(0.0, 2.0*math.pi, count),
         math.cos(angle)*7.0,
         math.sin(angle)*7.0,
-        "oval",
+        state.bullet_collection.sprite_tables.ids["oval"],
         (255, 255, 255, 200))
 
+# Radians per second every bullet spins (unless the collection has the
+# angular_velocity behavior, which takes over), and how far from the middle a
+# bullet goes before it is respawned.
+spin_rate = 15.0
+escape_radius = 10.0
+
+def respawn_dead_bullets(state):
+    dead_bullets = state.bullet_collection.bullets_beyond(escape_radius)
+    if len(dead_bullets):
+        zap_bullets(state, dead_bullets)
+    return dead_bullets
+
+def step_bullets(bullet_collection, elapsed, start=0, stop=None):
+    # Moves the live bullets in [start, stop) on by elapsed seconds and
+    # returns the indices of those that died, by escaping or running out
+    # of lifetime.
+    expired = bullet_collection.apply_behaviors(elapsed, start, stop)
+    bullet_collection.move_bullets(elapsed, start, stop)
+    if 'angular_velocity' not in bullet_collection.behaviors:
+        bullet_collection.rotate_bullets(elapsed * spin_rate, start, stop)
+    dead_bullets = bullet_collection.bullets_beyond(escape_radius, start, stop)
+    if len(expired):
+        dead_bullets = numpy.union1d(dead_bullets, expired)
+    return dead_bullets
+
+def replace_bullets(state, dead_bullets, elapsed):
+    # Without emitters, respawns the dead bullets in place. With them,
+    # removes the dead bullets and fires whatever the emitters have due
+    # in the step. Returns the indices of every bullet that changed.
+    if state.emitters is None:
+        if len(dead_bullets):
+            zap_bullets(state, dead_bullets)
+        return dead_bullets
+    moved = state.bullet_collection.eliminate_bullets(dead_bullets)
+    spawned = state.emitters.emit(state.bullet_collection, elapsed)
+    return numpy.concatenate([moved, spawned])
+
+class ShardedSimulation(object):
+    # Runs the per-frame kernels over contiguous slices of the live
+    # bullets on a pool of threads. numpy drops the GIL inside its ufuncs,
+    # so the slices really do run side by side, and since each one only
+    # touches its own rows of the arrays no locking is needed. Respawning
+    # stays on the calling thread, in bullet order, so a seeded run comes
+    # out the same however many threads there are.
+    #
+    # It's opt-in (make_simulation_state's threads), as it has only been
+    # timed on one core, where it can't win. Handing a batch of shards to
+    # the pool cost about 80 microseconds there, twice a step, against
+    # some 30 ns a bullet for the step itself, so even two perfectly
+    # parallel threads would only break even at around 11k bullets. Hence
+    # min_shard_size: nothing is split until there are two shards of 16k,
+    # 32k bullets. Check benchmark.py --threads on the machine in question
+    # before turning it on.
+    def __init__(self, threads=None, min_shard_size=16384):
+        if threads is None:
+            threads = multiprocessing.cpu_count()
+        self.threads = max(1, int(threads))
+        self.min_shard_size = min_shard_size
+        self.pool = ThreadPool(self.threads) if self.threads > 1 else None
+    def shards(self, count):
+        # [start, stop) slices covering range(count). Small collections
+        # get fewer shards, as each costs a handful of numpy calls.
+        shard_count = min(self.threads, max(1, count // self.min_shard_size))
+        bounds = numpy.linspace(0, count, shard_count + 1).astype(int)
+        return list(zip(bounds[:-1], bounds[1:]))
+    def map(self, function, shards):
+        if self.pool is None or len(shards) == 1:
+            return [function(shard) for shard in shards]
+        return self.pool.map(function, shards)
+    def advance(self, state, elapsed, expand=True):
+        bullet_collection = state.bullet_collection
+        def step(shard):
+            return step_bullets(bullet_collection, elapsed, *shard)
+        def expand_shard(shard):
+            bullet_collection.update_positions(*shard)
+        shards = self.shards(bullet_collection.active_count)
+        dead_bullets = numpy.concatenate(self.map(step, shards))
+        changed = replace_bullets(state, dead_bullets, elapsed)
+        if expand:
+            self.map(expand_shard,
+                self.shards(bullet_collection.active_count))
+        return changed
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+def advance_simulation(state, elapsed, expand=True):
+    # Steps the bullets by elapsed seconds and returns the indices of the
+    # ones that were respawned (or moved or spawned, with emitters).
+    # expand=False leaves the quad corners stale, for when something else
+    # draws the bullets.
+    if state.simulation is not None:
+        # Sharded on the CPU or run on the GPU.
+        return state.simulation.advance(state, elapsed, expand)
+    changed = replace_bullets(
+        state, step_bullets(state.bullet_collection, elapsed), elapsed)
+    if expand:
+        state.bullet_collection.update_positions()
+    return changed
+
+class Snapshot(object):
+    # The bullets as they were after one simulation tick, plus their
+    # positions and angles one tick earlier to interpolate from.
+    def __init__(self, capacity, layout, vertex_format='float'):
+        # Snapshots are only ever copied from, never drawn.
+        self.bullet_collection = BulletCollection(
+            capacity, layout, vertex_format, track_changes=False)
+        self.previous_positions = numpy.zeros((capacity,2), dtype=GLfloat)
+        self.previous_angles = numpy.zeros(capacity, dtype=GLfloat)
+        self.tick = -1
+        self.time = 0.0
+        # Bullets respawned by this tick, which jump rather than move.
+        self.respawned = numpy.zeros(0, dtype=int)
+        # (tick, respawned) for this and the last few ticks before it.
+        self.history = []
+
+def respawned_since(history, tick):
+    # Every bullet respawned after tick according to history, or None if
+    # history doesn't go back that far.
+    if not history or history[0][0] > tick + 1:
+        return None
+    return numpy.concatenate([numpy.zeros(0, dtype=int)] + [
+        respawned for later_tick, respawned in history if later_tick > tick])
+
+class SimulationScheduler(object):
+    # Steps a simulation state at a fixed rate on its own thread, so the
+    # physics doesn't depend on the frame rate and simulation overlaps
+    # with drawing. Each tick is published as a Snapshot in one of three
+    # slots: the newest, the one the renderer is reading and the one
+    # being written. The renderer calls interpolate to fill its own
+    # BulletCollection from the newest snapshot, blended between the
+    # last two ticks by how far the clock has got.
+    #
+    # Only positions and angles are copied wholesale each tick. The other
+    # arrays only change when a bullet respawns, so just those bullets
+    # are copied, using a short history of which ones respawned when.
+    def __init__(self, simulation_state, tick_rate=60.0, history_length=8,
+            max_lag=5, clock=timeit.default_timer):
+        self.simulation_state = simulation_state
+        self.timestep = 1.0 / tick_rate
+        self.clock = clock
+        self.max_lag = max_lag
+        self.paused = False
+        source = simulation_state.bullet_collection
+        self.slots = [
+            Snapshot(source.capacity, source.layout, source.vertex_format)
+            for i in range(3)]
+        self.history = collections.deque(maxlen=history_length)
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.tick = 0
+        self.latest = None
+        self.reading = None
+        self.consumed_tick = -1
+        # Tick 0 is the starting state, with nothing to interpolate from.
+        self.next_time = self.clock()
+        self.publish(self.write_slot(), self.next_time, 0,
+            numpy.zeros(0, dtype=int))
+    def start(self):
+        self.next_time = self.clock()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+    def run(self):
+        while not self.stopping.is_set():
+            now = self.clock()
+            if self.paused:
+                self.next_time = now
+                self.stopping.wait(self.timestep)
+                continue
+            if now < self.next_time:
+                self.stopping.wait(self.next_time - now)
+                continue
+            if now - self.next_time > self.max_lag * self.timestep:
+                # Too far behind to catch up; drop the missed ticks.
+                self.next_time = now
+            self.step()
+    def step(self):
+        # One fixed-length tick, published as a new snapshot.
+        bullet_collection = self.simulation_state.bullet_collection
+        slot = self.write_slot()
+        live = slice(0, bullet_collection.active_count)
+        slot.previous_positions[live] = bullet_collection.positions[live]
+        slot.previous_angles[live] = bullet_collection.angles[live]
+        respawned = advance_simulation(
+            self.simulation_state, self.timestep, expand=False)
+        self.next_time += self.timestep
+        self.tick += 1
+        self.publish(slot, self.next_time, self.tick, respawned)
+    def write_slot(self):
+        with self.lock:
+            for slot in self.slots:
+                if slot is not self.latest and slot is not self.reading:
+                    return slot
+    def publish(self, slot, time, tick, respawned):
+        source = self.simulation_state.bullet_collection
+        target = slot.bullet_collection
+        self.history.append((tick, respawned))
+        changed = respawned_since(self.history, slot.tick)
+        if changed is None or target.active_count != source.active_count:
+            target.copy_bullets(source)
+        else:
+            live = slice(0, source.active_count)
+            target.positions[live] = source.positions[live]
+            target.angles[live] = source.angles[live]
+            if len(changed):
+                target.copy_bullets(source, changed)
+        if tick == 0:
+            slot.previous_positions[:] = target.positions
+            slot.previous_angles[:] = target.angles
+        # The renderer's collection tracks its own changes as it copies
+        # from the snapshots; the simulation's would pile up unused.
+        source.forget_changes()
+        slot.tick = tick
+        slot.time = time
+        slot.respawned = respawned
+        slot.history = list(self.history)
+        with self.lock:
+            self.latest = slot
+    def interpolate(self, bullet_collection):
+        # Fills bullet_collection, of the simulation's layout and capacity,
+        # with the bullets as of now. This lags the simulation by up to a
+        # tick: it shows the newest tick once a whole tick has passed.
+        with self.lock:
+            snapshot = self.reading = self.latest
+        source = snapshot.bullet_collection
+        count = source.active_count
+        changed = respawned_since(snapshot.history, self.consumed_tick)
+        if changed is None or bullet_collection.active_count != count:
+            bullet_collection.copy_bullets(source)
+        elif len(changed):
+            bullet_collection.copy_bullets(source, changed)
+        self.consumed_tick = snapshot.tick
+        fraction = (self.clock() - snapshot.time) / self.timestep
+        fraction = min(max(fraction, 0.0), 1.0)
+        live = slice(0, count)
+        for current, previous, target in (
+                (source.positions, snapshot.previous_positions,
+                    bullet_collection.positions),
+                (source.angles, snapshot.previous_angles,
+                    bullet_collection.angles)):
+            numpy.subtract(current[live], previous[live], target[live])
+            numpy.multiply(target[live], fraction, target[live])
+            numpy.add(target[live], previous[live], target[live])
+        # Respawned bullets would otherwise streak from where they died.
+        respawned = snapshot.respawned
+        bullet_collection.positions[respawned] = source.positions[respawned]
+        bullet_collection.angles[respawned] = source.angles[respawned]
+        bullet_collection.update_positions()
+
+# What the GPU simulation keeps resident and advances every tick: the
+# parts of a bullet that change in flight. The rest of the instanced
+# record, gpu_sprite_dtype, only changes when a bullet respawns.
+gpu_bullet_dtype = numpy.dtype([
+    ('center', GLfloat, 2),
+    ('angle', GLfloat),
+    ('velocity', GLfloat, 2),
+    ('lifetime', GLfloat)])
+
+gpu_sprite_dtype = numpy.dtype([
+    ('size', GLfloat, 2),
+    ('atlas_rect', GLfloat, 4),
+    ('color', GLubyte, 4)])
+
+# One bullet per vertex, doing the same sums as step_bullets.
+gpu_step_vertex_shader = '''\
+#version 150
+
+uniform float elapsed;
+uniform float spin;
+
+in vec2 center;
+in float angle;
+in vec2 velocity;
+in float lifetime;
+
+out vec2 next_center;
+out float next_angle;
+out vec2 next_velocity;
+out float next_lifetime;
+
+void main()
+{
+    next_center = center + velocity * elapsed;
+    next_angle = angle + spin;
+    next_velocity = velocity;
+    next_lifetime = lifetime - elapsed;
+}
+'''
+
+# Passes each bullet's index on to the geometry shader below, which
+# only emits the dead ones.
+gpu_dead_vertex_shader = '''\
+#version 150
+
+in vec2 center;
+in float lifetime;
+
+out vec2 vertex_center;
+out float vertex_lifetime;
+flat out int vertex_index;
+
+void main()
+{
+    vertex_center = center;
+    vertex_lifetime = lifetime;
+    vertex_index = gl_VertexID;
+}
+'''
+
+gpu_dead_geometry_shader = '''\
+#version 150
+
+layout(points) in;
+layout(points, max_vertices = 1) out;
+
+uniform float escape_radius;
+
+in vec2 vertex_center[];
+in float vertex_lifetime[];
+flat in int vertex_index[];
+
+flat out int dead_index;
+
+void main()
+{
+    vec2 center = vertex_center[0];
+    if (center.x * center.x + center.y * center.y >
+            escape_radius * escape_radius ||
+            vertex_lifetime[0] <= 0.0) {
+        dead_index = vertex_index[0];
+        EmitVertex();
+    }
+}
+'''
+
+class GPUSimulation(object):
+    # Steps the bullets on the GPU with transform feedback, so they don't
+    # go through numpy and over the bus every tick. What changes in
+    # flight (gpu_bullet_dtype) lives in two buffers: each tick a vertex
+    # shader reads one and writes the other, then a geometry shader pass
+    # over the result writes out the indices of the bullets that died.
+    # Only those indices come back. The dead bullets are respawned into
+    # bullet_collection as usual and their new records go up with
+    # glBufferSubData, which in a steady state is the only upload. The
+    # sprite data (gpu_sprite_dtype) has one buffer, patched the same way.
+    #
+    # bullet_collection must be instanced and float. After the first
+    # upload its arrays are only current for bullets that have since
+    # respawned; download() brings back the rest. Respawning is
+    # zap_bullets, so there's no support for emitters, nor for behaviors
+    # other than lifetime. Reading back the dead list waits for the GPU
+    # to finish the tick.
+    def __init__(self, bullet_collection, coalesce_gap=16):
+        if bullet_collection.layout != 'instanced' or \
+                bullet_collection.vertex_format != 'float':
+            raise ValueError(
+                "GPU simulation needs an instanced, float collection.")
+        unsupported = sorted(
+            set(bullet_collection.behaviors) - set(['lifetime']))
+        if unsupported:
+            raise ValueError(
+                "GPU simulation doesn't support the %s behaviors." % (
+                    ", ".join(unsupported),))
+        self.bullet_collection = bullet_collection
+        self.coalesce_gap = coalesce_gap
+        capacity = bullet_collection.capacity
+        # CPU copies of what was last uploaded. Only the rows of records
+        # just respawned are current; all of sprites is.
+        self.records = numpy.zeros(capacity, dtype=gpu_bullet_dtype)
+        self.sprites = numpy.zeros(capacity, dtype=gpu_sprite_dtype)
+        self.step_program = make_feedback_shader_program(
+            [(GL_VERTEX_SHADER, gpu_step_vertex_shader)],
+            ['next_center', 'next_angle', 'next_velocity', 'next_lifetime'],
+            uniforms = ['elapsed', 'spin'],
+            attributes = list(gpu_bullet_dtype.names))
+        self.dead_program = make_feedback_shader_program(
+            [(GL_VERTEX_SHADER, gpu_dead_vertex_shader),
+                (GL_GEOMETRY_SHADER, gpu_dead_geometry_shader)],
+            ['dead_index'],
+            uniforms = ['escape_radius'],
+            attributes = ['center', 'lifetime'])
+        self.state_buffers = [
+            DynamicBuffer(GL_ARRAY_BUFFER, self.records.nbytes)
+            for i in range(2)]
+        self.sprite_buffer = DynamicBuffer(
+            GL_ARRAY_BUFFER, self.sprites.nbytes)
+        self.dead_buffer = DynamicBuffer(
+            GL_ARRAY_BUFFER, capacity * numpy.dtype(GLint).itemsize)
+        self.dead_query = int(glGenQueries(1)[0])
+        self.corner_buffer = shared_quad_corners.get()
+        # Vertex arrays for reading each state buffer: to step it, to look
+        # for dead bullets in it and to draw it.
+        self.step_arrays = [VertexArray() for i in range(2)]
+        self.dead_arrays = [VertexArray() for i in range(2)]
+        self.draw_arrays = [VertexArray() for i in range(2)]
+        # Which of state_buffers holds the latest tick.
+        self.current = 0
+        self.upload_bytes = 0
+        self.readback_bytes = 0
+        self.total_upload_bytes = 0
+        self.upload(numpy.arange(bullet_collection.active_count))
+    def upload(self, indices):
+        # Sends the bullets at indices, as they are in bullet_collection,
+        # to the latest state buffer and the sprite buffer.
+        collection = self.bullet_collection
+        records = self.records
+        sprites = self.sprites
+        records['center'][indices] = collection.positions[indices]
+        records['angle'][indices] = collection.angles[indices]
+        records['velocity'][indices] = collection.velocities[indices]
+        lifetimes = collection.behaviors.get('lifetime')
+        records['lifetime'][indices] = \
+            numpy.inf if lifetimes is None else lifetimes[indices]
+        for name in gpu_sprite_dtype.names:
+            sprites[name][indices] = collection.instances[name][indices]
+        dirty = DirtyRanges()
+        dirty.mark_indices(indices)
+        uploaded = 0
+        for buffer, data, spans in (
+                (self.state_buffers[self.current], records, dirty.ranges()),
+                (self.sprite_buffer, sprites,
+                    dirty.ranges(self.coalesce_gap))):
+            buffer.update(data, spans)
+            uploaded += sum(stop - start for start, stop in spans) * \
+                data.dtype.itemsize
+        self.upload_bytes += uploaded
+        self.total_upload_bytes += uploaded
+    def bind_state(self, vertex_array, program, buffer, names):
+        # Points the program's attributes named in names at the fields of
+        # a state buffer.
+        vertex_array.bind()
+        for name, size, type, normalized, stride, offset in \
+                vertex_attribute_pointers(self.records):
+            if name in names:
+                vertex_array.attribute(
+                    getattr(program.attributes, name),
+                    buffer.buffer, size, type, normalized, stride, offset)
+    def advance(self, state, elapsed, expand=True):
+        # Steps the bullets by elapsed seconds, respawns the dead ones and
+        # returns their indices, as advance_simulation. There are no
+        # quads to expand.
+        self.upload_bytes = 0
+        count = self.bullet_collection.active_count
+        source = self.current
+        target = 1 - source
+        gl_state.enable(GL_RASTERIZER_DISCARD)
+        program = self.step_program
+        gl_state.use_program(program.program)
+        gl_state.uniform(glUniform1f, program.uniforms.elapsed, elapsed)
+        gl_state.uniform(glUniform1f, program.uniforms.spin,
+            elapsed * spin_rate)
+        self.bind_state(self.step_arrays[source], program,
+            self.state_buffers[source], gpu_bullet_dtype.names)
+        glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, 0,
+            self.state_buffers[target].buffer)
+        glBeginTransformFeedback(GL_POINTS)
+        glDrawArrays(GL_POINTS, 0, count)
+        glEndTransformFeedback()
+        program = self.dead_program
+        gl_state.use_program(program.program)
+        gl_state.uniform(glUniform1f, program.uniforms.escape_radius,
+            escape_radius)
+        self.bind_state(self.dead_arrays[target], program,
+            self.state_buffers[target], ('center', 'lifetime'))
+        glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, 0,
+            self.dead_buffer.buffer)
+        glBeginQuery(GL_TRANSFORM_FEEDBACK_PRIMITIVES_WRITTEN, self.dead_query)
+        glBeginTransformFeedback(GL_POINTS)
+        glDrawArrays(GL_POINTS, 0, count)
+        glEndTransformFeedback()
+        glEndQuery(GL_TRANSFORM_FEEDBACK_PRIMITIVES_WRITTEN)
+        glBindBufferBase(GL_TRANSFORM_FEEDBACK_BUFFER, 0, 0)
+        gl_state.disable(GL_RASTERIZER_DISCARD)
+        self.current = target
+        dead_count = GLuint()
+        glGetQueryObjectuiv(self.dead_query, GL_QUERY_RESULT, dead_count)
+        if not dead_count.value:
+            return numpy.zeros(0, dtype=numpy.intp)
+        # Points come out of transform feedback in order, so these are
+        # sorted, as from bullets_beyond.
+        dead_bullets = self.read_buffer(
+            self.dead_buffer, GLint, dead_count.value).astype(numpy.intp)
+        self.readback_bytes += dead_count.value * \
+            numpy.dtype(GLint).itemsize
+        zap_bullets(state, dead_bullets)
+        self.upload(dead_bullets)
+        return dead_bullets
+    def read_buffer(self, buffer, dtype, count):
+        # The first count rows of buffer, as an array of dtype.
+        gl_state.bind_buffer(GL_ARRAY_BUFFER, buffer.buffer)
+        # PyOpenGL fills in an array it allocates; handing it one to fill
+        # isn't safe.
+        data = glGetBufferSubData(
+            GL_ARRAY_BUFFER, 0, count * numpy.dtype(dtype).itemsize)
+        return numpy.frombuffer(data, dtype=dtype)
+    def download(self):
+        # Copies the latest tick back into bullet_collection, whose arrays
+        # are then all current, and returns it. Slow: it's for tests and
+        # snapshots.
+        collection = self.bullet_collection
+        count = collection.active_count
+        records = numpy.zeros(0, dtype=gpu_bullet_dtype)
+        if count:
+            records = self.read_buffer(
+                self.state_buffers[self.current], gpu_bullet_dtype, count)
+        collection.positions[:count] = records['center']
+        collection.angles[:count] = records['angle']
+        collection.velocities[:count] = records['velocity']
+        if 'lifetime' in collection.behaviors:
+            collection.behaviors['lifetime'][:count] = records['lifetime']
+        return collection
+    def draw(self, resources, texture=None, blend=alpha_blend):
+        # Draws the latest tick with the instanced bullet program. texture
+        # is a TextureHandle, None meaning the sprite sheet.
+        program = resources.instanced_bullet_program
+        unis = program.uniforms
+        focal_point, zoom = view_transform(resources)
+        if texture is None:
+            texture = resources.textures[2]
+        gl_state.use_program(program.program)
+        gl_state.uniform(glUniform2f, unis.focal_point, *focal_point)
+        gl_state.uniform(glUniform2f, unis.zoom, *zoom)
+        gl_state.bind_texture(GL_TEXTURE_2D, texture.texture, 0)
+        gl_state.uniform(glUniform1i, unis.tex, 0)
+        gl_state.enable(GL_BLEND)
+        gl_state.blend_func(*blend)
+        pointers = [
+            (buffer.buffer,) + pointer
+            for buffer, data in (
+                (self.state_buffers[self.current], self.records),
+                (self.sprite_buffer, self.sprites))
+            for pointer in vertex_attribute_pointers(data)
+            if pointer[0] in instanced_bullet_dtype.names]
+        bind_sprite_attributes(self.draw_arrays[self.current], program,
+            'instanced', pointers, self.corner_buffer)
+        draw_sprites('instanced', self.bullet_collection.active_count)
+
 def update_timer(resources, state):
     milliseconds = pygame.time.get_ticks()
     lasttimer = state.timer
     state.timer = milliseconds * 0.001
-    if not state.paused:
+    if state.scheduler is not None:
+        state.scheduler.paused = state.paused
+        state.scheduler.interpolate(state.bullet_collection)
+    else:
         elapsed = state.timer - lasttimer
-        state.bullet_collection.move_bullets(elapsed)
-        state.bullet_collection.angles += elapsed * 15.0
-        dead_bullets = numpy.nonzero(
-            numpy.sum(
-                numpy.square(
-                    state.bullet_collection.positions
-                ),
-                1
-            )>100
-        )
-        for idx in dead_bullets:
-            zap_bullet(state, idx)
-        state.bullet_collection.update_positions()
-        #state.bullet_collection.eliminate_bullets(dead_bullets)
-        state.bullet_buffers.update_buffers()
+        changed = ()
+        if not state.paused:
+            changed = advance_simulation(state, elapsed)
+        if state.recorder is not None:
+            state.recorder.record(state, elapsed, changed)
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bullet hell demo.")
+    parser.add_argument("--trace",
+        help="write a Chrome trace (chrome://tracing) of the frame phases "
+             "here on exit")
+    parser.add_argument("--overlay", action="store_true",
+        help="draw a graph of recent frame timings")
+    parser.add_argument("--no-gpu-timing", action="store_true",
+        help="don't time the GPU side of uploads and drawing")
+    parser.add_argument("--upload-strategy",
+        choices=StreamingBuffer.strategies, default='orphan',
+        help="how the vertex data is streamed to the GPU each frame "
+             "(default: %(default)s)")
+    parser.add_argument("--vertex-format", choices=vertex_formats,
+        default='float',
+        help="types to upload the bullets as (default: %(default)s)")
+    parser.add_argument("--emitters", action="store_true",
+        help="fire the bullets from pattern emitters instead of a "
+             "random scatter")
+    parser.add_argument("--gpu-simulation", action="store_true",
+        help="step the bullets on the GPU with transform feedback, where "
+             "supported (not with --emitters)")
+    parser.add_argument("--seed", type=int, default=None,
+        help="seed for the random numbers")
+    parser.add_argument("--record", metavar="DIRECTORY",
+        help="record the session here for replay.py; the simulation then "
+             "steps once a frame rather than on its own thread")
+    args = parser.parse_args(argv)
     video_flags = OPENGL|DOUBLEBUF|RESIZABLE
     pygame.init()
-    surface = pygame.display.set_mode((800,600), video_flags)
-    surface = pygame.display.set_mode((800,600), video_flags)
-    resources = make_resources((800,600))
-    state = make_state()
+    viewport_size = (800,600)
+    surface = pygame.display.set_mode(viewport_size, video_flags)
+    surface = pygame.display.set_mode(viewport_size, video_flags)
+    resources = make_resources(viewport_size)
+    sprite_tables = resources.sprite_tables
+    state = make_state(tick_rate=None if args.record else 60.0,
+        upload_strategy=args.upload_strategy,
+        vertex_format=args.vertex_format,
+        bullet_emitters=demo_emitters(sprite_tables) if args.emitters
+            else None,
+        gpu_simulation=args.gpu_simulation, seed=args.seed,
+        sprite_tables=sprite_tables)
+    gpu_simulation = isinstance(state.simulation, GPUSimulation)
+    profiler = FrameProfiler(gpu=not args.no_gpu_timing)
     frames = 0
     done = 0
     ticks = pygame.time.get_ticks()
+    if args.record:
+        # Frames are timed from here on.
+        state.timer = ticks * 0.001
+        state.recorder = Recorder(args.record, state)
     while not done:
-        while 1:
-            event = pygame.event.poll()
-            if event.type == NOEVENT:
-                break
-            if event.type == VIDEORESIZE:
-                surface = pygame.display.set_mode(event.size, video_flags)
-                glViewport(0,0,event.w,event.h)
-                resources.aspect_ratio = (1.0 * event.w) / event.h
-            if event.type == KEYDOWN:
-                if event.key == K_ESCAPE:
+        profiler.begin_frame()
+        with profiler.phase("events"):
+            while 1:
+                event = pygame.event.poll()
+                if event.type == NOEVENT:
+                    break
+                if event.type == VIDEORESIZE:
+                    surface = pygame.display.set_mode(event.size, video_flags)
+                    glViewport(0,0,event.w,event.h)
+                    resources.aspect_ratio = (1.0 * event.w) / event.h
+                    viewport_size = event.size
+                if event.type == KEYDOWN:
+                    if event.key == K_ESCAPE:
+                        done = 1
+                    elif event.key == K_SPACE:
+                        state.paused = not state.paused
+                if event.type == QUIT:
                     done = 1
-                elif event.key == K_SPACE:
-                    state.paused = not state.paused
-            if event.type == QUIT:
-                done = 1
-        update_timer(resources, state)
-        render(resources, state)
+        with profiler.phase("simulation", gpu=gpu_simulation):
+            update_timer(resources, state)
+        with profiler.phase("upload", gpu=True):
+            state.renderer.prepare(resources, state.layers)
+            resources.texture_loader.update()
+        with profiler.phase("draw", gpu=True):
+            render(resources, state)
+            if args.overlay:
+                profiler.draw_overlay(viewport_size)
+        with profiler.phase("flip"):
+            pygame.display.flip()
+        gl_state.end_frame()
+        profiler.end_frame()
+        if not frames:
+            # Milliseconds since pygame.init, which includes compiling (or
+            # loading from the program cache) every shader.
+            print("first frame: %d ms" % pygame.time.get_ticks())
         #if state.timer > 15.0:
         #    done = 1
         frames += 1
-    print "fps:  %d" % ((frames*1000)/(pygame.time.get_ticks()-ticks))
+    if state.scheduler is not None:
+        state.scheduler.stop()
+    if state.recorder is not None:
+        state.recorder.close()
+    resources.texture_loader.close()
+    print("fps:  %d" % ((frames*1000)/(pygame.time.get_ticks()-ticks)))
+    print("gl calls per frame: %d issued, %d skipped" % (
+        gl_state.total_issued // max(frames, 1),
+        gl_state.total_skipped // max(frames, 1)))
+    print("draw calls per frame: %.1f for %.1f layers" % (
+        float(state.renderer.total_draw_calls) / max(frames, 1),
+        float(state.renderer.total_layers) / max(frames, 1)))
+    if gpu_simulation:
+        print("gpu simulation: %d bytes uploaded, %d read back per frame" % (
+            state.simulation.total_upload_bytes // max(frames, 1),
+            state.simulation.readback_bytes // max(frames, 1)))
+    print(profiler.report())
+    if args.trace:
+        profiler.write_chrome_trace(args.trace)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,213 @@
+# Bullet pattern emitters. An Emitter describes a pattern declaratively:
+# where it fires from, how often, how many shots each volley and in which
+# directions, and how fast. An EmitterSet steps any number of them and
+# writes every bullet they fire in a step into a BulletCollection with a
+# single spawn_many, working on whole volleys at a time with numpy so
+# that nothing is done per bullet in Python.
+#
+#     emitters = EmitterSet([
+#         Emitter('spiral', rate=30, count=3, angular_velocity=2.0),
+#         Emitter('aimed', position=(0, 8), rate=2, count=5,
+#             target=(0, -8)),
+#         ])
+#     spawned = emitters.emit(bullet_collection, elapsed)
+#
+# Patterns, each volley being count shots:
+#
+#     ring    evenly spaced all the way round
+#     spiral  a ring whose direction turns at angular_velocity
+#     fan     spread radians wide, centered on the emitter's direction
+#     aimed   a fan centered on the direction to target
+#     burst   scattered at random across spread, speeds varied by
+#             speed_spread
+#
+# A volley's direction is angle + angular_velocity * t, t being seconds
+# on the emitter's clock, which starts when it's added to the set. Volleys
+# go off at phase + k / rate for k = 0, 1, ... until duration runs out.
+# speed is a number or a curve of (t, speed) keys, interpolated linearly
+# and held beyond the ends. Each bullet starts where it would have got to
+# had it been fired at exactly its volley's time, so fast streams stay
+# evenly spaced whatever the step length.
+#
+# position and target may be changed between steps to move or re-aim an
+# emitter. sprite_id indexes the sprite_tables of the collection fired
+# into.
+# behaviors is a dict of BulletCollection behavior channels given to
+# every bullet fired, e.g. {'drag': 0.5, 'lifetime': 4.0}.
+
+import math
+
+import numpy
+
+# Per pattern: (count, spread, angular_velocity) used when not given.
+pattern_defaults = {
+    'ring':   (16, 2.0 * math.pi, 0.0),
+    'spiral': (4, 2.0 * math.pi, 1.5),
+    'fan':    (5, math.pi / 3.0, 0.0),
+    'aimed':  (3, math.pi / 8.0, 0.0),
+    'burst':  (24, 2.0 * math.pi, 0.0),
+    }
+
+def evaluate_curve(curve, times):
+    # curve at each of times: a constant, or a sequence of (time, value)
+    # keys in time order.
+    if numpy.ndim(curve) == 0:
+        return numpy.full(len(times), float(curve))
+    keys = numpy.asarray(curve, dtype=numpy.float64).reshape(-1, 2)
+    return numpy.interp(times, keys[:,0], keys[:,1])
+
+class Emitter(object):
+    def __init__(self, pattern, position=(0.0, 0.0), rate=10.0, count=None,
+            speed=4.0, angle=0.0, angular_velocity=None, spread=None,
+            phase=0.0, duration=None, target=(0.0, 0.0), speed_spread=0.0,
+            sprite_id=0, size=1.0, color=(255, 255, 255, 255),
+            behaviors=None):
+        if pattern not in pattern_defaults:
+            raise ValueError("Unknown emitter pattern %r." % (pattern,))
+        default_count, default_spread, default_angular_velocity = \
+            pattern_defaults[pattern]
+        self.pattern = pattern
+        self.position = position
+        self.rate = float(rate)
+        self.count = default_count if count is None else int(count)
+        self.speed = speed
+        self.angle = angle
+        self.angular_velocity = default_angular_velocity \
+            if angular_velocity is None else angular_velocity
+        self.spread = default_spread if spread is None else spread
+        self.phase = phase
+        self.duration = duration
+        self.target = target
+        self.speed_spread = speed_spread
+        self.sprite_id = sprite_id
+        self.size = size
+        self.color = color
+        self.behaviors = behaviors or {}
+        # Set by EmitterSet.add: when, on the set's clock, this one's
+        # clock reads zero.
+        self.started = 0.0
+    def volleys(self, start, stop):
+        # The times, on the emitter's clock, of the volleys due in
+        # [start, stop).
+        if self.rate <= 0.0 or self.count <= 0:
+            return numpy.zeros(0)
+        first = max(0, int(math.ceil((start - self.phase) * self.rate)))
+        last = int(math.ceil((stop - self.phase) * self.rate))
+        if self.duration is not None:
+            last = min(last, int(math.ceil(self.duration * self.rate)))
+        return self.phase + numpy.arange(first, max(first, last)) / self.rate
+    def directions(self, times, rng):
+        # (volleys, count) directions of travel of each volley's shots.
+        base = self.angle + self.angular_velocity * times
+        if self.pattern == 'aimed':
+            base += math.atan2(
+                self.target[1] - self.position[1],
+                self.target[0] - self.position[0])
+        if self.pattern in ('ring', 'spiral'):
+            offsets = numpy.arange(self.count) * (self.spread / self.count)
+        elif self.pattern == 'burst':
+            offsets = rng.uniform(
+                -0.5 * self.spread, 0.5 * self.spread,
+                (len(times), self.count))
+        elif self.count > 1:
+            offsets = numpy.linspace(
+                -0.5 * self.spread, 0.5 * self.spread, self.count)
+        else:
+            offsets = numpy.zeros(1)
+        return base[:,numpy.newaxis] + offsets
+    def speeds(self, times, rng):
+        # (volleys, count) speeds of each volley's shots.
+        speeds = numpy.repeat(
+            evaluate_curve(self.speed, times)[:,numpy.newaxis],
+            self.count, axis=1)
+        if self.speed_spread:
+            speeds *= rng.uniform(
+                1.0 - self.speed_spread, 1.0 + self.speed_spread,
+                speeds.shape)
+        return speeds
+
+class EmitterSet(object):
+    # Steps a group of emitters together. rng is a numpy Generator or
+    # RandomState for the burst pattern. spawned and dropped count the
+    # bullets fired, and those that didn't fit in the collection.
+    def __init__(self, emitters=(), rng=None):
+        self.rng = numpy.random.RandomState() if rng is None else rng
+        self.time = 0.0
+        self.emitters = []
+        self.spawned = 0
+        self.dropped = 0
+        for emitter in emitters:
+            self.add(emitter)
+    def add(self, emitter):
+        emitter.started = self.time
+        self.emitters.append(emitter)
+        return emitter
+    def remove(self, emitter):
+        self.emitters.remove(emitter)
+    def emit(self, bullet_collection, elapsed):
+        # Fires every volley due in the next elapsed seconds into the
+        # collection's free slots and returns the indices written.
+        start = self.time
+        stop = self.time = start + elapsed
+        due = []
+        total = 0
+        for emitter in self.emitters:
+            times = emitter.volleys(
+                start - emitter.started, stop - emitter.started)
+            if len(times):
+                due.append((emitter, times))
+                total += len(times) * emitter.count
+        free = bullet_collection.capacity - bullet_collection.active_count
+        if total > free:
+            self.dropped += total - free
+        if not total or not free:
+            return numpy.zeros(0, dtype=numpy.intp)
+        x = numpy.empty(total)
+        y = numpy.empty(total)
+        angles = numpy.empty(total)
+        vx = numpy.empty(total)
+        vy = numpy.empty(total)
+        sizes = numpy.empty(total)
+        sprite_ids = numpy.empty(total, dtype=numpy.intp)
+        colors = numpy.empty((total, 4), dtype=numpy.uint8)
+        end = 0
+        for emitter, times in due:
+            part = slice(end, end + len(times) * emitter.count)
+            end = part.stop
+            directions = emitter.directions(times, self.rng).ravel()
+            speeds = emitter.speeds(times, self.rng).ravel()
+            # How long each shot has been flying by the end of the step.
+            ages = numpy.repeat(
+                stop - emitter.started - times, emitter.count)
+            numpy.cos(directions, vx[part])
+            numpy.sin(directions, vy[part])
+            vx[part] *= speeds
+            vy[part] *= speeds
+            x[part] = emitter.position[0] + vx[part] * ages
+            y[part] = emitter.position[1] + vy[part] * ages
+            # Sprites point up their direction of travel.
+            angles[part] = directions - 0.5 * math.pi
+            sizes[part] = emitter.size
+            sprite_ids[part] = emitter.sprite_id
+            colors[part] = emitter.color
+        count = min(total, free)
+        self.spawned += count
+        indices = bullet_collection.spawn_many(
+            None,
+            x[:count], y[:count],
+            sizes[:count], sizes[:count],
+            angles[:count],
+            vx[:count], vy[:count],
+            sprite_ids[:count],
+            colors[:count])
+        # Behaviors go on one emitter's share of the bullets at a time.
+        end = 0
+        for emitter, times in due:
+            part = slice(end, min(count, end + len(times) * emitter.count))
+            end += len(times) * emitter.count
+            if emitter.behaviors and part.start < part.stop:
+                first = indices[0]
+                bullet_collection.set_behaviors(
+                    slice(first + part.start, first + part.stop),
+                    **emitter.behaviors)
+        return indices
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+# Checks GPUSimulation against the CPU simulation it stands in for.
+#
+# Two simulation states are made from the same seed. One steps on the
+# CPU, the other through a GPUSimulation, with the same timesteps. Each
+# tick the dead lists must match exactly. Every --check-every ticks the
+# GPU bullets are downloaded and their positions, angles and velocities
+# compared with the CPU ones. The run is repeated with per-bullet
+# lifetimes, so the GPU's lifetime test is covered as well.
+#
+#     python gpu_check.py
+#     python gpu_check.py --egl    # no display: Mesa's surfaceless EGL
+#
+# Software rasterizers such as llvmpipe match bit for bit. Drivers that
+# fuse the multiply-add may drift by an ulp or so, which --tolerance
+# allows for. Results go to stdout as JSON, like benchmark.py, and the
+# exit status is 1 if any check failed.
+
+import argparse
+import ctypes
+import json
+import os
+import sys
+
+import numpy
+
+# bullets imports pygame, whose banner would otherwise end up in the
+# JSON on stdout.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+timestep = 1.0 / 60.0
+
+def make_egl_context():
+    # A context with no window or display at all, for headless machines.
+    # PyOpenGL picks its platform on first import, so this has to run
+    # before anything imports OpenGL.
+    os.environ["PYOPENGL_PLATFORM"] = "egl"
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+    from OpenGL import EGL
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(
+            display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError("Couldn't initialize EGL.")
+    attributes = (EGL.EGLint * 5)(
+        EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+        EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT,
+        EGL.EGL_NONE)
+    config = EGL.EGLConfig()
+    configs = EGL.EGLint()
+    EGL.eglChooseConfig(display, attributes, ctypes.pointer(config), 1,
+        ctypes.pointer(configs))
+    if not configs.value:
+        raise RuntimeError("No EGL config for desktop OpenGL.")
+    size = (EGL.EGLint * 5)(EGL.EGL_WIDTH, 16, EGL.EGL_HEIGHT, 16,
+        EGL.EGL_NONE)
+    surface = EGL.eglCreatePbufferSurface(display, config, size)
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context = EGL.eglCreateContext(display, config, EGL.EGL_NO_CONTEXT, None)
+    EGL.eglMakeCurrent(display, surface, surface, context)
+
+def make_window_context():
+    import pygame
+    from pygame.locals import OPENGL, HIDDEN
+    pygame.init()
+    pygame.display.set_mode((16, 16), OPENGL | HIDDEN)
+
+def check(bullets, count, ticks, seed, lifetimes, check_every, tolerance):
+    states = [
+        bullets.make_simulation_state(count, seed=seed, layout='instanced')
+        for i in range(2)]
+    if lifetimes:
+        for state in states:
+            state.bullet_collection.set_behaviors(slice(0, count),
+                lifetime=numpy.linspace(0.05, 2.0, count))
+    cpu, gpu = states
+    gpu.simulation = bullets.GPUSimulation(gpu.bullet_collection)
+    dead = 0
+    first_failure = None
+    worst = dict((name, 0.0) for name in ("center", "angle", "velocity"))
+    for tick in range(1, ticks + 1):
+        cpu_dead = bullets.advance_simulation(cpu, timestep)
+        gpu_dead = bullets.advance_simulation(gpu, timestep)
+        dead += len(cpu_dead)
+        failure = None
+        if not numpy.array_equal(cpu_dead, gpu_dead):
+            failure = "dead bullets"
+        elif tick % check_every == 0 or tick == ticks:
+            expected = cpu.bullet_collection
+            actual = gpu.simulation.download()
+            live = slice(0, expected.active_count)
+            for name, array in (
+                    ("center", "positions"),
+                    ("angle", "angles"),
+                    ("velocity", "velocities")):
+                error = float(numpy.abs(
+                    getattr(actual, array)[live].astype(numpy.float64) -
+                    getattr(expected, array)[live]).max())
+                worst[name] = max(worst[name], error)
+                if error > tolerance and failure is None:
+                    failure = name
+        if failure is not None and first_failure is None:
+            first_failure = {"tick": tick, "reason": failure}
+    return {
+        "bullets": count,
+        "ticks": ticks,
+        "lifetimes": lifetimes,
+        "dead_bullets": dead,
+        "upload_bytes": gpu.simulation.total_upload_bytes,
+        "readback_bytes": gpu.simulation.readback_bytes,
+        "max_error": worst,
+        "first_failure": first_failure,
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+        "Compare the GPU bullet simulation with the CPU one.")
+    parser.add_argument("--egl", action="store_true",
+        help="use a surfaceless EGL context instead of a hidden window")
+    parser.add_argument("--bullets", type=int, default=2000,
+        help="bullets to simulate (default: %(default)s)")
+    parser.add_argument("--ticks", type=int, default=300,
+        help="ticks to step (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--check-every", type=int, default=10,
+        help="compare the whole state every this many ticks "
+             "(default: %(default)s)")
+    parser.add_argument("--tolerance", type=float, default=0.0,
+        help="largest acceptable difference in any value "
+             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+    if args.egl:
+        make_egl_context()
+    else:
+        make_window_context()
+    # Only now that there's a context, on the right platform.
+    import bullets
+    from ogl_helpers import transform_feedback_supported
+    if not transform_feedback_supported():
+        sys.stderr.write("Transform feedback isn't supported here.\n")
+        sys.exit(2)
+    results = [
+        check(bullets, args.bullets, args.ticks, args.seed, lifetimes,
+            args.check_every, args.tolerance)
+        for lifetimes in (False, True)]
+    sys.stdout.write(json.dumps(results, indent=2, sort_keys=True) + "\n")
+    if any(result["first_failure"] for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,8 @@ from pygame.locals import *
 import numpy
 import math
 import sys
+import argparse
+from profiler import FrameProfiler
 
 def render(resources):
     glClearColor(0.1, 0.1, 0.1, 1.0)
@@ -39,7 +41,6 @@ def render(resources):
         GL_UNSIGNED_SHORT,
         None)
     glDisableVertexAttribArray(resources.attributes.position)
-    pygame.display.flip()
 
 def make_buffer(target, buffer_data, size):
     buffer = glGenBuffers(1)
@@ -272,8 +273,8 @@ def make_shader(type, source):
     retval = ctypes.c_uint()
     glGetShaderiv(shader, GL_COMPILE_STATUS, retval)
     if not retval:
-        print >> sys.stderr, "Failed to compile shader."
-        print >> sys.stderr, glGetShaderInfoLog(shader)
+        sys.stderr.write("Failed to compile shader.\n")
+        sys.stderr.write("%s\n" % (glGetShaderInfoLog(shader),))
         glDeleteShader(shader)
         raise Exception("Failed to compile shader.")
     return shader
@@ -283,7 +284,7 @@ def show_info_log(object, getiv, getinfolog):
     getiv(object, GL_INFO_LOG_LENGTH, log_length)
     log = ctypes.create_string_buffer(log_length)
     getinfolog(object, log_length, None, log)
-    print >> sys.stderr, log
+    sys.stderr.write("%s\n" % (log,))
 
 def make_program(vertex_shader, fragment_shader):
     program = glCreateProgram()
@@ -293,8 +294,8 @@ def make_program(vertex_shader, fragment_shader):
     retval = ctypes.c_int()
     glGetProgramiv(program, GL_LINK_STATUS, retval)
     if not retval:
-        print >> sys.stderr, "Failed to link shader program."
-        print >> sys.stderr, glGetProgramInfoLog(program)
+        sys.stderr.write("Failed to link shader program.\n")
+        sys.stderr.write("%s\n" % (glGetProgramInfoLog(program),))
         glDeleteProgram(program)
         raise Exception("Failed to link shader program.")
     return program
@@ -303,27 +304,48 @@ def update_timer(resources):
     milliseconds = pygame.time.get_ticks()
     resources.timer = milliseconds * 0.001
 
-def main():
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--trace",
+        help="write a Chrome trace of the frame phases here on exit")
+    parser.add_argument("--overlay", action="store_true",
+        help="draw a graph of recent frame timings")
+    parser.add_argument("--no-gpu-timing", action="store_true",
+        help="don't time the GPU side of drawing")
+    args = parser.parse_args(argv)
     video_flags = OPENGL|DOUBLEBUF
     pygame.init()
     surface = pygame.display.set_mode((640,480), video_flags)
     resources = make_resources()
+    profiler = FrameProfiler(gpu=not args.no_gpu_timing)
     frames = 0
     done = 0
     ticks = pygame.time.get_ticks()
     while not done:
-        while 1:
-            event = pygame.event.poll()
-            if event.type == NOEVENT:
-                break
-            if event.type == KEYDOWN:
-                pass
-            if event.type == QUIT:
-                done = 1
-        update_timer(resources)
-        render(resources)
+        profiler.begin_frame()
+        with profiler.phase("events"):
+            while 1:
+                event = pygame.event.poll()
+                if event.type == NOEVENT:
+                    break
+                if event.type == KEYDOWN:
+                    pass
+                if event.type == QUIT:
+                    done = 1
+        with profiler.phase("simulation"):
+            update_timer(resources)
+        with profiler.phase("draw", gpu=True):
+            render(resources)
+            if args.overlay:
+                profiler.draw_overlay((640,480))
+        with profiler.phase("flip"):
+            pygame.display.flip()
+        profiler.end_frame()
         frames += 1
-    print "fps:  %d" % ((frames*1000)/(pygame.time.get_ticks()-ticks))
+    print("fps:  %d" % ((frames*1000)/(pygame.time.get_ticks()-ticks)))
+    print(profiler.report())
+    if args.trace:
+        profiler.write_chrome_trace(args.trace)
 
 if __name__ == '__main__':
     main()
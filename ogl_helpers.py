@@ -4,15 +4,195 @@
 
 from OpenGL.GL import *
 from OpenGL.GLU import gluBuild2DMipmaps
+from OpenGL.GL.EXT.texture_compression_s3tc import \
+    glInitTextureCompressionS3TcEXT
+from OpenGL.raw.GL.VERSION.GL_1_0 import \
+    glTexImage2D as raw_glTexImage2D
+from OpenGL.raw.GL.VERSION.GL_1_3 import \
+    glCompressedTexImage2D as raw_glCompressedTexImage2D
+from OpenGL.error import GLError
 import pygame, pygame.image, pygame.key
 from pygame.locals import *
 import numpy
 import math
 import sys
+import os
+import hashlib
+import struct
+import timeit
+import collections
+from multiprocessing.pool import ThreadPool
+import texture_assets
+
+class GLState(object):
+    # Shadows the GL state that draw code sets over and over (the bound
+    # program, textures, buffers and vertex array, enabled capabilities,
+    # the blend function and uniform values) and skips calls that would
+    # set something to what it already is. It only knows what went
+    # through it, so call invalidate() after changing any of these
+    # behind its back.
+    #
+    # issued and skipped count calls since the last end_frame();
+    # frame_issued and frame_skipped hold the counts for the last frame.
+    def __init__(self):
+        self.invalidate()
+        self.issued = self.skipped = 0
+        self.frame_issued = self.frame_skipped = 0
+        self.total_issued = self.total_skipped = 0
+    def invalidate(self):
+        self.program = None
+        self.active_unit = None
+        self.textures = {}
+        self.buffers = {}
+        self.vertex_array = None
+        self.capabilities = {}
+        self.blend = None
+        self.uniforms = {}
+    def changed(self, cache, key, value):
+        # Records value under key, returning whether it differs from
+        # what was there; counts the call either way.
+        if key in cache and cache[key] == value:
+            self.skipped += 1
+            return False
+        cache[key] = value
+        self.issued += 1
+        return True
+    def use_program(self, program):
+        if self.program != program:
+            glUseProgram(program)
+            self.program = program
+            self.issued += 1
+        else:
+            self.skipped += 1
+    def active_texture(self, unit):
+        # unit is an index: 0 for GL_TEXTURE0 and so on.
+        if self.active_unit != unit:
+            glActiveTexture(GL_TEXTURE0 + unit)
+            self.active_unit = unit
+            self.issued += 1
+        else:
+            self.skipped += 1
+    def bind_texture(self, target, texture, unit=None):
+        # Binds to the given texture unit, or the active one if None.
+        if unit is not None:
+            self.active_texture(unit)
+        if self.changed(self.textures, (self.active_unit, target), texture):
+            glBindTexture(target, texture)
+    def bind_buffer(self, target, buffer):
+        if self.changed(self.buffers, target, buffer):
+            glBindBuffer(target, buffer)
+    def bind_vertex_array(self, vertex_array):
+        if self.vertex_array != vertex_array:
+            glBindVertexArray(vertex_array)
+            self.vertex_array = vertex_array
+            # The element array binding belongs to the vertex array.
+            self.buffers.pop(GL_ELEMENT_ARRAY_BUFFER, None)
+            self.issued += 1
+        else:
+            self.skipped += 1
+    def enable(self, capability):
+        if self.changed(self.capabilities, capability, True):
+            glEnable(capability)
+    def disable(self, capability):
+        if self.changed(self.capabilities, capability, False):
+            glDisable(capability)
+    def blend_func(self, source, destination):
+        if self.blend != (source, destination):
+            glBlendFunc(source, destination)
+            self.blend = (source, destination)
+            self.issued += 1
+        else:
+            self.skipped += 1
+    def uniform(self, function, location, *values):
+        # Sets a uniform of the current program with function, one of the
+        # glUniform* calls taking values directly.
+        if self.changed(self.uniforms, (self.program, location),
+                (function, values)):
+            function(location, *values)
+    def end_frame(self):
+        self.frame_issued, self.frame_skipped = self.issued, self.skipped
+        self.total_issued += self.issued
+        self.total_skipped += self.skipped
+        self.issued = self.skipped = 0
+
+# The state of the one context these helpers draw into.
+gl_state = GLState()
+
+def vertex_arrays_supported():
+    # GL 3.0 or ARB_vertex_array_object. Needs a current context.
+    return bool(glGenVertexArrays) and bool(glBindVertexArray)
+
+class VertexArray(object):
+    # A vertex array object, remembering the attribute pointers and
+    # element buffer recorded in it so that setting them again is free.
+    # Pointers whose offset moves (streamed buffers) are just set again.
+    #
+    # Without vertex array objects everything shares the default one, so
+    # a VertexArray takes it over when bound, disabling the previous
+    # owner's attributes (and divisors) and forgetting its own record.
+    owner = None
+    def __init__(self, state=gl_state):
+        self.state = state
+        self.supported = vertex_arrays_supported()
+        self.name = glGenVertexArrays(1) if self.supported else 0
+        self.pointers = {}
+        self.elements = None
+    def bind(self):
+        if self.supported:
+            self.state.bind_vertex_array(self.name)
+            return
+        previous = VertexArray.owner
+        if previous is not self:
+            if previous is not None:
+                for location, (pointer, divisor) in previous.pointers.items():
+                    glDisableVertexAttribArray(location)
+                    if divisor:
+                        glVertexAttribDivisor(location, 0)
+                previous.pointers = {}
+                previous.elements = None
+            VertexArray.owner = self
+            self.pointers = {}
+            self.elements = None
+    def attribute(self, location, buffer, size, type, normalized, stride,
+            offset, divisor=0):
+        # Sets up generic attribute location to read from buffer, as
+        # glVertexAttribPointer; divisor as glVertexAttribDivisor.
+        pointer = (buffer, size, type, normalized, stride, offset)
+        previous = self.pointers.get(location)
+        if previous is not None and previous[0] == pointer:
+            self.state.skipped += 1
+        else:
+            self.state.bind_buffer(GL_ARRAY_BUFFER, buffer)
+            glVertexAttribPointer(
+                location,
+                size,
+                type,
+                normalized,
+                stride,
+                ctypes.c_void_p(offset) if offset else None)
+            self.state.issued += 1
+            if previous is None:
+                glEnableVertexAttribArray(location)
+                self.state.issued += 1
+        if divisor != (previous[1] if previous is not None else 0):
+            glVertexAttribDivisor(location, divisor)
+            self.state.issued += 1
+        self.pointers[location] = (pointer, divisor)
+    def element_buffer(self, buffer):
+        if not self.supported:
+            self.state.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, buffer)
+            return
+        if self.elements != buffer:
+            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, buffer)
+            self.elements = buffer
+            self.state.issued += 1
+        else:
+            self.state.skipped += 1
+        self.state.buffers[GL_ELEMENT_ARRAY_BUFFER] = buffer
 
 def make_buffer(target, buffer_data, size):
     buffer = glGenBuffers(1)
-    glBindBuffer(target, buffer)
+    gl_state.bind_buffer(target, buffer)
     glBufferData(target, size, buffer_data, GL_STATIC_DRAW)
     return buffer
 
@@ -29,12 +209,40 @@ def float_array_buffer(*args):
         array,
         array.nbytes)
 
-def short_element_buffer(*args):
-    array = short_array(*args)
-    return make_buffer(
-        GL_ELEMENT_ARRAY_BUFFER,
-        array,
-        array.nbytes)
+gl_types = {
+    numpy.dtype(GLfloat): GL_FLOAT,
+    numpy.dtype(numpy.float16): GL_HALF_FLOAT,
+    numpy.dtype(GLbyte): GL_BYTE,
+    numpy.dtype(GLubyte): GL_UNSIGNED_BYTE,
+    numpy.dtype(GLshort): GL_SHORT,
+    numpy.dtype(GLushort): GL_UNSIGNED_SHORT,
+    numpy.dtype(GLint): GL_INT,
+    numpy.dtype(GLuint): GL_UNSIGNED_INT,
+    }
+
+def vertex_attribute_pointers(array, name=None):
+    # Works out the glVertexAttribPointer arguments for the vertex data in
+    # array, as (name, size, type, normalized, stride, offset) tuples.
+    # A record array gives one attribute per field, all sharing the record
+    # stride. A plain array is a single attribute called name, one vertex
+    # per element of its last axis. Integer data is normalized.
+    dtype = array.dtype
+    if dtype.names is None:
+        fields = [(name, dtype, array.shape[-1], 0)]
+        stride = dtype.itemsize * array.shape[-1]
+    else:
+        fields = []
+        for field in dtype.names:
+            field_dtype, offset = dtype.fields[field][:2]
+            base = field_dtype.base
+            size = int(numpy.prod(field_dtype.shape)) if field_dtype.shape else 1
+            fields.append((field, base, size, offset))
+        stride = dtype.itemsize
+    return [
+        (field, size, gl_types[base],
+            GL_FALSE if base.kind == 'f' else GL_TRUE,
+            stride, offset)
+        for field, base, size, offset in fields]
 
 def translation_matrix(x,y,z):
     return numpy.matrix(
@@ -48,7 +256,7 @@ def make_texture(filename, mipmaps=False):
     image = pygame.image.load(filename)
     pixels = pygame.image.tostring(image, "RGBA", True)
     texture=glGenTextures(1)
-    glBindTexture(GL_TEXTURE_2D, texture)
+    gl_state.bind_texture(GL_TEXTURE_2D, texture)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
         GL_LINEAR_MIPMAP_LINEAR if mipmaps else GL_LINEAR)
     glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
@@ -71,6 +279,162 @@ def make_texture(filename, mipmaps=False):
             pixels)
     return texture
 
+def s3tc_supported():
+    # Needs a current context.
+    return bool(glInitTextureCompressionS3TcEXT())
+
+def texture_asset_path(filename):
+    # The baked version of filename (the same name ending .btex) if there
+    # is one at least as new as it, otherwise filename itself.
+    baked = os.path.splitext(filename)[0] + ".btex"
+    if os.path.exists(baked) and (not os.path.exists(filename) or
+            os.path.getmtime(baked) >= os.path.getmtime(filename)):
+        return baked
+    return filename
+
+def decode_texture(filename, mipmaps=False):
+    # The GL internal format and (width, height, data) levels for an
+    # image or baked texture, largest first. Touches no GL, so it can run
+    # on any thread.
+    path = texture_asset_path(filename)
+    if path.endswith(".btex"):
+        return texture_assets.read_texture(path)
+    pixels = texture_assets.load_pixels(path)
+    levels = texture_assets.mip_chain(pixels) if mipmaps else [pixels]
+    return GL_RGBA8, [
+        (level.shape[1], level.shape[0], level.reshape(-1))
+        for level in levels]
+
+class TextureHandle(object):
+    # Stands for a texture that may still be loading. texture is always
+    # something that can be bound: the loader's placeholder until every
+    # level has been uploaded, then the real thing.
+    def __init__(self, filename, texture):
+        self.filename = filename
+        self.texture = texture
+        self.ready = False
+        self.error = None
+
+class TextureLoader(object):
+    # Loads textures without stalling the frame. Images are decoded (and
+    # mipmapped) on a pool of worker threads; update(), called once a
+    # frame on the GL thread, then uploads the decoded levels through a
+    # pixel unpack buffer, stopping for the frame once budget_bytes or
+    # budget_seconds have been spent. At least one level goes up each
+    # frame, however big.
+    #
+    # load() returns a TextureHandle straight away, showing a 1x1
+    # texture of placeholder_color until the real one is complete.
+    def __init__(self, workers=2, budget_bytes=4*1024*1024,
+            budget_seconds=0.002, placeholder_color=(0, 0, 0, 0)):
+        self.budget_bytes = budget_bytes
+        self.budget_seconds = budget_seconds
+        self.pool = ThreadPool(workers)
+        self.handles = {}
+        self.decoding = []
+        self.uploads = collections.deque()
+        self.pixel_buffer = StreamingBuffer(
+            GL_PIXEL_UNPACK_BUFFER, budget_bytes)
+        gl_state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.placeholder = glGenTextures(1)
+        gl_state.bind_texture(GL_TEXTURE_2D, self.placeholder)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glTexImage2D(
+            GL_TEXTURE_2D, 0,
+            GL_RGBA8,
+            1, 1, 0,
+            GL_RGBA, GL_UNSIGNED_BYTE,
+            numpy.array(placeholder_color, dtype=numpy.uint8))
+        # Bytes uploaded by the last update, for profiling.
+        self.uploaded_bytes = 0
+    def load(self, filename, mipmaps=False):
+        key = (filename, mipmaps)
+        handle = self.handles.get(key)
+        if handle is None:
+            handle = self.handles[key] = TextureHandle(
+                filename, self.placeholder)
+            self.decoding.append((handle, self.pool.apply_async(
+                decode_texture, (filename, mipmaps))))
+        return handle
+    def pending(self):
+        return len(self.decoding) + len(self.uploads)
+    def update(self):
+        start = timeit.default_timer()
+        still_decoding = []
+        for handle, result in self.decoding:
+            if not result.ready():
+                still_decoding.append((handle, result))
+                continue
+            try:
+                texture_format, levels = result.get()
+                if texture_format != GL_RGBA8 and not s3tc_supported():
+                    raise Exception(
+                        "it is S3TC compressed, which this driver doesn't "
+                        "support")
+            except Exception as error:
+                handle.error = error
+                sys.stderr.write(
+                    "Failed to load %s: %s\n" % (handle.filename, error))
+                continue
+            self.uploads.append([handle, texture_format, levels, None, 0])
+        self.decoding = still_decoding
+        uploaded = 0
+        while self.uploads:
+            upload = self.uploads[0]
+            handle, texture_format, levels, texture, level = upload
+            width, height, data = levels[level]
+            if uploaded and (
+                    uploaded + data.nbytes > self.budget_bytes or
+                    timeit.default_timer() - start > self.budget_seconds):
+                break
+            if texture is None:
+                texture = upload[3] = self.make_texture(len(levels))
+            self.upload_level(texture, texture_format, level, width, height, data)
+            uploaded += data.nbytes
+            upload[4] = level = level + 1
+            if level == len(levels):
+                handle.texture = texture
+                handle.ready = True
+                self.uploads.popleft()
+        if uploaded:
+            self.pixel_buffer.end_frame()
+        gl_state.bind_buffer(GL_PIXEL_UNPACK_BUFFER, 0)
+        self.uploaded_bytes = uploaded
+    def make_texture(self, level_count):
+        texture = glGenTextures(1)
+        gl_state.bind_texture(GL_TEXTURE_2D, texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER,
+            GL_LINEAR_MIPMAP_LINEAR if level_count > 1 else GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAX_LEVEL, level_count - 1)
+        return texture
+    def upload_level(self, texture, texture_format, level, width, height,
+            data):
+        # The data goes into the pixel buffer, and GL copies it into the
+        # texture from there in its own time; the offset is passed in
+        # place of a pointer.
+        offset = ctypes.c_void_p(self.pixel_buffer.upload(data))
+        gl_state.bind_texture(GL_TEXTURE_2D, texture)
+        if texture_format == GL_RGBA8:
+            raw_glTexImage2D(
+                GL_TEXTURE_2D, level,
+                GL_RGBA8,
+                width, height, 0,
+                GL_RGBA, GL_UNSIGNED_BYTE,
+                offset)
+        else:
+            raw_glCompressedTexImage2D(
+                GL_TEXTURE_2D, level,
+                texture_format,
+                width, height, 0,
+                data.nbytes, offset)
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
 def make_shader(type, source):
     shader = glCreateShader(type)
     glShaderSource(shader, source)
@@ -78,7 +442,7 @@ def make_shader(type, source):
     retval = ctypes.c_uint()
     glGetShaderiv(shader, GL_COMPILE_STATUS, retval)
     if not retval:
-        print >> sys.stderr, "Failed to compile shader."
+        sys.stderr.write("Failed to compile shader.\n")
         show_info_log(shader, glGetShaderiv, glGetShaderInfoLog)
         glDeleteShader(shader)
         raise Exception("Failed to compile shader.")
@@ -90,20 +454,488 @@ def show_info_log(object, getiv, getinfolog):
     log = ctypes.create_string_buffer(log_length.value)
     #getinfolog(object, log_length, None, log)
     log = getinfolog(object)
-    print >> sys.stderr, log
+    sys.stderr.write("%s\n" % (log,))
 
-def make_program(vertex_shader, fragment_shader):
-    program = glCreateProgram()
-    glAttachShader(program, vertex_shader)
-    glAttachShader(program, fragment_shader)
+def link_program(program):
+    # Links program, or reports why it didn't link, deletes it and raises.
     glLinkProgram(program)
     retval = ctypes.c_int()
     glGetProgramiv(program, GL_LINK_STATUS, retval)
     if not retval:
-        print >> sys.stderr, "Failed to link shader program."
+        sys.stderr.write("Failed to link shader program.\n")
         show_info_log(program, glGetProgramiv, glGetProgramInfoLog)
         glDeleteProgram(program)
         raise Exception("Failed to link shader program.")
+
+def make_program(vertex_shader, fragment_shader, retrievable=False):
+    # retrievable asks the driver to keep the linked binary around for
+    # glGetProgramBinary.
+    program = glCreateProgram()
+    glAttachShader(program, vertex_shader)
+    glAttachShader(program, fragment_shader)
+    if retrievable:
+        glProgramParameteri(
+            program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    link_program(program)
     return program
 
+def transform_feedback_supported():
+    # Transform feedback (GL 3.0) plus geometry shaders (GL 3.2), which
+    # the feedback passes use to drop vertices. Needs a current context.
+    return bool(glTransformFeedbackVaryings) and \
+        bool(glBeginTransformFeedback) and bool(glFramebufferTexture)
+
+def make_feedback_program(shaders, varyings,
+        buffer_mode=GL_INTERLEAVED_ATTRIBS):
+    # Links compiled shaders into a program whose outputs named in
+    # varyings are captured by transform feedback, in that order. There
+    # need be no fragment shader if it runs with GL_RASTERIZER_DISCARD.
+    # The varyings are part of the link, so these don't go through the
+    # program cache.
+    program = glCreateProgram()
+    for shader in shaders:
+        glAttachShader(program, shader)
+    names = (ctypes.c_char_p * len(varyings))(
+        *[name.encode("ascii") for name in varyings])
+    glTransformFeedbackVaryings(
+        program, len(varyings),
+        ctypes.cast(names, ctypes.POINTER(ctypes.POINTER(GLchar))),
+        buffer_mode)
+    link_program(program)
+    for shader in shaders:
+        glDeleteShader(shader)
+    return program
+
+def apply_defines(source, defines):
+    # Adds a #define for each (name, value) pair after the #version line,
+    # which has to stay first.
+    if not defines:
+        return source
+    directives = "".join(
+        "#define %s %s\n" % (name, value) for name, value in defines)
+    if source.startswith("#version"):
+        version, newline, rest = source.partition("\n")
+        return version + "\n" + directives + rest
+    return directives + source
+
+def program_binaries_supported():
+    # GL 4.1 or ARB_get_program_binary, with at least one binary format.
+    if not (bool(glGetProgramBinary) and bool(glProgramBinary)):
+        return False
+    formats = GLint()
+    glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, formats)
+    return formats.value > 0
+
+def default_program_cache_directory():
+    # $OGL_PROGRAM_CACHE if set, where an empty value turns the disk
+    # cache off; otherwise somewhere under the user's cache directory.
+    directory = os.environ.get("OGL_PROGRAM_CACHE")
+    if directory is not None:
+        return directory or None
+    base = os.environ.get("XDG_CACHE_HOME") or \
+        os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "ogl_helpers", "programs")
+
+class ProgramCache(object):
+    # Linked shader programs, keyed by a hash of their sources (after
+    # defines are applied) and of the driver's vendor, renderer and
+    # version strings.
+    #
+    # Within a process the same sources always give back the same
+    # program, so they are only ever compiled once. Programs are only
+    # valid in the context that made them; call forget if it goes away.
+    #
+    # With a directory, linked binaries are also saved there with
+    # glGetProgramBinary and loaded with glProgramBinary on later runs.
+    # Each file is the binary format as a little-endian uint32 followed
+    # by the binary. A binary the driver rejects, say after an upgrade,
+    # is deleted and the program compiled from source as usual. Once the
+    # files add up to more than max_bytes, the least recently used go.
+    def __init__(self, directory=None, max_bytes=32*1024*1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.programs = {}
+        # How each request was satisfied, for startup measurements.
+        self.compiled = 0
+        self.loaded = 0
+        self.reused = 0
+    def key(self, vertex_source, fragment_source):
+        digest = hashlib.sha1()
+        for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+            digest.update(glGetString(name) or b"")
+            digest.update(b"\0")
+        for source in (vertex_source, fragment_source):
+            digest.update(source.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+    def program(self, vertex_source, fragment_source, defines=()):
+        # The program for these sources. defines is a sequence of
+        # (name, value) pairs or a dict.
+        if isinstance(defines, dict):
+            defines = sorted(defines.items())
+        vertex_source = apply_defines(vertex_source, defines)
+        fragment_source = apply_defines(fragment_source, defines)
+        key = self.key(vertex_source, fragment_source)
+        program = self.programs.get(key)
+        if program is not None:
+            self.reused += 1
+            return program
+        binaries = self.directory is not None and program_binaries_supported()
+        if binaries:
+            program = self.load(key)
+        if program is not None:
+            self.loaded += 1
+        else:
+            vertex_shader = make_shader(GL_VERTEX_SHADER, vertex_source)
+            fragment_shader = make_shader(GL_FRAGMENT_SHADER, fragment_source)
+            program = make_program(vertex_shader, fragment_shader, binaries)
+            # The program keeps them alive for as long as it needs them.
+            glDeleteShader(vertex_shader)
+            glDeleteShader(fragment_shader)
+            self.compiled += 1
+            if binaries:
+                self.store(key, program)
+        self.programs[key] = program
+        return program
+    def forget(self):
+        self.programs = {}
+    def path(self, key):
+        return os.path.join(self.directory, key + ".bin")
+    def load(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError:
+            return None
+        if len(data) < 4:
+            self.discard(path)
+            return None
+        binary_format, = struct.unpack("<I", data[:4])
+        binary = numpy.frombuffer(data, dtype=numpy.uint8, offset=4)
+        program = glCreateProgram()
+        try:
+            glProgramBinary(program, binary_format, binary, len(binary))
+        except GLError:
+            pass
+        status = GLint()
+        glGetProgramiv(program, GL_LINK_STATUS, status)
+        if not status.value:
+            glDeleteProgram(program)
+            self.discard(path)
+            return None
+        # Eviction goes by modification time, so mark it as used.
+        os.utime(path, None)
+        return program
+    def store(self, key, program):
+        length = GLint()
+        glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH, length)
+        if not length.value:
+            return
+        binary = numpy.zeros(length.value, dtype=numpy.uint8)
+        size = GLsizei()
+        binary_format = GLenum()
+        glGetProgramBinary(program, length.value, size, binary_format, binary)
+        path = self.path(key)
+        # Written under another name and renamed into place, so a reader
+        # never sees half a file.
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            with open(temporary, "wb") as f:
+                f.write(struct.pack("<I", binary_format.value))
+                f.write(binary[:size.value].tobytes())
+            os.rename(temporary, path)
+        except (IOError, OSError):
+            # An unwritable cache just means compiling every time.
+            self.discard(temporary)
+            return
+        self.evict()
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".bin"):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.discard(path)
+            total -= size
+    def discard(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+shared_program_cache = ProgramCache(default_program_cache_directory())
+
+class StreamingBuffer(object):
+    # A buffer object for data that is rewritten every frame.
+    #
+    # "buffer_data" re-specifies the whole store with glBufferData on each
+    # upload, which is the simplest thing but reallocates every time.
+    #
+    # "orphan" and "fenced" treat the store as a ring of `segments` regions,
+    # one per frame, and write each frame's data into the next region
+    # through an unsynchronized glMapBufferRange, so the driver never has
+    # to wait for the GPU to finish with the previous frame. "orphan"
+    # re-specifies the store each time the ring wraps, letting the driver
+    # hand out fresh memory while the old copy drains. "fenced" instead
+    # drops a fence after each frame and waits on it before reusing that
+    # region; without sync objects it falls back to "orphan".
+    #
+    # upload() returns the byte offset the data landed at, to be added to
+    # the attribute pointer offsets. Call end_frame() once the draw calls
+    # that read this frame's data have been issued.
+    strategies = ('buffer_data', 'orphan', 'fenced')
+    alignment = 64
+    def __init__(self, target, frame_size, strategy='orphan', segments=3):
+        if strategy not in self.strategies:
+            raise ValueError("Unknown streaming strategy %r." % (strategy,))
+        if strategy == 'fenced' and not bool(glFenceSync):
+            strategy = 'orphan'
+        self.target = target
+        self.strategy = strategy
+        self.segments = segments
+        self.buffer = glGenBuffers(1)
+        self.fences = [None] * segments
+        self.segment = 0
+        self.cursor = 0
+        self.allocate(frame_size)
+    def allocate(self, frame_size):
+        self.frame_size = self.aligned(max(frame_size, 1))
+        self.cursor = 0
+        if self.strategy != 'buffer_data':
+            self.segment = 0
+            self.delete_fences()
+            gl_state.bind_buffer(self.target, self.buffer)
+            glBufferData(
+                self.target,
+                self.frame_size * self.segments,
+                None,
+                GL_STREAM_DRAW)
+    def aligned(self, size):
+        return -(-size // self.alignment) * self.alignment
+    def upload(self, data):
+        gl_state.bind_buffer(self.target, self.buffer)
+        if self.strategy == 'buffer_data':
+            glBufferData(self.target, data.nbytes, data, GL_STREAM_DRAW)
+            return 0
+        if self.cursor + data.nbytes > self.frame_size:
+            # Doesn't fit in a frame's region: grow, which starts a fresh
+            # store and so can't disturb anything still being drawn.
+            self.allocate(2 * (self.cursor + data.nbytes))
+        offset = self.segment * self.frame_size + self.cursor
+        if data.nbytes:
+            address = glMapBufferRange(
+                self.target,
+                offset,
+                data.nbytes,
+                GL_MAP_WRITE_BIT |
+                GL_MAP_INVALIDATE_RANGE_BIT |
+                GL_MAP_UNSYNCHRONIZED_BIT)
+            ctypes.memmove(address, data.ctypes.data, data.nbytes)
+            glUnmapBuffer(self.target)
+        self.cursor += self.aligned(data.nbytes)
+        return offset
+    def end_frame(self):
+        if self.strategy == 'buffer_data':
+            return
+        if self.strategy == 'fenced':
+            self.fences[self.segment] = glFenceSync(
+                GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.segment = (self.segment + 1) % self.segments
+        self.cursor = 0
+        if self.strategy == 'fenced':
+            fence = self.fences[self.segment]
+            if fence is not None:
+                glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, 10**9)
+                glDeleteSync(fence)
+                self.fences[self.segment] = None
+        elif self.segment == 0:
+            gl_state.bind_buffer(self.target, self.buffer)
+            glBufferData(
+                self.target,
+                self.frame_size * self.segments,
+                None,
+                GL_STREAM_DRAW)
+    def delete_fences(self):
+        for i, fence in enumerate(self.fences):
+            if fence is not None:
+                glDeleteSync(fence)
+                self.fences[i] = None
+
+class DirtyRanges(object):
+    # Records which rows of an array have changed since it was last
+    # uploaded, so only those need sending again. Rows are marked either
+    # as [start, stop) spans or as arrays of indices; ranges() merges the
+    # lot into sorted, non-overlapping spans.
+    #
+    # Nothing is forgotten until clear(), so an array that goes a long
+    # time between uploads (or is never uploaded) would pile up marks.
+    # Past max_entries of them they collapse into the one span from the
+    # first row marked to the last, which can only over-upload.
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.clear()
+    def clear(self):
+        self.spans = []
+        self.indices = []
+    def mark(self, start, stop):
+        # Runs of neighbouring marks, as from a spawning loop, collapse
+        # into one span as they arrive.
+        if self.spans and self.spans[-1][0] <= start <= self.spans[-1][1]:
+            self.spans[-1] = (self.spans[-1][0], max(stop, self.spans[-1][1]))
+        else:
+            self.spans.append((start, stop))
+            self.limit_entries()
+    def mark_indices(self, indices):
+        if isinstance(indices, slice):
+            self.mark(indices.start, indices.stop)
+        elif numpy.ndim(indices) == 0:
+            self.mark(int(indices), int(indices) + 1)
+        else:
+            indices = numpy.array(indices, dtype=numpy.intp).ravel()
+            if len(indices):
+                self.indices.append(indices)
+                self.limit_entries()
+    def limit_entries(self):
+        if len(self.spans) + len(self.indices) <= self.max_entries:
+            return
+        starts = [start for start, stop in self.spans] + [
+            int(indices.min()) for indices in self.indices]
+        stops = [stop for start, stop in self.spans] + [
+            int(indices.max()) + 1 for indices in self.indices]
+        self.spans = [(min(starts), max(stops))]
+        self.indices = []
+    def __nonzero__(self):
+        return bool(self.spans or self.indices)
+    __bool__ = __nonzero__
+    def ranges(self, gap=0, limit=None):
+        # Spans separated by no more than gap rows are merged, trading a
+        # little redundant data for fewer upload calls. Spans are clipped
+        # to limit rows.
+        starts = [numpy.array([s for s, e in self.spans], dtype=numpy.intp)]
+        stops = [numpy.array([e for s, e in self.spans], dtype=numpy.intp)]
+        if self.indices:
+            rows = numpy.unique(numpy.concatenate(self.indices))
+            if len(rows):
+                breaks = numpy.nonzero(numpy.diff(rows) > 1)[0] + 1
+                starts.append(rows[numpy.r_[0, breaks]])
+                stops.append(rows[numpy.r_[breaks - 1, len(rows) - 1]] + 1)
+        starts = numpy.concatenate(starts)
+        stops = numpy.concatenate(stops)
+        if limit is not None:
+            stops = numpy.minimum(stops, limit)
+            keep = starts < stops
+            starts, stops = starts[keep], stops[keep]
+        if not len(starts):
+            return []
+        order = numpy.argsort(starts, kind='mergesort')
+        starts, stops = starts[order], stops[order]
+        reach = numpy.maximum.accumulate(stops)
+        split = numpy.nonzero(starts[1:] > reach[:-1] + gap)[0]
+        return list(zip(
+            starts[numpy.r_[0, split + 1]].tolist(),
+            reach[numpy.r_[split, len(starts) - 1]].tolist()))
+
+class DynamicBuffer(object):
+    # A buffer object allocated once at full size and then patched in
+    # place with glBufferSubData, for data that mostly stays the same
+    # from frame to frame. Shares upload()/end_frame() with
+    # StreamingBuffer so the two can be used interchangeably. upload()
+    # grows the store when data doesn't fit; update() doesn't, so only
+    # patch rows below size bytes.
+    def __init__(self, target, size):
+        self.target = target
+        self.buffer = glGenBuffers(1)
+        self.size = size
+        gl_state.bind_buffer(target, self.buffer)
+        glBufferData(target, size, None, GL_DYNAMIC_DRAW)
+    def upload(self, data):
+        if data.nbytes > self.size:
+            self.size = max(data.nbytes, 2 * self.size)
+            gl_state.bind_buffer(self.target, self.buffer)
+            glBufferData(self.target, self.size, None, GL_DYNAMIC_DRAW)
+        return self.update(data, [(0, len(data))])
+    def update(self, data, ranges):
+        # ranges are [start, stop) spans of rows of data.
+        gl_state.bind_buffer(self.target, self.buffer)
+        row_bytes = data.strides[0]
+        for start, stop in ranges:
+            if stop > start:
+                glBufferSubData(
+                    self.target,
+                    start * row_bytes,
+                    (stop - start) * row_bytes,
+                    data[start:stop])
+        return 0
+    def end_frame(self):
+        pass
+
+def instancing_supported():
+    # Needs a current context: PyOpenGL resolves entry points lazily.
+    return bool(glDrawArraysInstanced) and bool(glVertexAttribDivisor)
+
+def quad_indices(count, dtype):
+    # Two triangles, (0,1,2) and (2,3,0), for each of count quads of four
+    # consecutive vertices.
+    corners = numpy.array([0,1,2,2,3,0], dtype=dtype)
+    starts = numpy.arange(0, 4*count, 4, dtype=dtype)
+    return (starts[:,numpy.newaxis] + corners).ravel()
+
+class QuadIndexBuffer(object):
+    # A static element buffer of quad_indices, shared by everything that
+    # draws quads so the indices exist once however many collections
+    # there are. It only ever grows. Indices are 16-bit while they fit
+    # and 32-bit beyond 16384 quads, so draw with the current self.type.
+    def __init__(self):
+        self.buffer = None
+        self.count = 0
+        self.type = GL_UNSIGNED_SHORT
+    def reserve(self, count):
+        if count <= self.count:
+            return self
+        count = max(count, 2 * self.count)
+        if 4 * count <= 65536:
+            dtype, self.type = GLushort, GL_UNSIGNED_SHORT
+        else:
+            dtype, self.type = GLuint, GL_UNSIGNED_INT
+        indices = quad_indices(count, dtype)
+        if self.buffer is None:
+            self.buffer = glGenBuffers(1)
+        # Bound with the default vertex array, so as not to change the
+        # element buffer recorded in whichever one happens to be bound.
+        if vertex_arrays_supported():
+            gl_state.bind_vertex_array(0)
+        gl_state.bind_buffer(GL_ELEMENT_ARRAY_BUFFER, self.buffer)
+        glBufferData(
+            GL_ELEMENT_ARRAY_BUFFER,
+            indices.nbytes,
+            indices,
+            GL_STATIC_DRAW)
+        self.count = count
+        return self
+
+shared_quad_indices = QuadIndexBuffer()
+
+class QuadCornerBuffer(object):
+    # The four corners of a quad as a static vertex buffer, the per-vertex
+    # attribute of instanced drawing. Shared like shared_quad_indices, and
+    # made on first use, since that needs a context.
+    def __init__(self):
+        self.buffer = None
+    def get(self):
+        if self.buffer is None:
+            self.buffer = float_array_buffer(
+                -1.0, -1.0,
+                 1.0, -1.0,
+                 1.0,  1.0,
+                -1.0,  1.0)
+        return self.buffer
 
+shared_quad_corners = QuadCornerBuffer()
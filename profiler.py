@@ -0,0 +1,192 @@
+# Per-frame timing of the phases of a main loop.
+#
+#     profiler = FrameProfiler()
+#     while running:
+#         profiler.begin_frame()
+#         with profiler.phase("events"):
+#             ...
+#         with profiler.phase("draw", gpu=True):
+#             ...
+#         profiler.end_frame()
+#     print(profiler.report())
+#     profiler.write_chrome_trace("trace.json")
+#
+# CPU time comes from the wall clock. Phases marked gpu=True are also
+# wrapped in a GL_TIME_ELAPSED query; results are collected a few frames
+# later, once GL says they're available, so reading them never stalls
+# the pipeline. Only one such query can run at a time, so gpu phases
+# mustn't nest.
+#
+# The last `history` frames of each phase are kept for rolling
+# percentiles. The trace, viewable in chrome://tracing or Perfetto, puts
+# CPU phases on one track and GPU phases on another; GPU phases are
+# placed at the time their CPU side started, since only their length is
+# measured.
+
+import collections
+import contextlib
+import json
+import timeit
+
+import numpy
+from OpenGL.GL import *
+
+def timer_queries_supported():
+    # GL 3.3 or ARB_timer_query. Needs a current context.
+    return bool(glGetQueryObjectui64v) and bool(glBeginQuery)
+
+class FrameProfiler(object):
+    percentiles = (50, 95, 99)
+    def __init__(self, history=600, gpu=True, trace_frames=3600):
+        self.clock = timeit.default_timer
+        self.origin = self.clock()
+        self.gpu = gpu and timer_queries_supported()
+        self.samples = collections.defaultdict(
+            lambda: collections.deque(maxlen=history))
+        self.order = []
+        self.trace = collections.deque()
+        self.trace_frames = trace_frames
+        self.frame = -1
+        self.frame_start = None
+        # (name, trace event, query) for queries still waiting on the GPU.
+        self.pending = collections.deque()
+        self.free_queries = []
+    def microseconds(self, time):
+        return (time - self.origin) * 1e6
+    def begin_frame(self):
+        self.frame += 1
+        self.frame_start = self.clock()
+    @contextlib.contextmanager
+    def phase(self, name, gpu=False):
+        query = None
+        if gpu and self.gpu:
+            query = self.free_queries.pop() if self.free_queries else \
+                int(glGenQueries(1)[0])
+            glBeginQuery(GL_TIME_ELAPSED, query)
+        start = self.clock()
+        try:
+            yield
+        finally:
+            end = self.clock()
+            if query is not None:
+                glEndQuery(GL_TIME_ELAPSED)
+            self.record(name, (end - start) * 1e3)
+            self.add_event(name, "cpu", 1, start, end - start)
+            if query is not None:
+                event = self.add_event(name, "gpu", 2, start, 0.0)
+                self.pending.append((name + " (gpu)", event, query))
+    def record(self, name, milliseconds):
+        if name not in self.samples:
+            self.order.append(name)
+        self.samples[name].append(milliseconds)
+    def add_event(self, name, category, track, start, seconds):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "pid": 1,
+            "tid": track,
+            "ts": self.microseconds(start),
+            "dur": seconds * 1e6,
+            "args": {"frame": self.frame},
+            }
+        self.trace.append(event)
+        return event
+    def end_frame(self):
+        end = self.clock()
+        self.record("frame", (end - self.frame_start) * 1e3)
+        self.add_event("frame", "frame", 0, self.frame_start,
+            end - self.frame_start)
+        self.collect()
+        # Drop whole frames from the front of the trace.
+        oldest = self.frame - self.trace_frames
+        while self.trace and self.trace[0]["args"]["frame"] <= oldest:
+            self.trace.popleft()
+    def collect(self):
+        # Reads back whichever GPU timings are ready, oldest first.
+        available = GLint()
+        while self.pending:
+            name, event, query = self.pending[0]
+            glGetQueryObjectiv(query, GL_QUERY_RESULT_AVAILABLE, available)
+            if not available.value:
+                break
+            self.pending.popleft()
+            nanoseconds = GLuint64()
+            glGetQueryObjectui64v(query, GL_QUERY_RESULT, nanoseconds)
+            self.free_queries.append(query)
+            # Some drivers (llvmpipe, for one) report nonsense for the
+            # first query a context runs; nothing can have taken longer
+            # than the profiler has existed.
+            if nanoseconds.value * 1e-9 > self.clock() - self.origin:
+                continue
+            event["dur"] = nanoseconds.value * 1e-3
+            self.record(name, nanoseconds.value * 1e-6)
+    def summary(self):
+        # {phase: {"p50": ms, "p95": ms, "p99": ms, "mean": ms}} over the
+        # rolling window.
+        result = {}
+        for name in self.order:
+            samples = numpy.array(self.samples[name])
+            entry = dict(
+                ("p%d" % p, float(value)) for p, value in zip(
+                    self.percentiles,
+                    numpy.percentile(samples, self.percentiles)))
+            entry["mean"] = float(samples.mean())
+            result[name] = entry
+        return result
+    def report(self):
+        lines = ["%-20s %8s %8s %8s" % (
+            "phase (ms)", "p50", "p95", "p99")]
+        summary = self.summary()
+        for name in self.order:
+            entry = summary[name]
+            lines.append("%-20s %8.2f %8.2f %8.2f" % (
+                name, entry["p50"], entry["p95"], entry["p99"]))
+        return "\n".join(lines)
+    def write_chrome_trace(self, filename):
+        names = [
+            {"name": "thread_name", "ph": "M", "pid": 1, "tid": track,
+                "args": {"name": name}}
+            for track, name in ((0, "frames"), (1, "cpu"), (2, "gpu"))]
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": names + list(self.trace),
+                "displayTimeUnit": "ms"}, f)
+    def draw_overlay(self, viewport_size, frames=120, scale=4.0,
+            budget=1000.0/60.0):
+        # A graph in the bottom left corner of the last frames, one column
+        # each, stacked by phase, scale pixels to a millisecond; the
+        # white line is budget. Drawn with scissored clears, so it needs
+        # no shaders and leaves nothing bound.
+        width, height = viewport_size
+        frames = min(frames, width // 2)
+        clear_color = glGetFloatv(GL_COLOR_CLEAR_VALUE)
+        glEnable(GL_SCISSOR_TEST)
+        colors = overlay_colors
+        phases = [name for name in self.order
+            if name != "frame" and not name.endswith(" (gpu)")]
+        columns = [self.samples[name] for name in phases]
+        count = min(frames, min([len(c) for c in columns] or [0]))
+        for column in range(count):
+            y = 0.0
+            for i, samples in enumerate(columns):
+                milliseconds = samples[len(samples) - count + column]
+                top = y + milliseconds * scale
+                self.fill(column * 2, int(y), 2, max(1, int(top) - int(y)),
+                    colors[i % len(colors)])
+                y = top
+        self.fill(0, int(budget * scale), frames * 2, 1, (1, 1, 1, 1))
+        glDisable(GL_SCISSOR_TEST)
+        glClearColor(*clear_color)
+    def fill(self, x, y, width, height, color):
+        glScissor(x, y, width, height)
+        glClearColor(*color)
+        glClear(GL_COLOR_BUFFER_BIT)
+
+overlay_colors = (
+    (0.9, 0.3, 0.3, 1.0),
+    (0.3, 0.9, 0.3, 1.0),
+    (0.3, 0.5, 1.0, 1.0),
+    (1.0, 0.8, 0.2, 1.0),
+    (0.8, 0.3, 0.9, 1.0),
+    (0.3, 0.9, 0.9, 1.0),
+    )
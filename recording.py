@@ -0,0 +1,275 @@
+# Capturing, restoring and recording simulation states, so that a session
+# can be run again exactly, without a window, by replay.py.
+#
+#     recorder = Recorder("session", state)
+#     while running:
+#         ...
+#         changed = advance_simulation(state, elapsed)
+#         recorder.record(state, elapsed, changed)
+#     recorder.close()
+#
+# A recording is a directory holding:
+#
+#     snapshot.npz  capture_state of the state before the first frame
+#     frames.dat    one frame_dtype row per frame: its inputs (how far
+#                   the clock moved, whether it was paused) and what it
+#                   left behind (the live count and a checksum of every
+#                   position and angle)
+#     deltas.dat    one delta_dtype row per bullet a frame respawned,
+#                   moved or spawned, the frame's rows starting at its
+#                   delta_start
+#     header.json   the collection's layout, plus the row counts once
+#                   the recorder is closed
+#
+# The .dat files are raw rows, written and read through numpy memmaps,
+# so a long session neither builds up in memory nor has to be loaded to
+# be replayed.
+#
+# A state here is anything laid out like bullets.State. Snapshots cover
+# the live rows of every BulletCollection array (behaviors included), its
+# sprite tables, the RNG and the emitters. A state stepped by a
+# SimulationScheduler has to be captured from its simulation_state with
+# the thread stopped.
+
+import json
+import os
+import pickle
+import zlib
+
+import numpy
+
+frame_dtype = numpy.dtype([
+    ('time', numpy.float64),
+    ('elapsed', numpy.float64),
+    ('paused', numpy.uint8),
+    ('active_count', numpy.int64),
+    ('delta_start', numpy.int64),
+    ('delta_count', numpy.int64),
+    ('checksum', numpy.uint32)])
+
+delta_dtype = numpy.dtype([
+    ('index', numpy.int32),
+    ('center', numpy.float32, 2),
+    ('velocity', numpy.float32, 2),
+    ('angle', numpy.float32),
+    ('size', numpy.float32, 2)])
+
+def capture_state(state):
+    # A dict of arrays holding everything needed to carry on from state,
+    # suitable for save_snapshot.
+    collection = state.bullet_collection
+    download = getattr(state.simulation, 'download', None)
+    if download is not None:
+        # A GPUSimulation, whose bullets only live on the GPU.
+        download()
+    count = collection.active_count
+    snapshot = {
+        'layout': numpy.array(collection.layout),
+        'vertex_format': numpy.array(collection.vertex_format),
+        'capacity': numpy.array(collection.capacity),
+        'active_count': numpy.array(count),
+        'vertex_origin': numpy.array(collection.vertex_origin),
+        'homing_target': numpy.array(collection.homing_target),
+        'timer': numpy.array(state.timer, dtype=numpy.float64),
+        'paused': numpy.array(state.paused),
+        # Pickled together so the emitters still share the state's RNG.
+        'objects': numpy.frombuffer(
+            pickle.dumps((state.rng, state.emitters), 2),
+            dtype=numpy.uint8),
+        }
+    for i, array in enumerate(collection.bullet_arrays(False)):
+        snapshot['array_%d' % i] = array[:count].copy()
+    # Respawned bullets look their sprites up in these, so a replay has
+    # to have the same ones.
+    sprites = collection.sprite_tables
+    snapshot['sprite_names'] = numpy.array(sprites.names)
+    snapshot['sprite_texture_coords'] = sprites.texture_coords
+    snapshot['sprite_atlas_rects'] = sprites.atlas_rects
+    snapshot['sprite_sizes'] = sprites.sizes
+    for name, array in collection.behaviors.items():
+        snapshot['behavior_' + name] = array[:count].copy()
+    return snapshot
+
+def restore_state(state, snapshot):
+    # Puts state back as it was when snapshot was captured. Its
+    # collection must have the same layout, vertex format and capacity.
+    collection = state.bullet_collection
+    kind = (str(snapshot['layout']), str(snapshot['vertex_format']),
+        int(snapshot['capacity']))
+    if kind != (collection.layout, collection.vertex_format,
+            collection.capacity):
+        raise ValueError(
+            "Snapshot is of a %s, %s collection of %d bullets." % kind)
+    count = int(snapshot['active_count'])
+    collection.active_count = count
+    for i, array in enumerate(collection.bullet_arrays(False)):
+        array[:count] = snapshot['array_%d' % i]
+    names = [key[len('behavior_'):] for key in snapshot
+        if key.startswith('behavior_')]
+    collection.disable_behaviors(
+        *[name for name in list(collection.behaviors) if name not in names])
+    collection.enable_behaviors(*names)
+    for name in names:
+        collection.behaviors[name][:count] = snapshot['behavior_' + name]
+    collection.vertex_origin = tuple(
+        float(value) for value in snapshot['vertex_origin'])
+    collection.homing_target = tuple(
+        float(value) for value in snapshot['homing_target'])
+    collection.mark_dirty(slice(0, count))
+    collection.update_positions()
+    state.timer = float(snapshot['timer'])
+    state.paused = bool(snapshot['paused'])
+    state.rng, state.emitters = pickle.loads(snapshot['objects'].tobytes())
+    upload = getattr(state.simulation, 'upload', None)
+    if upload is not None:
+        upload(numpy.arange(count))
+
+def save_snapshot(path, snapshot):
+    with open(path, 'wb') as f:
+        numpy.savez(f, **snapshot)
+
+def load_snapshot(path):
+    with numpy.load(path) as data:
+        return dict((key, data[key]) for key in data.files)
+
+def checksum(bullet_collection):
+    # CRC of every live position and angle, to tell cheaply whether two
+    # runs are still bit for bit the same.
+    count = bullet_collection.active_count
+    crc = zlib.crc32(numpy.ascontiguousarray(
+        bullet_collection.positions[:count]).tobytes())
+    crc = zlib.crc32(numpy.ascontiguousarray(
+        bullet_collection.angles[:count]).tobytes(), crc)
+    return crc & 0xffffffff
+
+def delta_rows(bullet_collection, indices):
+    # delta_dtype rows for the bullets at indices.
+    rows = numpy.zeros(len(indices), dtype=delta_dtype)
+    rows['index'] = indices
+    rows['center'] = bullet_collection.positions[indices]
+    rows['velocity'] = bullet_collection.velocities[indices]
+    rows['angle'] = bullet_collection.angles[indices]
+    rows['size'] = bullet_collection.dimensions[indices]
+    return rows
+
+class MemmapLog(object):
+    # Rows of dtype appended to a file through a memmap, which grows by
+    # doubling. close() cuts the file back to the rows written.
+    def __init__(self, path, dtype, capacity=4096):
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.count = 0
+        self.rows = None
+        open(path, 'wb').close()
+        self.reserve(capacity)
+    def reserve(self, capacity):
+        if self.rows is not None:
+            if capacity <= len(self.rows):
+                return
+            capacity = max(capacity, 2 * len(self.rows))
+            self.rows.flush()
+            self.rows = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.dtype.itemsize)
+        self.rows = numpy.memmap(
+            self.path, dtype=self.dtype, mode='r+', shape=(capacity,))
+    def append(self, rows):
+        self.reserve(self.count + len(rows))
+        self.rows[self.count:self.count + len(rows)] = rows
+        self.count += len(rows)
+    def close(self):
+        self.rows.flush()
+        self.rows = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.count * self.dtype.itemsize)
+
+def read_log(path, dtype, count=None):
+    # A read-only memmap of the rows of a MemmapLog file; the whole file
+    # when count is None.
+    dtype = numpy.dtype(dtype)
+    if count is None:
+        count = os.path.getsize(path) // dtype.itemsize
+    if not count:
+        # mmap can't map nothing.
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r', shape=(count,))
+
+class Recorder(object):
+    def __init__(self, directory, state, capacity=4096):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        collection = state.bullet_collection
+        self.header = {
+            'layout': collection.layout,
+            'vertex_format': collection.vertex_format,
+            'capacity': collection.capacity,
+            }
+        save_snapshot(self.path('snapshot.npz'), capture_state(state))
+        self.frames = MemmapLog(self.path('frames.dat'), frame_dtype, capacity)
+        self.deltas = MemmapLog(
+            self.path('deltas.dat'), delta_dtype, 16 * capacity)
+        self.frame = numpy.zeros(1, dtype=frame_dtype)
+        self.write_header()
+    def path(self, name):
+        return os.path.join(self.directory, name)
+    def write_header(self):
+        with open(self.path('header.json'), 'w') as f:
+            json.dump(self.header, f, indent=2, sort_keys=True)
+    def record(self, state, elapsed, changed=()):
+        # Appends a frame that stepped state by elapsed seconds (or would
+        # have, had it not been paused), changing the bullets at changed.
+        collection = state.bullet_collection
+        download = getattr(state.simulation, 'download', None)
+        if download is not None:
+            download()
+        changed = numpy.asarray(changed, dtype=numpy.intp)
+        frame = self.frame[0]
+        frame['time'] = state.timer
+        frame['elapsed'] = elapsed
+        frame['paused'] = state.paused
+        frame['active_count'] = collection.active_count
+        frame['delta_start'] = self.deltas.count
+        frame['delta_count'] = len(changed)
+        frame['checksum'] = checksum(collection)
+        self.frames.append(self.frame)
+        if len(changed):
+            self.deltas.append(delta_rows(collection, changed))
+    def close(self):
+        self.frames.close()
+        self.deltas.close()
+        self.header['frames'] = self.frames.count
+        self.header['deltas'] = self.deltas.count
+        self.write_header()
+
+class Recording(object):
+    # A recording made by Recorder, opened for reading.
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'header.json')) as f:
+            self.header = json.load(f)
+        self.layout = self.header['layout']
+        self.vertex_format = self.header['vertex_format']
+        self.capacity = self.header['capacity']
+        # An unclosed recording has no counts, and its files run on past
+        # the last row into space never written.
+        self.complete = 'frames' in self.header
+        self.snapshot = load_snapshot(os.path.join(directory, 'snapshot.npz'))
+        self.frames = read_log(os.path.join(directory, 'frames.dat'),
+            frame_dtype, self.header.get('frames'))
+        if not self.complete:
+            # Rows never written are all zero bytes; a real frame has at
+            # least its elapsed time or live count set.
+            written = numpy.nonzero(
+                (self.frames['elapsed'] != 0) |
+                (self.frames['active_count'] != 0))[0]
+            self.frames = self.frames[:written[-1] + 1 if len(written) else 0]
+        deltas = None
+        if len(self.frames):
+            last = self.frames[-1]
+            deltas = int(last['delta_start'] + last['delta_count'])
+        self.deltas = read_log(os.path.join(directory, 'deltas.dat'),
+            delta_dtype, deltas)
+    def frame_deltas(self, frame):
+        start = int(frame['delta_start'])
+        return self.deltas[start:start + int(frame['delta_count'])]
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# Headless replay of a session recorded with bullets.py --record.
+#
+# Rebuilds the simulation from the recording's snapshot and steps it
+# through the recorded frames, as fast as it will go, timing each one.
+# Every frame is checked against what was recorded: the live count, the
+# checksum of positions and angles, and the rows of the bullets that
+# changed. The first frame that doesn't match is reported, so two builds
+# can be compared on the same session:
+#
+#     python bullets.py --record session --seed 1
+#     python replay.py session --frame-times before.npy
+#     (change something)
+#     python replay.py session --compare before.npy
+#
+# Results go to stdout as JSON, like benchmark.py.
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy
+
+# bullets imports pygame, whose banner would otherwise end up in the
+# JSON on stdout.
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from bullets import SpriteTables, advance_simulation, make_simulation_state
+from recording import Recording, checksum, delta_rows, restore_state
+
+def make_replay_state(recording, threads=1):
+    # A headless state as the recording started. Whatever stepped the
+    # recorded session, this steps on the CPU.
+    snapshot = recording.snapshot
+    sprite_tables = None
+    if 'sprite_names' in snapshot:
+        sprite_tables = SpriteTables(
+            [str(name) for name in snapshot['sprite_names']],
+            snapshot['sprite_texture_coords'],
+            snapshot['sprite_atlas_rects'],
+            snapshot['sprite_sizes'])
+    state = make_simulation_state(
+        0, capacity=recording.capacity, layout=recording.layout,
+        threads=threads, vertex_format=recording.vertex_format,
+        sprite_tables=sprite_tables)
+    restore_state(state, snapshot)
+    return state
+
+def frame_mismatch(recording, frame, state, changed):
+    # What about state differs from the recorded frame, or None.
+    collection = state.bullet_collection
+    if collection.active_count != frame['active_count']:
+        return "live count"
+    expected = recording.frame_deltas(frame)
+    if len(changed) != len(expected):
+        return "changed count"
+    if not numpy.array_equal(delta_rows(collection, changed), expected):
+        return "changed bullets"
+    if checksum(collection) != frame['checksum']:
+        return "checksum"
+    return None
+
+def replay(recording, frames=None, threads=1, verify=True):
+    # Steps through the first frames of recording (all of them with
+    # None). Returns the report and the seconds each frame took.
+    state = make_replay_state(recording, threads)
+    recorded = recording.frames[:frames]
+    seconds = numpy.zeros(len(recorded))
+    timer = timeit.default_timer
+    first_mismatch = None
+    mismatches = 0
+    no_change = numpy.zeros(0, dtype=numpy.intp)
+    for i in range(len(recorded)):
+        frame = recorded[i]
+        start = timer()
+        if frame['paused']:
+            changed = no_change
+        else:
+            changed = advance_simulation(state, float(frame['elapsed']))
+        seconds[i] = timer() - start
+        state.timer = float(frame['time'])
+        if verify:
+            mismatch = frame_mismatch(recording, frame, state, changed)
+            if mismatch is not None:
+                mismatches += 1
+                if first_mismatch is None:
+                    first_mismatch = {"frame": i, "reason": mismatch}
+    if state.simulation is not None:
+        state.simulation.close()
+    report = {
+        "frames": len(recorded),
+        "complete_recording": recording.complete,
+        "layout": recording.layout,
+        "vertex_format": recording.vertex_format,
+        "threads": threads,
+        "session_seconds": float(recorded['elapsed'].sum()),
+        "replay_seconds": float(seconds.sum()),
+        "mean_bullets": float(recorded['active_count'].mean())
+            if len(recorded) else 0.0,
+        "verified": verify,
+        "mismatched_frames": mismatches,
+        "first_mismatch": first_mismatch,
+        }
+    if len(seconds):
+        for p in (50, 95, 99):
+            report["ms_per_frame_p%d" % p] = \
+                float(numpy.percentile(seconds, p)) * 1e3
+        report["ms_per_frame_max"] = float(seconds.max()) * 1e3
+    return report, seconds
+
+def compare(seconds, baseline):
+    # How this replay's frame times stack up against an earlier one's,
+    # frame by frame.
+    count = min(len(seconds), len(baseline))
+    if not count:
+        return {"frames": 0}
+    # Per-frame speedups, > 1 being faster than the baseline.
+    speedups = baseline[:count] / numpy.maximum(seconds[:count], 1e-9)
+    worst = int(numpy.argmin(speedups))
+    return {
+        "frames": count,
+        "total_speedup": float(
+            baseline[:count].sum() / seconds[:count].sum()),
+        "median_speedup": float(numpy.median(speedups)),
+        "p5_speedup": float(numpy.percentile(speedups, 5)),
+        "worst_frame": worst,
+        "worst_frame_speedup": float(speedups[worst]),
+        }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay a recorded session without a window.")
+    parser.add_argument("recording",
+        help="directory written by bullets.py --record")
+    parser.add_argument("--frames", type=int, default=None,
+        help="replay only this many frames")
+    parser.add_argument("--threads", type=int, default=1,
+        help="shard the simulation over this many threads "
+             "(default: %(default)s)")
+    parser.add_argument("--no-verify", action="store_true",
+        help="don't check the frames against the recording")
+    parser.add_argument("--frame-times",
+        help="save the seconds each frame took here (.npy)")
+    parser.add_argument("--compare",
+        help="frame times saved by an earlier --frame-times to compare "
+             "against")
+    parser.add_argument("--output", default=None,
+        help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+    recording = Recording(args.recording)
+    report, seconds = replay(
+        recording, args.frames, args.threads, not args.no_verify)
+    if args.frame_times:
+        numpy.save(args.frame_times, seconds)
+    if args.compare:
+        report["compare"] = compare(seconds, numpy.load(args.compare))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    if report["mismatched_frames"]:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
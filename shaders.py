@@ -6,14 +6,14 @@ import math
 from random import Random
 from ogl_helpers import (
     make_buffer,
-    short_element_buffer,
     float_array,
     short_array,
     translation_matrix,
     make_texture,
     make_shader,
     show_info_log,
-    make_program)
+    make_program,
+    shared_program_cache)
 
 
 
@@ -66,15 +66,9 @@ def make_shader_program(
     fragment_shader_source,
     uniforms,
     attributes):
-    vertex_shader = make_shader(
-        GL_VERTEX_SHADER,
-        vertex_shader_source)
-    fragment_shader = make_shader(
-        GL_FRAGMENT_SHADER,
+    program = shared_program_cache.program(
+        vertex_shader_source,
         fragment_shader_source)
-    program = make_program(
-        vertex_shader,
-        fragment_shader)
     shader_program = ShaderProgram(program)
     for u in uniforms:
         setattr(
@@ -0,0 +1,147 @@
+# Uniform grid over bullet positions, for finding the bullets that touch
+# a set of shapes (a player's hitbox, a list of shields) without testing
+# every bullet against every shape.
+#
+# Bullets are treated as circles around their centers that enclose the
+# whole rotated quad. The grid is rebuilt from scratch each frame: bullet
+# centers are binned into square cells by sorting on a cell key, so a
+# row of neighbouring cells is a contiguous run of the sorted bullets.
+
+import numpy
+
+def bullet_radii(bullet_collection):
+    # Radius of the circle around each live bullet's quad; dimensions
+    # are the half width and half height.
+    dimensions = bullet_collection.dimensions[:bullet_collection.active_count]
+    return numpy.hypot(dimensions[:,0], dimensions[:,1])
+
+class UniformGrid(object):
+    def __init__(self, cell_size=1.0):
+        self.cell_size = float(cell_size)
+        self.build(numpy.zeros((0,2)), numpy.zeros(0))
+    def build_from_collection(self, bullet_collection):
+        count = bullet_collection.active_count
+        self.build(
+            bullet_collection.positions[:count],
+            bullet_radii(bullet_collection))
+    def build(self, positions, radii):
+        self.positions = numpy.asarray(positions, dtype=numpy.float64)
+        self.radii = numpy.asarray(radii, dtype=numpy.float64)
+        self.max_radius = self.radii.max() if len(self.radii) else 0.0
+        if len(self.positions):
+            self.origin = self.positions.min(axis=0)
+            extent = self.positions.max(axis=0) - self.origin
+        else:
+            self.origin = numpy.zeros(2)
+            extent = numpy.zeros(2)
+        self.columns, self.rows = \
+            (extent // self.cell_size).astype(numpy.int64) + 1
+        cells = self.cell_coordinates(self.positions)
+        keys = cells[:,1] * self.columns + cells[:,0]
+        # order lists the bullets cell by cell; keys[order] is sorted.
+        self.order = numpy.argsort(keys, kind='mergesort')
+        self.sorted_keys = keys[self.order]
+    def cell_coordinates(self, points):
+        cells = numpy.floor((points - self.origin) / self.cell_size)
+        cells = cells.astype(numpy.int64)
+        numpy.clip(cells[:,0], 0, self.columns - 1, out=cells[:,0])
+        numpy.clip(cells[:,1], 0, self.rows - 1, out=cells[:,1])
+        return cells
+    def candidates(self, lower, upper):
+        # For each axis-aligned box given by corners lower and upper (n,2),
+        # every bullet whose center lies in a cell the box touches, as
+        # parallel arrays (query index, bullet index).
+        if not len(self.sorted_keys) or not len(lower):
+            empty = numpy.zeros(0, dtype=numpy.int64)
+            return empty, empty
+        first = self.cell_coordinates(lower)
+        last = self.cell_coordinates(upper)
+        # Boxes wholly outside the grid would have been clamped onto its
+        # edge cells; drop them.
+        outside = numpy.any(
+            (upper < self.origin) |
+            (lower > self.origin +
+                self.cell_size * numpy.array([self.columns, self.rows])),
+            axis=1)
+        row_counts = numpy.where(outside, 0, last[:,1] - first[:,1] + 1)
+        # One entry per (query, grid row) pair.
+        queries = numpy.repeat(numpy.arange(len(lower)), row_counts)
+        rows = first[queries,1] + (
+            numpy.arange(len(queries)) -
+            numpy.repeat(numpy.cumsum(row_counts) - row_counts, row_counts))
+        begins = numpy.searchsorted(
+            self.sorted_keys,
+            rows * self.columns + first[queries,0],
+            'left')
+        ends = numpy.searchsorted(
+            self.sorted_keys,
+            rows * self.columns + last[queries,0],
+            'right')
+        # Expand each [begin, end) run into the sorted positions it covers.
+        lengths = ends - begins
+        total = lengths.sum()
+        run_starts = numpy.cumsum(lengths) - lengths
+        slots = numpy.arange(total) + numpy.repeat(begins - run_starts, lengths)
+        return numpy.repeat(queries, lengths), self.order[slots]
+    def query_circles(self, centers, radii):
+        # Bullets overlapping each circle. Returns parallel arrays of
+        # (query index, bullet index), sorted by query.
+        centers = numpy.asarray(centers, dtype=numpy.float64).reshape(-1,2)
+        radii = numpy.broadcast_to(
+            numpy.asarray(radii, dtype=numpy.float64), (len(centers),))
+        reach = (radii + self.max_radius)[:,numpy.newaxis]
+        queries, bullets = self.candidates(centers - reach, centers + reach)
+        offsets = self.positions[bullets] - centers[queries]
+        limit = radii[queries] + self.radii[bullets]
+        hit = numpy.einsum('ij,ij->i', offsets, offsets) <= limit * limit
+        return queries[hit], bullets[hit]
+    def query_boxes(self, boxes):
+        # Bullets overlapping each box, given as (left, bottom, right, top)
+        # rows. Returns parallel arrays of (query index, bullet index).
+        boxes = numpy.asarray(boxes, dtype=numpy.float64).reshape(-1,4)
+        lower = boxes[:,0:2]
+        upper = boxes[:,2:4]
+        queries, bullets = self.candidates(
+            lower - self.max_radius, upper + self.max_radius)
+        centers = self.positions[bullets]
+        nearest = numpy.clip(centers, lower[queries], upper[queries])
+        offsets = centers - nearest
+        limit = self.radii[bullets]
+        hit = numpy.einsum('ij,ij->i', offsets, offsets) <= limit * limit
+        return queries[hit], bullets[hit]
+
+def brute_force_circles(positions, bullet_radii, centers, radii):
+    # Reference for UniformGrid.query_circles: every bullet against every
+    # circle, one circle at a time.
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    queries = [numpy.zeros(0, dtype=numpy.int64)]
+    bullets = [numpy.zeros(0, dtype=numpy.int64)]
+    for i, (center, radius) in enumerate(zip(centers, radii)):
+        offsets = positions - center
+        limit = radius + bullet_radii
+        hit = numpy.nonzero(
+            numpy.einsum('ij,ij->i', offsets, offsets) <= limit * limit)[0]
+        queries.append(numpy.full(len(hit), i, dtype=numpy.int64))
+        bullets.append(hit)
+    return numpy.concatenate(queries), numpy.concatenate(bullets)
+
+def brute_force_boxes(positions, bullet_radii, boxes):
+    # Reference for UniformGrid.query_boxes, one box at a time.
+    positions = numpy.asarray(positions, dtype=numpy.float64)
+    queries = [numpy.zeros(0, dtype=numpy.int64)]
+    bullets = [numpy.zeros(0, dtype=numpy.int64)]
+    for i, box in enumerate(numpy.asarray(boxes, dtype=numpy.float64)):
+        offsets = positions - numpy.clip(positions, box[0:2], box[2:4])
+        hit = numpy.nonzero(
+            numpy.einsum('ij,ij->i', offsets, offsets) <=
+            bullet_radii * bullet_radii)[0]
+        queries.append(numpy.full(len(hit), i, dtype=numpy.int64))
+        bullets.append(hit)
+    return numpy.concatenate(queries), numpy.concatenate(bullets)
+
+def sorted_hits(hits):
+    # (query index, bullet index) pairs from a query, one per row, sorted,
+    # so results that list the same hits in another order compare equal.
+    queries, bullets = hits
+    order = numpy.lexsort((bullets, queries))
+    return numpy.column_stack((queries[order], bullets[order]))
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+
+# Baked textures: an image decoded ahead of time, with its whole mip
+# chain, stored so that loading it is a memory map and one upload per
+# level. Bake with
+#
+#     python texture_assets.py sheet.tga sheet.btex [--compress]
+#
+# and load with ogl_helpers.TextureLoader, which picks up the .btex next
+# to an image in its place.
+#
+# The file is a header, a table with one entry per mip level, then the
+# levels themselves, all little-endian:
+#
+#     header:  magic "BTEX", version, GL internal format, width, height,
+#              level count (uint32 each)
+#     levels:  offset, size (uint64), width, height (uint32) per level
+#
+# Levels are either RGBA8 rows, bottom row first as glTexImage2D wants
+# them, or DXT5 (S3TC) blocks for glCompressedTexImage2D. Each starts on
+# a 16 byte boundary.
+
+import argparse
+
+import numpy
+import pygame, pygame.image
+
+from OpenGL.GL import GL_RGBA8
+from OpenGL.GL.EXT.texture_compression_s3tc import \
+    GL_COMPRESSED_RGBA_S3TC_DXT5_EXT
+
+magic = b"BTEX"
+
+version = 1
+
+header_dtype = numpy.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('format', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+    ('levels', '<u4')])
+
+level_dtype = numpy.dtype([
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('width', '<u4'),
+    ('height', '<u4')])
+
+level_alignment = 16
+
+def load_pixels(filename):
+    # RGBA8 pixels as a (height, width, 4) array, bottom row first.
+    image = pygame.image.load(filename)
+    pixels = pygame.image.tostring(image, "RGBA", True)
+    return numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(
+        image.get_height(), image.get_width(), 4)
+
+def halve(pixels):
+    # The next mip level down: each texel is the average of a 2x2 block,
+    # with the colors weighted by alpha so that transparent texels don't
+    # darken the edges of sprites.
+    height, width = pixels.shape[:2]
+    if height == 1:
+        pixels = numpy.concatenate([pixels, pixels], axis=0)
+    if width == 1:
+        pixels = numpy.concatenate([pixels, pixels], axis=1)
+    height, width = max(1, height // 2), max(1, width // 2)
+    blocks = pixels[:height*2, :width*2].astype(numpy.float64).reshape(
+        height, 2, width, 2, 4)
+    alphas = blocks[..., 3:4]
+    weight = alphas.sum(axis=(1, 3))
+    colors = (blocks[..., :3] * alphas).sum(axis=(1, 3))
+    colors /= numpy.where(weight > 0, weight, 1.0)
+    plain = blocks[..., :3].mean(axis=(1, 3))
+    colors = numpy.where(weight > 0, colors, plain)
+    result = numpy.empty((height, width, 4))
+    result[..., :3] = colors
+    result[..., 3] = weight[..., 0] / 4.0
+    return (result + 0.5).astype(numpy.uint8)
+
+def mip_chain(pixels):
+    # pixels followed by every smaller level down to 1x1.
+    levels = [pixels]
+    while levels[-1].shape[0] > 1 or levels[-1].shape[1] > 1:
+        levels.append(halve(levels[-1]))
+    return levels
+
+def to_blocks(pixels):
+    # (count, 16, 4) float array of the 4x4 blocks of pixels, in row
+    # order, padding partial blocks by repeating the edge texels.
+    height, width = pixels.shape[:2]
+    rows, columns = (height + 3) // 4, (width + 3) // 4
+    padded = numpy.pad(
+        pixels,
+        ((0, rows*4 - height), (0, columns*4 - width), (0, 0)),
+        mode='edge')
+    blocks = padded.reshape(rows, 4, columns, 4, 4).transpose(0, 2, 1, 3, 4)
+    return blocks.reshape(rows * columns, 16, 4).astype(numpy.float64)
+
+def nearest(values, palette):
+    # Index into palette (count, n, channels) of the entry nearest each of
+    # values (count, 16, channels).
+    differences = values[:, :, numpy.newaxis, :] - \
+        palette[:, numpy.newaxis, :, :]
+    return numpy.argmin((differences * differences).sum(axis=3), axis=2)
+
+def pack_indices(indices, bits):
+    # Packs each row of indices, first index in the lowest bits.
+    shifts = numpy.arange(indices.shape[1], dtype=numpy.uint64) * bits
+    return numpy.bitwise_or.reduce(
+        indices.astype(numpy.uint64) << shifts, axis=1)
+
+def to_565(colors):
+    red, green, blue = (colors[:, 0], colors[:, 1], colors[:, 2])
+    return (
+        ((red * 31 + 127) // 255).astype(numpy.uint64) << 11 |
+        ((green * 63 + 127) // 255).astype(numpy.uint64) << 5 |
+        ((blue * 31 + 127) // 255).astype(numpy.uint64))
+
+def from_565(packed):
+    red = (packed >> 11) & 31
+    green = (packed >> 5) & 63
+    blue = packed & 31
+    return numpy.stack([
+        (red << 3) | (red >> 2),
+        (green << 2) | (green >> 4),
+        (blue << 3) | (blue >> 2)], axis=1).astype(numpy.float64)
+
+def compress_dxt5(pixels):
+    # DXT5 blocks for an RGBA8 level. Each block's colors and alphas are
+    # fitted to the range between their minimum and maximum; it's fast
+    # and good enough for flat sprite art.
+    blocks = to_blocks(pixels)
+    # Alpha: two endpoints and six values between them, 3 bit indices.
+    alpha0 = blocks[:, :, 3].max(axis=1)
+    alpha1 = blocks[:, :, 3].min(axis=1)
+    weights = numpy.array([7, 0, 6, 5, 4, 3, 2, 1]) / 7.0
+    alpha_palette = numpy.floor(
+        alpha0[:, numpy.newaxis] * weights +
+        alpha1[:, numpy.newaxis] * (1.0 - weights) + 0.5)
+    alpha_indices = nearest(
+        blocks[:, :, 3:4], alpha_palette[:, :, numpy.newaxis])
+    alpha_block = (
+        alpha0.astype(numpy.uint64) |
+        alpha1.astype(numpy.uint64) << numpy.uint64(8) |
+        pack_indices(alpha_indices, 3) << numpy.uint64(16))
+    # Color: two 565 endpoints, the larger first, and two colors between
+    # them, 2 bit indices.
+    color0 = to_565(blocks[:, :, :3].max(axis=1))
+    color1 = to_565(blocks[:, :, :3].min(axis=1))
+    color0, color1 = numpy.maximum(color0, color1), \
+        numpy.minimum(color0, color1)
+    end0 = from_565(color0)
+    end1 = from_565(color1)
+    color_palette = numpy.stack([
+        end0, end1, (2*end0 + end1) / 3.0, (end0 + 2*end1) / 3.0], axis=1)
+    color_indices = nearest(blocks[:, :, :3], color_palette)
+    color_block = (
+        color0 |
+        color1 << numpy.uint64(16) |
+        pack_indices(color_indices, 2) << numpy.uint64(32))
+    result = numpy.empty((len(blocks), 2), dtype='<u8')
+    result[:, 0] = alpha_block
+    result[:, 1] = color_block
+    return result.view(numpy.uint8).ravel()
+
+def write_texture(filename, levels, format=GL_RGBA8):
+    # Writes RGBA8 levels, largest first, compressing them for formats
+    # other than GL_RGBA8.
+    if format == GL_RGBA8:
+        encoded = [numpy.ascontiguousarray(level, dtype=numpy.uint8).ravel()
+            for level in levels]
+    elif format == GL_COMPRESSED_RGBA_S3TC_DXT5_EXT:
+        encoded = [compress_dxt5(level) for level in levels]
+    else:
+        raise ValueError("Can't bake textures in format 0x%x." % (format,))
+    header = numpy.zeros(1, dtype=header_dtype)
+    header['magic'] = magic
+    header['version'] = version
+    header['format'] = format
+    header['height'], header['width'] = levels[0].shape[:2]
+    header['levels'] = len(levels)
+    table = numpy.zeros(len(levels), dtype=level_dtype)
+    offset = header_dtype.itemsize + level_dtype.itemsize * len(levels)
+    for entry, level, data in zip(table, levels, encoded):
+        offset += -offset % level_alignment
+        entry['offset'] = offset
+        entry['size'] = data.nbytes
+        entry['height'], entry['width'] = level.shape[:2]
+        offset += data.nbytes
+    with open(filename, "wb") as f:
+        f.write(header.tobytes())
+        f.write(table.tobytes())
+        for entry, data in zip(table, encoded):
+            f.write(b"\0" * (int(entry['offset']) - f.tell()))
+            f.write(data.tobytes())
+
+def read_texture(filename):
+    # Maps a baked texture and returns its GL internal format and a list
+    # of (width, height, data) per level, largest first. Each data is a
+    # uint8 view straight onto the mapped file.
+    mapped = numpy.memmap(filename, dtype=numpy.uint8, mode='r')
+    header = mapped[:header_dtype.itemsize].view(header_dtype)[0]
+    if header['magic'] != magic or header['version'] != version:
+        raise Exception("%s is not a baked texture." % (filename,))
+    count = int(header['levels'])
+    table = mapped[
+        header_dtype.itemsize:
+        header_dtype.itemsize + level_dtype.itemsize * count
+        ].view(level_dtype)
+    levels = []
+    for entry in table:
+        offset = int(entry['offset'])
+        levels.append((
+            int(entry['width']), int(entry['height']),
+            mapped[offset:offset + int(entry['size'])]))
+    return int(header['format']), levels
+
+def bake(source, destination, compress=False, mipmaps=True):
+    pixels = load_pixels(source)
+    levels = mip_chain(pixels) if mipmaps else [pixels]
+    write_texture(destination, levels,
+        GL_COMPRESSED_RGBA_S3TC_DXT5_EXT if compress else GL_RGBA8)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=
+        "Bake an image and its mip chain into a texture that loads "
+        "without decoding.")
+    parser.add_argument("source", help="image to bake (anything pygame reads)")
+    parser.add_argument("destination", help="baked texture to write")
+    parser.add_argument("--compress", action="store_true",
+        help="store DXT5 (S3TC) blocks instead of RGBA8")
+    parser.add_argument("--no-mipmaps", action="store_true",
+        help="store only the full size level")
+    args = parser.parse_args(argv)
+    bake(args.source, args.destination, args.compress, not args.no_mipmaps)
+
+if __name__ == '__main__':
+    main()